@@ -1,42 +1,207 @@
 // Background script: fetch username from local whoami HTTP service (service.py)
 console.log('Background script loaded (HTTP mode via service.py)');
 
-chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
-  console.log('Background: Received message:', request);
+// Last identity body + its ETag: the service answers 304 (no body) while identity is unchanged.
+// Bodies from /whoami?fields=username and identity stream events share the same ETag.
+let lastWhoami = null;
+let lastEtag = null;
 
-  if (request && request.action === 'getADUsername') {
-    const url = 'http://127.0.0.1:7777/whoami';
-    console.log('Background: Fetching from', url);
+// ------------------------------------------------------------
+// Identity stream: one long-lived GET /events instead of a request per fill.
+// MV3 service workers have no EventSource, so the text/event-stream body is read with fetch.
+// While the stream is up, getADUsername is answered from memory (no HTTP at all).
+// ------------------------------------------------------------
+const EVENTS_URL = 'http://127.0.0.1:7777/events';
+const STREAM_MAX_RETRY_MS = 60000;
+let streamLive = false;
+let streamOpening = false;
+// the only pending reconnect: messages never start a second retry chain while the service is down
+let streamRetryTimer = null;
+let streamRetryMs = 2000; // server overrides with "retry:"
+let streamBackoffMs = streamRetryMs;
+
+function usernameFrom(data) {
+  if (data && data.username) return String(data.username).trim();
+  const active = data && data.active_console_user && data.active_console_user.username;
+  const proc = data && data.process_user && data.process_user.username;
+  return (active && String(active).trim()) || (proc && String(proc).trim()) || '';
+}
+
+function handleStreamEvent(block) {
+  let event = 'message';
+  const dataLines = [];
+  for (const line of block.split('\n')) {
+    if (!line || line.startsWith(':')) continue; // heartbeat / comment
+    const idx = line.indexOf(':');
+    const field = idx < 0 ? line : line.slice(0, idx);
+    const value = idx < 0 ? '' : line.slice(idx + 1).replace(/^ /, '');
+    if (field === 'event') event = value;
+    else if (field === 'data') dataLines.push(value);
+    else if (field === 'retry' && /^\d+$/.test(value)) streamRetryMs = Number(value);
+  }
+  if (event === 'identity' && dataLines.length) {
+    const data = JSON.parse(dataLines.join('\n'));
+    const before = usernameFrom(lastWhoami);
+    lastWhoami = data;
+    lastEtag = data.etag || null;
+    const username = usernameFrom(data);
+    console.log('Background: identity event, username:', username);
+    if (username && username !== before) {
+      // content scripts read cachedUsername first; keep it in step with the logged-on user
+      chrome.storage.sync.set({ cachedUsername: username, cachedAt: Date.now() }).catch(() => {});
+    }
+  } else if (event === 'session') {
+    console.log('Background: session event', dataLines.join('\n'));
+  }
+}
 
+function streamIdle() {
+  return !streamLive && !streamOpening && streamRetryTimer === null;
+}
+
+function scheduleStreamRetry() {
+  if (streamRetryTimer !== null) return;
+  streamRetryTimer = setTimeout(() => {
+    streamRetryTimer = null;
+    openEventStream();
+  }, streamBackoffMs);
+}
+
+async function openEventStream() {
+  if (!streamIdle()) return;
+  streamOpening = true;
+  try {
+    const resp = await fetch(EVENTS_URL, { headers: { 'Accept': 'text/event-stream' }, cache: 'no-store' });
+    if (!resp.ok || !resp.body) throw new Error(`HTTP ${resp.status}: ${resp.statusText}`);
+    streamLive = true;
+    streamOpening = false;
+    clearTimeout(streamRetryTimer);
+    streamRetryTimer = null;
+    streamBackoffMs = streamRetryMs;
+    const reader = resp.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += value.replace(/\r\n?/g, '\n');
+      let sep;
+      while ((sep = buffer.indexOf('\n\n')) >= 0) {
+        const block = buffer.slice(0, sep);
+        buffer = buffer.slice(sep + 2);
+        try {
+          handleStreamEvent(block);
+        } catch (err) {
+          console.log('Background: bad stream event:', err && err.message ? err.message : String(err));
+        }
+      }
+    }
+    console.log('Background: identity stream closed by service');
+  } catch (err) {
+    console.log('Background: identity stream error:', err && err.message ? err.message : String(err));
+    streamBackoffMs = Math.min(streamBackoffMs * 2, STREAM_MAX_RETRY_MS);
+  } finally {
+    streamLive = false;
+    streamOpening = false;
+    scheduleStreamRetry();
+  }
+}
+
+openEventStream();
+
+// ------------------------------------------------------------
+// Shared identity for every tab: one cached value, one request in flight.
+// The service's Cache-Control max-age says how long the value may be reused without asking;
+// after that a conditional GET (If-None-Match) usually comes back 304 with no body.
+// ------------------------------------------------------------
+// only the username is used: ask for the minimal body instead of the full /whoami payload
+const WHOAMI_URL = 'http://127.0.0.1:7777/whoami?fields=username';
+// services older than ?fields= match paths exactly and answer 404; fall back to the full payload
+// (usernameFrom reads either shape) until this service worker restarts
+const WHOAMI_FULL_URL = 'http://127.0.0.1:7777/whoami';
+let whoamiUrl = WHOAMI_URL;
+const FETCH_TIMEOUT_MS = 5000;
+const RETRY_DELAYS_MS = [250, 1000]; // bounded: at most 3 attempts per lookup
+let identityExpiresAt = 0;
+let identityInFlight = null;
+
+function maxAgeMs(resp) {
+  const match = /max-age=(\d+)/.exec(resp.headers.get('Cache-Control') || '');
+  return match ? Number(match[1]) * 1000 : 0;
+}
+
+async function fetchIdentityOnce() {
+  const controller = new AbortController();
+  const timer = setTimeout(() => controller.abort(), FETCH_TIMEOUT_MS);
+  try {
+    const headers = { 'Accept': 'application/json' };
+    if (lastEtag && lastWhoami) headers['If-None-Match'] = lastEtag;
+    const resp = await fetch(whoamiUrl, { method: 'GET', headers, cache: 'no-store', signal: controller.signal });
+    if (resp.status === 404 && whoamiUrl !== WHOAMI_FULL_URL) {
+      console.log('Background: service does not support ?fields=; using /whoami');
+      whoamiUrl = WHOAMI_FULL_URL;
+      lastEtag = null; // the ETag belonged to the other representation
+      return await fetchIdentityOnce();
+    }
+    if (!(resp.status === 304 && lastWhoami)) {
+      if (!resp.ok) {
+        const err = new Error(`HTTP ${resp.status}: ${resp.statusText}`);
+        // 503 = service busy (honour Retry-After); other 4xx will not get better by retrying
+        err.retryable = resp.status >= 500;
+        err.retryAfterMs = Number(resp.headers.get('Retry-After') || 0) * 1000;
+        throw err;
+      }
+      lastWhoami = await resp.json().catch(() => ({}));
+      lastEtag = resp.headers.get('ETag');
+    }
+    identityExpiresAt = Date.now() + maxAgeMs(resp);
+    return lastWhoami;
+  } finally {
+    clearTimeout(timer);
+  }
+}
+
+async function fetchIdentity() {
+  for (let attempt = 0; ; attempt++) {
     try {
-      const controller = new AbortController();
-      const timer = setTimeout(() => controller.abort(), 5000);
-
-      fetch(url, { method: 'GET', headers: { 'Accept': 'application/json' }, signal: controller.signal })
-        .then(async (resp) => {
-          clearTimeout(timer);
-          if (!resp.ok) throw new Error(`HTTP ${resp.status}: ${resp.statusText}`);
-          const data = await resp.json().catch(() => ({}));
-          const active = data && data.active_console_user && data.active_console_user.username;
-          const proc = data && data.process_user && data.process_user.username;
-          const username = (active && String(active).trim()) || (proc && String(proc).trim()) || '';
-          if (username) {
-            console.log('Background: Got username from whoami service:', username);
-            sendResponse({ success: true, username });
-          } else {
-            console.log('Background: whoami service returned no username', data);
-            sendResponse({ success: false, error: 'No username from whoami service' });
-          }
-        })
-        .catch((err) => {
-          clearTimeout(timer);
-          console.log('Background: HTTP error:', err && err.message ? err.message : String(err));
-          sendResponse({ success: false, error: (err && err.message) || 'HTTP error' });
-        });
-    } catch (error) {
-      console.log('Background: Exception during fetch:', error);
-      sendResponse({ success: false, error: 'Exception: ' + (error && error.message ? error.message : String(error)) });
+      return await fetchIdentityOnce();
+    } catch (err) {
+      if (attempt >= RETRY_DELAYS_MS.length || err.retryable === false) throw err;
+      const delay = Math.max(RETRY_DELAYS_MS[attempt], err.retryAfterMs || 0);
+      console.log(`Background: whoami attempt ${attempt + 1} failed (${err && err.message}); retrying in ${delay}ms`);
+      await new Promise((resolve) => setTimeout(resolve, delay));
     }
+  }
+}
+
+function getIdentity() {
+  if (lastWhoami && (streamLive || Date.now() < identityExpiresAt)) return Promise.resolve(lastWhoami);
+  if (!identityInFlight) {
+    identityInFlight = fetchIdentity().finally(() => { identityInFlight = null; });
+  }
+  return identityInFlight;
+}
+
+chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
+  console.log('Background: Received message:', request);
+
+  if (request && request.action === 'getADUsername') {
+    getIdentity()
+      .then((data) => {
+        // no-op while connected, connecting or waiting for the scheduled retry
+        if (streamIdle()) openEventStream();
+        const username = usernameFrom(data);
+        if (username) {
+          console.log('Background: Got username from whoami service:', username);
+          sendResponse({ success: true, username });
+        } else {
+          console.log('Background: whoami service returned no username', data);
+          sendResponse({ success: false, error: 'No username from whoami service' });
+        }
+      })
+      .catch((err) => {
+        console.log('Background: HTTP error:', err && err.message ? err.message : String(err));
+        sendResponse({ success: false, error: (err && err.message) || 'HTTP error' });
+      });
 
     return true; // Keep message channel open for async response
   }
@@ -0,0 +1,337 @@
+# loadtest.py
+"""
+load test / latency benchmark ของ HTTP service ทั้งสองตัว รันบน Linux ได้
+- โมดูล Windows (win32ts, win32service, servicemanager, ...) และ subprocess ถูกแทนด้วย stub ในหน่วยความจำ
+- server รันใน process ลูก (ไม่แย่ง GIL กับ client) ส่วน client ยิงด้วย thread ตาม --concurrency
+- ผลลัพธ์เป็น JSON: throughput และ latency p50/p95/p99 ต่อ target
+
+ตัวอย่าง:
+    python bench/loadtest.py                                  # ทุก target, 2000 requests, concurrency 8
+    python bench/loadtest.py -t new-threading -t new-asyncio -c 32 --duration 10
+    python bench/loadtest.py -t old --no-keep-alive --spawn-ms 50 -o bench_output.json
+
+ค่าปรับของ service (WHOAMI_WORKERS, WHOAMI_QUEUE_SIZE, WHOAMI_KEEPALIVE_MAX, ...) ส่งผ่าน environment ได้ตามปกติ
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TARGETS = {
+    "new-threading": "/whoami",
+    "new-asyncio": "/whoami",
+    "old": "/username",
+}
+
+FAKE_USER = "alice"
+FAKE_DOMAIN = "CORP"
+
+
+# ---------------- stub ของ Windows / subprocess (ใช้ใน process ลูกเท่านั้น) ----------------
+def install_windows_stubs():
+    """ใส่โมดูล pywin32 ปลอมลง sys.modules ให้ import service ได้บน Linux"""
+
+    def module(name: str, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    class _Event:
+        def __init__(self):
+            self.event = threading.Event()
+
+    def wait_for_single_object(handle, ms):
+        return 0 if handle.event.wait(None if ms < 0 else ms / 1000) else 258
+
+    module(
+        "win32event",
+        WAIT_OBJECT_0=0, WAIT_TIMEOUT=258, INFINITE=-1,
+        CreateEvent=lambda *a: _Event(),
+        SetEvent=lambda h: h.event.set(),
+        WaitForSingleObject=wait_for_single_object,
+    )
+    win32service = module(
+        "win32service",
+        SERVICE_STOPPED=1, SERVICE_START_PENDING=2, SERVICE_STOP_PENDING=3, SERVICE_RUNNING=4,
+        SERVICE_ACCEPT_STOP=1, SERVICE_ACCEPT_SHUTDOWN=4, SERVICE_ACCEPT_SESSIONCHANGE=0x80,
+        SERVICE_CONTROL_SESSIONCHANGE=0xE,
+    )
+
+    class ServiceFramework:
+        def __init__(self, args):
+            pass
+
+        def ReportServiceStatus(self, *a, **k):
+            pass
+
+        def GetAcceptedControls(self):
+            return win32service.SERVICE_ACCEPT_STOP
+
+    module("win32serviceutil", ServiceFramework=ServiceFramework, HandleCommandLine=lambda cls: None)
+    module(
+        "servicemanager",
+        EVENTLOG_INFORMATION_TYPE=4, PYS_SERVICE_STARTED=1,
+        LogMsg=lambda *a: None, LogInfoMsg=lambda m: None, LogErrorMsg=lambda m: None,
+    )
+    module(
+        "win32ts",
+        WTS_CURRENT_SERVER_HANDLE=0, WTSUserName=5, WTSDomainName=7,
+        WTS_CONSOLE_CONNECT=1, WTS_CONSOLE_DISCONNECT=2, WTS_REMOTE_CONNECT=3, WTS_REMOTE_DISCONNECT=4,
+        WTS_SESSION_LOGON=5, WTS_SESSION_LOGOFF=6, WTS_SESSION_LOCK=7, WTS_SESSION_UNLOCK=8,
+        WTSGetActiveConsoleSessionId=lambda: 1,
+        WTSQuerySessionInformation=lambda h, sid, cls: {5: FAKE_USER, 7: FAKE_DOMAIN}[cls],
+        WTSEnumerateSessions=lambda h, *a: [
+            {"SessionId": 0, "WinStationName": "Services", "State": 4},
+            {"SessionId": 1, "WinStationName": "Console", "State": 0},
+        ],
+    )
+
+
+def install_subprocess_stub(spawn_ms: float):
+    """
+    แทน subprocess.run / Popen ด้วยของปลอมที่หน่วงเวลา spawn_ms แล้วคืน DOMAIN\\user
+    จำลองต้นทุนการสร้าง process บน Windows โดยไม่ต้องมี whoami/PowerShell จริง
+    """
+    delay = spawn_ms / 1000
+    output = f"{FAKE_DOMAIN.lower()}\\{FAKE_USER}\n"
+
+    def fake_run(args, *a, timeout=None, **kw):
+        time.sleep(delay)
+        return subprocess.CompletedProcess(args, 0, output, "")
+
+    class FakePopen:
+        def __init__(self, args, *a, **kw):
+            self.args = args
+            self.returncode = None
+            self._done_at = time.monotonic() + delay
+
+        def poll(self):
+            if time.monotonic() >= self._done_at:
+                self.returncode = 0
+            return self.returncode
+
+        def communicate(self, timeout=None):
+            remaining = self._done_at - time.monotonic()
+            if timeout is not None and remaining > timeout:
+                time.sleep(timeout)
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(max(0.0, remaining))
+            self.returncode = 0
+            return output, ""
+
+        def kill(self):
+            self._done_at = time.monotonic()
+
+    subprocess.run = fake_run
+    subprocess.Popen = FakePopen
+
+
+def build_server(target: str):
+    """สร้าง server ของ target บนพอร์ตว่าง คืน (server, serve) โดย serve() บล็อกจนปิด"""
+    if target.startswith("new-"):
+        # core ไม่ import pywin32; provider เริ่มต้นรัน whoami ผ่าน subprocess ที่ถูก stub ไว้
+        sys.path.insert(0, str(ROOT / "webservice-new"))
+        import core
+
+        core.register_service_metrics()
+        core.identity_refresher.start()
+        server = core.make_server(("127.0.0.1", 0), target.split("-", 1)[1])
+        return server, server.serve_forever
+
+    sys.path.insert(0, str(ROOT / "webservice-old"))
+    import ad_server_service
+
+    # server class เดียวกับ ADUsernameServer.start แต่ใช้พอร์ตว่าง
+    server = ad_server_service.ADUsernameHTTPServer(("127.0.0.1", 0), ad_server_service.ADUsernameHandler)
+    return server, server.serve_forever
+
+
+def serve(target: str, spawn_ms: float):
+    """โหมด process ลูก: พิมพ์ PORT แล้วเสิร์ฟจนกว่าจะถูก terminate"""
+    install_windows_stubs()
+    install_subprocess_stub(spawn_ms)
+    server, serve_forever = build_server(target)
+    port = server.server_address[1]
+    sys.stdout.write(f"PORT {port}\n")
+    sys.stdout.flush()
+    # handler บางตัว print ทุก request; ทิ้ง stdout เพื่อไม่ให้ pipe เต็มแล้วบล็อก
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    serve_forever()
+
+
+# ---------------- ฝั่ง client ----------------
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """nearest-rank: ค่าที่ตำแหน่ง ceil(pct% * n)"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct * len(sorted_values) / 100) - 1))
+    return sorted_values[rank]
+
+
+class LoadResult:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: list[float] = []
+        self.statuses: dict[str, int] = {}
+        self.errors = 0
+        self.connections = 0
+
+
+def client_worker(port: int, path: str, keep_alive: bool, result: LoadResult, budget, deadline: float | None):
+    latencies = []
+    statuses: dict[str, int] = {}
+    errors = 0
+    connections = 0
+    conn = None
+    headers = {} if keep_alive else {"Connection": "close"}
+    while budget():
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        if conn is None:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            connections += 1
+        started = time.perf_counter()
+        try:
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            latencies.append(time.perf_counter() - started)
+            statuses[str(resp.status)] = statuses.get(str(resp.status), 0) + 1
+            if not keep_alive or resp.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+    with result.lock:
+        result.latencies.extend(latencies)
+        for k, v in statuses.items():
+            result.statuses[k] = result.statuses.get(k, 0) + v
+        result.errors += errors
+        result.connections += connections
+
+
+def drive(port: int, path: str, concurrency: int, keep_alive: bool,
+          requests: int, duration: float | None) -> dict:
+    result = LoadResult()
+    remaining = [requests]
+    budget_lock = threading.Lock()
+
+    def budget() -> bool:
+        if duration is not None:
+            return True
+        with budget_lock:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    started = time.perf_counter()
+    deadline = started + duration if duration is not None else None
+    threads = [
+        threading.Thread(target=client_worker, args=(port, path, keep_alive, result, budget, deadline), daemon=True)
+        for _ in range(concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    lat = sorted(result.latencies)
+    ms = lambda v: round(v * 1000, 3)  # noqa: E731
+    return {
+        "requests": len(lat),
+        "errors": result.errors,
+        "connections": result.connections,
+        "statuses": dict(sorted(result.statuses.items())),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(lat) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": ms(sum(lat) / len(lat)) if lat else 0.0,
+            "p50": ms(percentile(lat, 50)),
+            "p95": ms(percentile(lat, 95)),
+            "p99": ms(percentile(lat, 99)),
+            "max": ms(lat[-1]) if lat else 0.0,
+        },
+    }
+
+
+def run_target(target: str, args) -> dict:
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--serve", target, "--spawn-ms", str(args.spawn_ms)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, cwd=str(ROOT))
+    try:
+        line = proc.stdout.readline()
+        if not line.startswith("PORT "):
+            raise RuntimeError(f"{target}: server did not start (exit={proc.poll()})")
+        port = int(line.split()[1])
+        path = args.path or TARGETS[target]
+        if args.warmup:
+            drive(port, path, 1, True, args.warmup, None)
+        report = drive(port, path, args.concurrency, args.keep_alive, args.requests, args.duration)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return {
+        "target": target,
+        "path": path,
+        "concurrency": args.concurrency,
+        "keep_alive": args.keep_alive,
+        **report,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the whoami / AD username HTTP services")
+    parser.add_argument("-t", "--target", action="append", choices=sorted(TARGETS),
+                        help="target ที่จะวัด (ใส่ซ้ำได้; ค่าเริ่มต้น = ทุก target)")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="จำนวน client พร้อมกัน")
+    parser.add_argument("-n", "--requests", type=int, default=2000, help="จำนวน request ทั้งหมด (ถ้าไม่ใส่ --duration)")
+    parser.add_argument("-d", "--duration", type=float, help="วัดตามเวลา (วินาที) แทนจำนวน request")
+    parser.add_argument("--keep-alive", dest="keep_alive", action="store_true", default=True,
+                        help="ใช้ connection เดิมซ้ำ (ค่าเริ่มต้น)")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false",
+                        help="เปิด connection ใหม่ทุก request")
+    parser.add_argument("--path", help="path ที่ยิง (ค่าเริ่มต้น /whoami หรือ /username ตาม target)")
+    parser.add_argument("--warmup", type=int, default=50, help="request อุ่นเครื่องก่อนวัด")
+    parser.add_argument("--spawn-ms", type=float, default=20.0, help="เวลาที่ subprocess ปลอมใช้ (ms)")
+    parser.add_argument("-o", "--output", help="เขียน JSON ลงไฟล์แทน stdout")
+    parser.add_argument("--serve", choices=sorted(TARGETS), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.spawn_ms)
+        return
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "spawn_ms": args.spawn_ms,
+        "results": [run_target(t, args) for t in (args.target or list(TARGETS))],
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
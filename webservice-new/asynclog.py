@@ -0,0 +1,170 @@
+# asynclog.py
+"""
+logging แบบไม่บล็อก request thread
+- handler ฝั่ง request แค่ใส่ record ลงคิว (put_nowait) ถ้าคิวเต็มจะทิ้งและนับไว้ใน dropped
+- writer thread เดียวดึง record เป็นชุด แล้วเขียนลงไฟล์ (มี rotation) ด้วย write/flush ครั้งเดียวต่อชุด
+- stop() เขียนของที่ค้างในคิวให้หมดก่อนปิดไฟล์ (เรียกตอน SvcStop); log หลัง stop() เขียนตรงไม่ผ่านคิว
+ใช้ร่วมกันทั้ง webservice-new และ webservice-old
+"""
+import logging
+import queue
+import threading
+from logging.handlers import RotatingFileHandler
+
+_STOP = object()
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler ที่เขียนหลาย record ในครั้งเดียว"""
+
+    def emit_batch(self, records: list) -> None:
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + self.terminator)
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+        text = "".join(lines)
+        with self.lock:
+            try:
+                if self.stream is None:
+                    self.stream = self._open()
+                if self.maxBytes > 0 and self.stream.tell() and self.stream.tell() + len(text) >= self.maxBytes:
+                    self.doRollover()
+                self.stream.write(text)
+                self.stream.flush()
+            except Exception:
+                self.handleError(records[-1])
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Handler ที่ผูกกับ logger: emit() แค่เข้าคิว ส่วนการเขียนไฟล์อยู่ใน writer thread
+    target ต้องมี emit_batch() (เช่น BatchRotatingFileHandler)
+    """
+
+    def __init__(self, target: BatchRotatingFileHandler, maxsize: int = 10_000,
+                 batch_size: int = 256, flush_interval: float = 0.5):
+        super().__init__()
+        self.target = target
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self._closed = False  # ตั้งก่อนส่ง _STOP: emit หลังจากนั้นเขียนตรง ไม่เข้าคิวที่ไม่มีใครอ่านแล้ว
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+
+    # ---------- ฝั่ง request thread ----------
+    def emit(self, record: logging.LogRecord) -> None:
+        # traceback ต้อง format ตอนนี้ เพราะ frame จะหายไปก่อน writer ได้ทำงาน
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if self._closed or self._thread is None:
+            # ยังไม่ start หรือกำลัง stop / stop ไปแล้ว (เช่น log สุดท้ายหลัง SvcStop) เขียนตรงแทน
+            self.target.emit_batch([record])
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    # ---------- writer thread ----------
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name="async-log-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        stopping = False  # เห็น _STOP แล้ว: เขียนที่เหลือในคิวให้หมด (ไม่รอของใหม่) แล้วจบ
+        while True:
+            try:
+                first = self._queue.get_nowait() if stopping else self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if stopping:
+                    return
+                continue
+            batch = [] if first is _STOP else [first]
+            stopping = stopping or first is _STOP
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    continue
+                batch.append(item)
+            if batch:
+                self.target.emit_batch(batch)
+                self.written += len(batch)
+                self.batches += 1
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """เขียน record ที่ค้างทั้งหมดแล้วปิดไฟล์ (ปิดเมื่อ writer thread จบแล้วเท่านั้น)"""
+        self._closed = True
+        thread = self._thread
+        if thread and thread.is_alive():
+            # รอที่ว่างในคิวได้ (ไม่ใช้ put_nowait) เพื่อให้ sentinel ไม่หลุด
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            thread.join(timeout)
+            if thread.is_alive():
+                # disk ช้าจนเขียนไม่ทันเวลา: อย่าปิดไฟล์ใต้มือ writer (daemon thread จะจบพร้อม process)
+                return
+        self._thread = None
+        # record ที่เข้าคิวหลัง writer เห็นคิวว่างครั้งสุดท้าย (emit ที่ผ่านการเช็ก _closed มาก่อน stop)
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                leftover.append(item)
+        if leftover:
+            self.target.emit_batch(leftover)
+            self.written += len(leftover)
+        self.target.close()
+
+    def close(self) -> None:
+        self.stop()
+        super().close()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+            "written": self.written,
+            "batches": self.batches,
+        }
+
+
+def attach(logger: logging.Logger, path: str, fmt: str, max_bytes: int = 5_000_000,
+           backup_count: int = 3, **options) -> AsyncLogHandler:
+    """สร้าง writer ไปที่ path, ผูกกับ logger (แทน handler เดิม) และเริ่ม writer thread"""
+    target = BatchRotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    target.setFormatter(logging.Formatter(fmt))
+    return attach_target(logger, target, **options)
+
+
+def attach_target(logger: logging.Logger, target, **options) -> AsyncLogHandler:
+    """เหมือน attach() แต่ใช้ target ที่สร้างเอง (อะไรก็ได้ที่มี emit_batch(records) และ close())"""
+    handler = AsyncLogHandler(target, **options)
+    handler.start()
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+        old.close()
+    logger.addHandler(handler)
+    logger.propagate = False
+    return handler
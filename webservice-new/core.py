@@ -0,0 +1,1597 @@
+# core.py
+"""
+แกนของ whoami service ที่ไม่ผูกกับ Windows: HTTP server, identity cache/refresher, metrics, logging
+- ที่มาของ identity เสียบผ่าน IdentityProvider (Windows ใช้ WTS ใน service.py, CI/benchmark ใช้ FakeIdentityProvider)
+- service.py เป็นแค่ adapter ของ Windows service ที่เรียก start_core()/stop_core()
+- รันแบบ foreground บน OS ไหนก็ได้: python core.py --fake-user alice
+- เสิร์ฟ /username และ /status ของ webservice-old ด้วย (router, identity cache, resolver ชุดเดียวกัน)
+  จึงไม่ต้องรัน ad_server_service.py แยกอีก process บน port เดียวกัน
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import threading
+import time
+import subprocess
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+from http.client import parse_headers
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+import asynclog
+import metrics
+import resolvers
+import sse
+from cors import CorsPolicy, parse_origins
+from router import Router
+from sessionbus import SessionEvent, SessionEventBus
+from singleflight import SingleFlight
+
+# ---------------- ปรับค่าได้ ----------------
+HOST = os.environ.get("WHOAMI_HOST", "127.0.0.1")  # ใช้ "0.0.0.0" ถ้าต้องการรับจากภายนอก
+PORT = int(os.environ.get("WHOAMI_PORT", "7777"))
+LOG_PATH = os.path.join(
+    os.environ.get("PROGRAMDATA", r"C:\ProgramData"),
+    "whoami_service",
+    "service.log",
+)
+REFRESH_INTERVAL = float(os.environ.get("WHOAMI_REFRESH_INTERVAL", "15"))  # วินาที; refresh identity เบื้องหลัง
+CACHE_TTL = float(os.environ.get("WHOAMI_CACHE_TTL", "30"))  # วินาที; snapshot เก่ากว่านี้ถือว่า stale
+SERVER_MODE = os.environ.get("WHOAMI_SERVER_MODE", "threading").strip().lower()  # "threading" หรือ "asyncio"
+ASYNC_WORKERS = int(os.environ.get("WHOAMI_ASYNC_WORKERS", "4"))  # thread สำหรับงานที่บล็อกในโหมด asyncio
+KEEPALIVE_TIMEOUT = float(os.environ.get("WHOAMI_KEEPALIVE_TIMEOUT", "5"))  # วินาที; ปิด connection ที่ idle
+KEEPALIVE_MAX = int(os.environ.get("WHOAMI_KEEPALIVE_MAX", "100"))  # request สูงสุดต่อ connection
+WORKERS = int(os.environ.get("WHOAMI_WORKERS", "16"))  # worker thread คงที่ของ HTTP server
+QUEUE_SIZE = int(os.environ.get("WHOAMI_QUEUE_SIZE", "64"))  # connection ที่รอ worker ได้สูงสุด; เกินนี้ตอบ 503
+# backlog ของ listen() ต้องใหญ่กว่าคิว: ไม่งั้น burst ล้น backlog ของ kernel (ค่าเดิม 5) แล้ว client ค้างรอ SYN retransmit ~1s
+# แทนที่จะได้ 503 ทันที (เท่ากับ handover.create_listen_socket)
+LISTEN_BACKLOG = max(QUEUE_SIZE, 128)
+RETRY_AFTER = 1  # วินาที; ใส่ใน Retry-After ตอนตอบ 503
+GRACEFUL_RESTART = os.environ.get("WHOAMI_GRACEFUL_RESTART", "0") == "1"  # เสิร์ฟจาก worker process ที่สลับตัวได้โดยไม่ปิด port
+DRAIN_TIMEOUT = float(os.environ.get("WHOAMI_DRAIN_TIMEOUT", str(KEEPALIVE_TIMEOUT + 5)))  # วินาที; worker เก่ารอ request ค้าง
+ACCESS_LOG = os.environ.get("WHOAMI_ACCESS_LOG", "text").strip().lower()  # "text" | "json" | "off"
+ACCESS_LOG_SAMPLE = float(os.environ.get("WHOAMI_ACCESS_LOG_SAMPLE", "1"))  # สัดส่วน 2xx/3xx ที่ลง log; 4xx/5xx ลงทุกครั้ง
+CLIENT_MAX_AGE = int(os.environ.get("WHOAMI_CLIENT_MAX_AGE", "5"))  # วินาที; Cache-Control max-age ของ identity ให้ client cache เอง
+COMPRESS_MIN_BYTES = int(os.environ.get("WHOAMI_COMPRESS_MIN_BYTES", "1024"))  # body เล็กกว่านี้ไม่บีบ (gzip/deflate)
+SSE_HEARTBEAT = float(os.environ.get("WHOAMI_SSE_HEARTBEAT", "15"))  # วินาที; ping ของ /events (ต่ำกว่า idle 30s ของ MV3)
+SSE_MAX_CLIENTS = int(os.environ.get("WHOAMI_SSE_MAX_CLIENTS", "256"))  # stream ที่เปิดค้างได้พร้อมกัน; เกินนี้ตอบ 503
+CORS_ORIGINS = parse_origins(os.environ.get("WHOAMI_CORS_ORIGINS"))  # origin ที่ browser เรียกได้ (comma); "*" = ทุก origin; extension ต้องเป็น ID ตรงตัว
+CORS_MAX_AGE = int(os.environ.get("WHOAMI_CORS_MAX_AGE", "7200"))  # วินาทีที่ browser จำผล preflight (Chrome จำได้สูงสุด 7200)
+# -------------------------------------------
+
+logger = logging.getLogger("whoami_service")
+logger.setLevel(logging.INFO)  # handler จะถูกเติมภายหลัง
+access_logger = logging.getLogger("whoami_service.access")  # JSON lines แยกไฟล์ (WHOAMI_ACCESS_LOG=json)
+access_logger.setLevel(logging.INFO)
+
+HTTP_REQUESTS = metrics.REGISTRY.counter(
+    "whoami_http_requests_total", "HTTP requests by route and status", ["route", "status"])
+HTTP_SECONDS = metrics.REGISTRY.histogram(
+    "whoami_http_request_duration_seconds", "Time to handle and write one request", ["route"])
+HTTP_IN_FLIGHT = metrics.REGISTRY.gauge(
+    "whoami_http_in_flight_requests", "Requests currently being handled")
+SESSION_EVENTS = metrics.REGISTRY.counter(
+    "whoami_session_events_total", "Session change notifications by event", ["event"])
+RESOLVER_SECONDS = metrics.REGISTRY.histogram(
+    "whoami_resolver_duration_seconds", "Identity lookup time per tier", ["tier", "outcome"])
+SUBPROCESS_SPAWNS = metrics.REGISTRY.counter(
+    "whoami_subprocess_spawns_total", "Child processes started", ["command"])
+
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+LOG_QUEUE_SIZE = int(os.environ.get("WHOAMI_LOG_QUEUE_SIZE", "10000"))  # record ที่รอเขียนได้สูงสุด; เกินนี้ทิ้ง
+log_handler: asynclog.AsyncLogHandler | None = None
+access_handler: asynclog.AsyncLogHandler | None = None
+
+
+def setup_logging():
+    """สร้างโฟลเดอร์ log และผูก async handler อย่างปลอดภัย (เรียกเมื่อ service เริ่มจริง ๆ)"""
+    global log_handler, access_handler
+    try:
+        log_dir = Path(LOG_PATH).parent
+        log_dir.mkdir(parents=True, exist_ok=True)
+        log_handler = asynclog.attach(logger, LOG_PATH, LOG_FORMAT, backup_count=3, maxsize=LOG_QUEUE_SIZE)
+        if ACCESS_LOG == "json":
+            access_handler = asynclog.attach(access_logger, str(log_dir / "access.log"), "%(message)s",
+                                             backup_count=3, maxsize=LOG_QUEUE_SIZE)
+        logger.info("Logging initialized at %s (access log: %s, sample=%s)", LOG_PATH, ACCESS_LOG, ACCESS_LOG_SAMPLE)
+    except Exception:
+        # ถ้าเขียน ProgramData ไม่ได้ ให้ fallback ไป temp
+        import tempfile
+        fallback = os.path.join(tempfile.gettempdir(), "whoami_service.log")
+        try:
+            log_handler = asynclog.attach(logger, fallback, LOG_FORMAT, backup_count=2, maxsize=LOG_QUEUE_SIZE)
+            if ACCESS_LOG == "json":
+                access_handler = asynclog.attach(access_logger, os.path.join(tempfile.gettempdir(), "whoami_access.log"),
+                                                 "%(message)s", backup_count=2, maxsize=LOG_QUEUE_SIZE)
+            logger.warning("Failed to init log at %s, fallback to %s", LOG_PATH, fallback)
+        except Exception:
+            pass  # อย่างน้อย Event Log ยังมี
+
+
+def forward_logging(target):
+    """
+    ใช้แทน setup_logging() ใน worker process ของ graceful restart: record ไปที่ target (ส่งต่อให้ supervisor)
+    มีแค่ supervisor ที่เปิดไฟล์ log จึง rotate ได้บน Windows (ไฟล์ที่ process อื่นเปิดอยู่ rename ไม่ได้)
+    """
+    global log_handler, access_handler
+    log_handler = asynclog.attach_target(logger, target, maxsize=LOG_QUEUE_SIZE)
+    if ACCESS_LOG == "json":
+        access_handler = asynclog.attach_target(access_logger, target, maxsize=LOG_QUEUE_SIZE)
+
+
+def flush_logging():
+    """เขียน log ที่ค้างในคิวให้หมด (เรียกตอน SvcStop)"""
+    for handler in (access_handler, log_handler):
+        if handler is not None:
+            handler.stop()
+
+
+def iso_now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+
+def get_process_whoami() -> dict:
+    """รัน whoami (ผู้ใช้ของโปรเซส service ปัจจุบัน)"""
+    raw = ""
+    SUBPROCESS_SPAWNS.inc(command="whoami")
+    try:
+        proc = subprocess.run(["whoami"], capture_output=True, text=True, shell=False, check=True)
+        raw = (proc.stdout or "").strip()
+    except subprocess.CalledProcessError as e:
+        logger.exception("whoami failed")
+        raw = (e.stdout or "").strip() or "unknown"
+
+    domain, username = (None, raw)
+    if "\\" in raw:
+        domain, username = raw.split("\\", 1)
+
+    return {"raw": raw, "domain": domain, "username": username}
+
+
+# WTS_CONNECTSTATE_CLASS -> ชื่อที่ใช้ใน /sessions
+SESSION_STATES = {
+    0: "active", 1: "connected", 2: "connect-query", 3: "shadow", 4: "disconnected",
+    5: "idle", 6: "listen", 7: "reset", 8: "down", 9: "init",
+}
+
+
+def session_entry(session_id: int, state: int, domain: str | None, username: str | None,
+                  station: str | None = None) -> dict:
+    return {
+        "session_id": int(session_id),
+        "station": station or None,
+        "state": SESSION_STATES.get(state, str(state)),
+        "domain": domain or None,
+        "username": username,
+    }
+
+
+class IdentityProvider:
+    """
+    ที่มาของ identity สำหรับ IdentityRefresher
+    - process_user(): ผู้ใช้ของโปรเซส service (ค่าเริ่มต้นรัน whoami ซึ่งมีทุก OS)
+    - active_console_user(): ผู้ใช้ที่ล็อกอินหน้าเครื่อง; None = ไม่มี session, error ให้ raise
+    - sessions(): ทุก session ที่มีผู้ใช้ (list ของ session_entry) ดึงรวดเดียว
+    """
+
+    process_tier = "whoami"
+    console_tier = "console"
+    sessions_tier = "sessions"
+
+    def process_user(self) -> dict:
+        return get_process_whoami()
+
+    def active_console_user(self) -> dict | None:
+        return None
+
+    def sessions(self) -> list[dict]:
+        return []
+
+
+class FakeIdentityProvider(IdentityProvider):
+    """identity คงที่สำหรับรันบน Linux/CI และ benchmark (ไม่ spawn process, ไม่แตะ WTS)"""
+
+    process_tier = "fake-process"
+    console_tier = "fake-console"
+    sessions_tier = "fake-sessions"
+
+    def __init__(self, username: str = "svc-whoami", console_user: str | None = None,
+                 domain: str = "LOCAL", delay: float = 0.0, remote_users: list[str] | None = None):
+        self.username = username
+        self.console_user = console_user
+        self.domain = domain
+        self.delay = delay  # วินาที; จำลองเวลาที่ provider จริงใช้
+        self.remote_users = list(remote_users or [])  # ผู้ใช้ RDP (session 2, 3, ...)
+
+    def process_user(self) -> dict:
+        if self.delay:
+            time.sleep(self.delay)
+        return {"raw": f"{self.domain}\\{self.username}", "domain": self.domain, "username": self.username}
+
+    def active_console_user(self) -> dict | None:
+        if not self.console_user:
+            return None
+        return {"domain": self.domain, "username": self.console_user, "session_id": 1}
+
+    def sessions(self) -> list[dict]:
+        entries = []
+        if self.console_user:
+            entries.append(session_entry(1, 0, self.domain, self.console_user, "Console"))
+        for i, user in enumerate(self.remote_users, start=2):
+            entries.append(session_entry(i, 0, self.domain, user, f"RDP-Tcp#{i}"))
+        return entries
+
+
+def identity_etag(process_user: dict | None, active_console_user: dict | None,
+                  sessions: list[dict] | None = None) -> str:
+    """
+    ลายนิ้วมือของ identity ทั้ง snapshot (ไม่รวม ts/age) ใช้ตัดสินว่า identity เปลี่ยนจริงไหม (on_change, /events)
+    ไม่ใช่ ETag ของ response: แต่ละ representation มี ETag ของตัวเอง (representation_etag)
+    """
+    raw = json.dumps([process_user, active_console_user, sessions or []], sort_keys=True).encode("utf-8")
+    return 'W/"%s"' % hashlib.sha1(raw).hexdigest()[:16]
+
+
+# field ที่เปลี่ยนตามเวลา/รอบ refresh แม้ identity เดิม: ไม่นับใน ETag ไม่งั้น 304 แทบไม่เกิด
+VOLATILE_FIELDS = frozenset({"ts", "snapshot"})
+
+
+def representation_etag(route: str, payload: dict) -> str:
+    """
+    weak ETag ต่อ representation: route (รวม ?fields=) + field ที่ body นั้นมีจริง ยกเว้น VOLATILE_FIELDS
+    RDP เข้า/ออกจึงไม่ทำให้ /whoami หรือ ?fields=username เปลี่ยน ETag (ไม่มี sessions ใน body)
+    """
+    stable = {k: v for k, v in payload.items() if k not in VOLATILE_FIELDS}
+    raw = json.dumps([route, stable], sort_keys=True).encode("utf-8")
+    return 'W/"%s"' % hashlib.sha1(raw).hexdigest()[:16]
+
+
+class IdentityCache:
+    """
+    เก็บ identity snapshot ล่าสุด (process_user / active_console_user) ในหน่วยความจำ
+    - IdentityRefresher เป็นคนเติม snapshot; handler แค่อ่าน ไม่ต้อง spawn whoami / query WTS
+    - snapshot ที่อายุเกิน ttl หรือโดน invalidate ยังเสิร์ฟได้ (stale-while-revalidate)
+      ระหว่างรอ refresher โหลดค่าใหม่
+    - นับ hits/misses ไว้ดูใน /healthz
+    - on_change(): callback เมื่อ identity เปลี่ยนจริง (ETag ใหม่) เช่น push event ไปที่ /events
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._listeners: list = []
+        self._snapshot: dict | None = None
+        self._invalidated = False
+        self._version = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def current(self) -> dict | None:
+        """snapshot ล่าสุด หรือ None ถ้ายังไม่เคยโหลดสำเร็จ"""
+        with self._lock:
+            snap = self._snapshot
+            if snap is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self._is_stale(snap):
+                self.stale_hits += 1
+            return snap
+
+    def peek(self) -> dict | None:
+        """เหมือน current() แต่ไม่นับสถิติ"""
+        return self._snapshot
+
+    def is_stale(self, snap: dict) -> bool:
+        with self._lock:
+            return self._is_stale(snap)
+
+    def _is_stale(self, snap: dict) -> bool:
+        if snap is not self._snapshot:
+            return True
+        return self._invalidated or time.monotonic() - snap["refreshed_at"] >= self.ttl
+
+    def publish(self, process_user: dict, active_console_user: dict | None, source: str,
+                sessions: list[dict] | None = None) -> dict:
+        with self._lock:
+            self._version += 1
+            snap = {
+                "process_user": process_user,
+                "active_console_user": active_console_user,
+                "sessions": sessions or [],
+                "source": source,
+                "version": self._version,
+                "etag": identity_etag(process_user, active_console_user, sessions),
+                "refreshed_at": time.monotonic(),
+                "refreshed_ts": iso_now(),
+            }
+            previous, self._snapshot = self._snapshot, snap
+            self._invalidated = False
+        if previous is None or previous["etag"] != snap["etag"]:
+            for callback in self._listeners:
+                try:
+                    callback(snap)
+                except Exception:
+                    logger.exception("Identity change listener failed")
+        return snap
+
+    def on_change(self, callback):
+        """callback(snapshot) ถูกเรียกจาก thread ที่ publish เมื่อเนื้อหา identity เปลี่ยน"""
+        self._listeners.append(callback)
+
+    def invalidate(self, reason: str = ""):
+        with self._lock:
+            self._invalidated = True
+            self.invalidations += 1
+        logger.info("Identity cache invalidated (%s)", reason or "manual")
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            snap = self._snapshot
+            return {
+                "ttl": self.ttl,
+                "version": self._version,
+                "age": round(time.monotonic() - snap["refreshed_at"], 3) if snap else None,
+                "stale": self._is_stale(snap) if snap else None,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+def timed_tier(tier: str, fn):
+    """เรียก fn แล้วเก็บเวลาไว้ใน whoami_resolver_duration_seconds"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = fn()
+        outcome = "ok"
+        return result
+    finally:
+        RESOLVER_SECONDS.observe(time.perf_counter() - started, tier=tier, outcome=outcome)
+
+
+class IdentityRefresher:
+    """
+    thread เบื้องหลังที่ refresh identity snapshot ตามรอบ และทันทีเมื่อถูก poke (เช่น session เปลี่ยน)
+    ถ้า refresh ล้มเหลว snapshot เดิมยังถูกเสิร์ฟต่อ แล้ว retry แบบ backoff
+    """
+
+    def __init__(self, cache: IdentityCache, interval: float, provider: IdentityProvider | None = None,
+                 max_backoff: float = 60.0):
+        self.cache = cache
+        self.provider = provider or IdentityProvider()
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        # refresh จาก background และ on-demand ที่มาพร้อมกันจะใช้ผลเดียวกัน (spawn whoami ครั้งเดียว)
+        self._flight = SingleFlight()
+        self._reason = "schedule"
+        self._thread: threading.Thread | None = None
+        self.refreshes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_error: str | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="identity-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def poke(self, reason: str, force: bool = True):
+        """
+        ขอให้ refresh ทันที (ไม่รอ)
+        force=False ใช้กับกรณี snapshot แค่หมดอายุ: ถ้ากำลัง backoff อยู่จะไม่ปลุก
+        """
+        if not force and self.consecutive_failures:
+            return
+        self._reason = reason
+        self._wake.set()
+
+    def refresh(self, source: str) -> bool:
+        return self._flight.do("identity", lambda: self._refresh(source))
+
+    def _refresh(self, source: str) -> bool:
+        try:
+            provider = self.provider
+            process_user = timed_tier(provider.process_tier, provider.process_user)
+            active = timed_tier(provider.console_tier, provider.active_console_user)
+            sessions = timed_tier(provider.sessions_tier, provider.sessions)
+        except Exception as e:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = f"{type(e).__name__}: {e}"
+            logger.exception("Identity refresh failed (%s)", source)
+            return False
+        self.cache.publish(process_user, active, source, sessions)
+        self.refreshes += 1
+        self.consecutive_failures = 0
+        return True
+
+    def _next_delay(self, ok: bool) -> float:
+        if ok:
+            return self.interval
+        return min(self.max_backoff, 2 ** (self.consecutive_failures - 1))
+
+    def _run(self):
+        source = "startup"
+        while not self._stop.is_set():
+            ok = self.refresh(source)
+            woke = self._wake.wait(self._next_delay(ok))
+            self._wake.clear()
+            source = self._reason if woke else "schedule"
+            self._reason = "schedule"
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "coalescing": self._flight.stats(),
+        }
+
+
+identity_cache = IdentityCache(CACHE_TTL)
+identity_refresher = IdentityRefresher(identity_cache, REFRESH_INTERVAL)
+event_hub = sse.EventHub(SSE_HEARTBEAT, SSE_MAX_CLIENTS)
+
+
+def identity_event(snap: dict) -> bytes:
+    """
+    event "identity" ของ /events: เนื้อหาเดียวกับ /whoami + etag
+    etag คือ ETag ของ /whoami?fields=username (request ที่ extension ส่ง If-None-Match ตามมา)
+    """
+    return sse.format_event("identity", {
+        "process_user": snap["process_user"],
+        "active_console_user": snap["active_console_user"],
+        "sessions": snap["sessions"],
+        "etag": representation_etag(USERNAME_ROUTE, {"username": display_username(snap)}),
+        "ts": iso_now(),
+    }, snap["version"])
+
+
+identity_cache.on_change(lambda snap: event_hub.broadcast(identity_event(snap)))
+
+
+# session change event ทุกแหล่ง (Windows SCM, worker stdin, event สังเคราะห์) เข้าทาง bus เดียว
+session_events = SessionEventBus()
+
+
+def on_session_event(event: SessionEvent):
+    """
+    session logon/logoff/lock/unlock/connect: snapshot เดิมใช้ไม่ได้แล้ว -> refresh ทันที
+    และแจ้ง stream ทุกตัว (identity ใหม่จะตามมาเป็น event "identity" ถ้าเปลี่ยนจริง)
+    """
+    SESSION_EVENTS.inc(event=event.kind)
+    reason = f"session {event.kind}" if event.session_id is None else f"session {event.kind} #{event.session_id}"
+    identity_cache.invalidate(reason)
+    identity_refresher.poke(reason)
+    event_hub.publish("session", {"event": event.kind, "session_id": event.session_id, "ts": iso_now()})
+
+
+session_events.subscribe(on_session_event)
+
+
+def session_changed(name: str, session_id: int | None = None):
+    """แจ้งว่า session เปลี่ยน (คืนทันที; cache/refresher/stream ได้รับจาก dispatcher ของ session_events)"""
+    session_events.publish(SessionEvent(name, session_id))
+
+
+
+def use_identity_provider(provider: IdentityProvider):
+    """เปลี่ยนที่มาของ identity (เรียกก่อน start_core) แล้วล้าง snapshot เดิม"""
+    identity_refresher.provider = provider
+    identity_cache.invalidate(f"provider {type(provider).__name__}")
+
+
+def current_identity() -> dict:
+    """
+    snapshot สำหรับ handler: ปกติคืนค่าจากหน่วยความจำทันที
+    จะโหลดเองเฉพาะตอนยังไม่มี snapshot เลย หรือไม่มี refresher ทำงานอยู่
+    """
+    snap = identity_cache.current()
+    if snap is not None and not identity_cache.is_stale(snap):
+        return snap
+    if identity_refresher.running:
+        if snap is not None:
+            identity_refresher.poke("stale", force=False)
+            return snap
+    identity_refresher.refresh("on-demand")
+    return identity_cache.peek() or {
+        "process_user": None,
+        "active_console_user": None,
+        "sessions": [],
+        "source": "unavailable",
+        "version": 0,
+        "etag": identity_etag(None, None),
+        "refreshed_at": time.monotonic(),
+        "refreshed_ts": None,
+    }
+
+
+def snapshot_info(snap: dict) -> dict:
+    """อายุและที่มาของ snapshot สำหรับแนบไปกับ response"""
+    return {
+        "source": snap["source"],
+        "age": int(time.monotonic() - snap["refreshed_at"]),  # ระดับวินาที ให้ body cache ได้
+        "stale": identity_cache.is_stale(snap) if snap["version"] else True,
+        "refreshed": snap["refreshed_ts"],
+    }
+
+
+HOSTNAME = socket.gethostname()
+
+
+class PreparedResponse:
+    """
+    response ที่ encode ไว้แล้ว: body เป็น bytes และ header block เป็น bytes
+    handler เขียนออกไปได้ทันทีโดยไม่ต้อง json.dumps / format header ซ้ำ
+    """
+
+    __slots__ = ("status", "body", "etag", "headers", "header_bytes", "not_modified", "meta", "_variants")
+
+    def __init__(self, status: int, body: bytes, headers: list[tuple[str, str]], etag: str | None = None):
+        self.status = status
+        self.body = body
+        self.etag = etag
+        self.headers = headers
+        self.header_bytes = "".join(f"{k}: {v}\r\n" for k, v in headers).encode("latin-1")
+        self.not_modified: PreparedResponse | None = None
+        self.meta: dict | None = None  # ข้อมูลประกอบ access log (resolver source, cache state)
+        self._variants: dict = {}
+
+    def variant(self, coding: str | None) -> "PreparedResponse":
+        """
+        response เดียวกันที่บีบด้วย coding ("gzip" / "deflate" / None = ไม่บีบ) พร้อม Vary: Accept-Encoding
+        บีบครั้งเดียวต่อ PreparedResponse; ตัวที่อยู่ใน ResponseCache จึงไม่บีบซ้ำทุก request
+        """
+        resp = self._variants.get(coding)
+        if resp is not None:
+            return resp
+        body = self.body
+        headers = [(k, v) for k, v in self.headers if k != "Content-Length"]
+        if coding == "gzip":
+            body = gzip.compress(body, 6, mtime=0)
+        elif coding == "deflate":
+            body = zlib.compress(body, 6)  # HTTP "deflate" = zlib stream
+        if coding:
+            headers.append(("Content-Encoding", coding))
+        headers += [("Content-Length", str(len(body))), ("Vary", "Accept-Encoding")]
+        resp = PreparedResponse(self.status, body, headers, self.etag)
+        resp.not_modified = self.not_modified
+        resp.meta = self.meta
+        self._variants[coding] = resp
+        return resp
+
+
+def cache_control(max_age: int) -> str:
+    """max_age > 0: client ใช้ค่าเดิมได้ max_age วินาทีโดยไม่ต้องถาม; 0: ถามทุกครั้ง (ใช้ If-None-Match)"""
+    return f"private, max-age={max_age}" if max_age > 0 else "no-cache"
+
+
+def json_response(obj: dict, status: int = 200, etag: str | None = None, max_age: int = 0,
+                  extra_headers: list[tuple[str, str]] = ()) -> PreparedResponse:
+    body = json.dumps(obj).encode("utf-8")
+    headers = [
+        ("Content-Type", "application/json; charset=utf-8"),
+        ("Content-Length", str(len(body))),
+        *extra_headers,
+    ]
+    if etag:
+        validators = [("ETag", etag), ("Cache-Control", cache_control(max_age))]
+        headers += validators
+    resp = PreparedResponse(status, body, headers, etag)
+    if etag:
+        # 304 ก็มี Cache-Control เพื่อให้ client ต่ออายุ cache ของตัวเองได้
+        resp.not_modified = PreparedResponse(304, b"", validators, etag)
+    return resp
+
+
+def text_response(text: str, content_type: str, status: int = 200) -> PreparedResponse:
+    body = text.encode("utf-8")
+    return PreparedResponse(status, body, [("Content-Type", content_type), ("Content-Length", str(len(body)))])
+
+
+def preferred_encoding(accept_encoding: str | None) -> str | None:
+    """เลือก gzip หรือ deflate จาก Accept-Encoding (เคารพ q=0); None = ส่งแบบไม่บีบ"""
+    if not accept_encoding:
+        return None
+    offered = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[coding.strip()] = q
+    star = offered.get("*", 0.0)
+    best = max(("gzip", "deflate"), key=lambda c: offered.get(c, star))
+    return best if offered.get(best, star) > 0 else None
+
+
+def negotiate_encoding(resp: PreparedResponse, headers) -> PreparedResponse:
+    """บีบเฉพาะ response 200 ที่ใหญ่พอ (/sessions, /healthz, /metrics); /whoami ปกติเล็กเกินจะคุ้ม"""
+    if resp.status != 200 or len(resp.body) < COMPRESS_MIN_BYTES:
+        return resp
+    return resp.variant(preferred_encoding(headers.get("Accept-Encoding")))
+
+
+def etag_matches(if_none_match: str | None, etag: str | None) -> bool:
+    """เทียบ If-None-Match แบบ weak comparison (รองรับหลายค่าและ *)"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+
+class ResponseCache:
+    """
+    เก็บ PreparedResponse ล่าสุดต่อ route
+    สร้างใหม่เฉพาะเมื่อ key เปลี่ยน (snapshot version / stale / วินาทีของ ts)
+    """
+
+    def __init__(self):
+        self._entries: dict[str, tuple[tuple, PreparedResponse]] = {}
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, route: str, key: tuple, build) -> PreparedResponse:
+        entry = self._entries.get(route)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1]
+        resp = build()
+        self._entries[route] = (key, resp)
+        self.builds += 1
+        return resp
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "builds": self.builds}
+
+
+response_cache = ResponseCache()
+NOT_FOUND = json_response({"error": "not found"}, 404)
+
+# header CORS ขึ้นกับ Origin ของแต่ละ request จึงต่อท้ายตอนเขียน response (ตัวที่ cache ไว้ใช้ร่วมกันได้ทุก origin)
+CORS = CorsPolicy(CORS_ORIGINS, max_age=CORS_MAX_AGE)
+PREFLIGHT = PreparedResponse(204, b"", [("Allow", "GET, HEAD, OPTIONS"), ("Content-Length", "0")])
+
+
+def cors_for(route, headers) -> bytes:
+    """header block ของ CORS สำหรับ route นี้; route ที่ cors=False (/sessions, /metrics, /events) ไม่ได้ header CORS เลย"""
+    if route is not None and not route.options.get("cors", True):
+        return b""
+    return CORS.actual(headers.get("Origin"))
+
+
+def method_not_allowed(target: str) -> PreparedResponse:
+    """method ที่ไม่มี handler: 405 + Allow ถ้ามี path นี้, 404 ถ้าไม่มี (ให้ทั้งสองโหมดตอบเหมือนกัน)"""
+    allowed = ROUTER.allowed(target)
+    if not allowed:
+        return NOT_FOUND
+    if "GET" in allowed:
+        allowed = [*allowed, "HEAD"]  # HEAD เสิร์ฟผ่าน route ของ GET
+    return json_response({"error": "method not allowed"}, 405,
+                         extra_headers=[("Allow", ", ".join([*allowed, "OPTIONS"]))])
+
+
+def preflight_response(target: str, headers) -> tuple[PreparedResponse, bytes]:
+    """
+    คำตอบ OPTIONS: (response, header block ของ CORS)
+    origin ที่ไม่อยู่ใน allowlist หรือ route ที่ cors=False ได้ 204 ที่ไม่มี Access-Control-Allow-Origin
+    (browser จะไม่ส่ง request จริง)
+    """
+    route, _ = ROUTER.match("GET", target)
+    if route is None:
+        return NOT_FOUND, CORS.actual(headers.get("Origin"))
+    if not route.options.get("cors", True):
+        return PREFLIGHT, b""
+    private_network = (headers.get("Access-Control-Request-Private-Network") or "").lower() == "true"
+    return PREFLIGHT, CORS.preflight(headers.get("Origin"), private_network) or b""
+
+
+def listen_address() -> dict:
+    host, port = http_server.server_address[:2] if http_server else (HOST, PORT)
+    return {"host": host, "port": port}
+
+
+def whoami_payload(snap: dict) -> dict:
+    return {
+        "process_user": snap["process_user"],
+        "active_console_user": snap["active_console_user"],
+        "host": HOSTNAME,
+        "listen": listen_address(),
+        "snapshot": snapshot_info(snap),
+        "ts": iso_now(),
+    }
+
+
+def active_user_payload(snap: dict) -> dict:
+    return {
+        "active_console_user": snap["active_console_user"],
+        "host": HOSTNAME,
+        "snapshot": snapshot_info(snap),
+        "ts": iso_now(),
+    }
+
+
+# field ที่เลือกได้ด้วย ?fields=... ต่อ route (= key ของ payload นั้น + "username")
+# "username" = ผู้ใช้หน้าเครื่อง ถ้าไม่มีใช้ process user (แบบเดียวกับ background.js)
+ROUTE_FIELDS = {
+    "/whoami": frozenset({"username", "process_user", "active_console_user", "host", "listen", "snapshot", "ts"}),
+    "/active-user": frozenset({"username", "active_console_user", "host", "snapshot", "ts"}),
+    "/sessions": frozenset({"username", "process_user", "active_console_user", "sessions", "host", "snapshot", "ts"}),
+}
+
+
+def parse_fields(query: dict) -> tuple[str, ...] | None:
+    """?fields=username,host -> ("host", "username"); ไม่มี ?fields= หรือว่าง (?fields=) -> None (payload เต็ม)"""
+    values = query.get("fields")
+    if not values:
+        return None
+    names = {name.strip() for value in values for name in value.split(",")} - {""}
+    return tuple(sorted(names)) or None
+
+
+def unknown_fields_response(route: str, fields: tuple[str, ...]) -> PreparedResponse | None:
+    """400 ถ้าขอ field ที่ route นี้ไม่มี (แทนการเงียบแล้วคืน payload เต็ม); None = ใช้ได้ทุกตัว"""
+    unknown = sorted(set(fields) - ROUTE_FIELDS[route])
+    if not unknown:
+        return None
+    return json_response({"error": "unknown fields", "fields": unknown, "allowed": sorted(ROUTE_FIELDS[route])}, 400)
+
+
+def display_username(snap: dict) -> str | None:
+    for key in ("active_console_user", "process_user"):
+        user = snap[key]
+        if user and user.get("username"):
+            return user["username"]
+    return None
+
+
+def select_fields(build_payload, fields: tuple[str, ...]):
+    """ห่อ build_payload ให้คืนเฉพาะ field ที่ขอ (ไม่มี ts ถ้าไม่ได้ขอ -> body เดิมจน identity เปลี่ยน)"""
+    def build(snap: dict) -> dict:
+        payload = build_payload(snap) if set(fields) - {"username"} else {}
+        selected = {name: payload[name] for name in fields if name in payload}
+        if "username" in fields:
+            selected["username"] = display_username(snap)
+        return selected
+    return build
+
+
+def sessions_payload(snap: dict) -> dict:
+    """ทุกอย่างใน request เดียว: process user, ผู้ใช้หน้าเครื่อง และผู้ใช้ของทุก session"""
+    return {
+        "process_user": snap["process_user"],
+        "active_console_user": snap["active_console_user"],
+        "sessions": snap["sessions"],
+        "host": HOSTNAME,
+        "snapshot": snapshot_info(snap),
+        "ts": iso_now(),
+    }
+
+
+# ---------- route ของ webservice-old (/username, /status) สำหรับ extension รุ่นเก่า ----------
+# เสิร์ฟจาก snapshot เดียวกับ /whoami: process เดียว port เดียว ไม่ resolve ซ้ำต่อ request
+# (CORS มาจาก CORS policy ตอนเขียน response เหมือน route อื่น แทน Access-Control-Allow-Origin: * แบบเดิม)
+
+
+def legacy_resolution(snap: dict) -> resolvers.Resolution:
+    """กติกาเดิมของ /username: ผู้ใช้หน้าเครื่องก่อน แล้วค่อย process user (ตัด DOMAIN\\ และบัญชีระบบทิ้ง)"""
+    provider = identity_refresher.provider
+    for user, tier in ((snap["active_console_user"], provider.console_tier),
+                       (snap["process_user"], provider.process_tier)):
+        username = resolvers.normalize_username(user.get("username") if user else None)
+        if username:
+            return resolvers.Resolution(username, tier)
+    return resolvers.Resolution("unknown", "default")
+
+
+def legacy_username_response() -> PreparedResponse:
+    snap = current_identity()
+
+    def build() -> PreparedResponse:
+        resolution = legacy_resolution(snap)
+        resp = json_response({"ok": True, "username": resolution.username, "method": "AD",
+                              "source": resolution.source})
+        resp.meta = {"source": snap["source"], "cache": "stale" if identity_cache.is_stale(snap) else "fresh"}
+        return resp
+
+    return response_cache.get("/username", (snap["version"],), build)
+
+
+def legacy_status_response() -> PreparedResponse:
+    address = listen_address()
+    return json_response({
+        "service": "AD Username HTTP Server",
+        "status": "running",
+        "endpoint": f"http://{address['host']}:{address['port']}/username",
+        "snapshot": snapshot_info(current_identity()),
+        "refresher": identity_refresher.stats(),
+    })
+
+
+def identity_response(route: str, build_payload) -> PreparedResponse:
+    """response ของ endpoint ที่อิง identity snapshot (cache ไว้จนกว่า snapshot/วินาทีจะเปลี่ยน)"""
+    snap = current_identity()
+    now = time.monotonic()
+    stale = identity_cache.is_stale(snap)
+    key = (snap["version"], stale, int(now - snap["refreshed_at"]), int(time.time()))
+
+    def build() -> PreparedResponse:
+        # snapshot ที่ stale ไม่ให้ client cache ต่อ (refresher กำลังโหลดค่าใหม่)
+        payload = build_payload(snap)
+        resp = json_response(payload, 200, representation_etag(route, payload), 0 if stale else CLIENT_MAX_AGE)
+        resp.meta = resp.not_modified.meta = {"source": snap["source"], "cache": "stale" if stale else "fresh"}
+        return resp
+
+    return response_cache.get(route, key, build)
+
+
+def fields_route(route: str, fields: tuple[str, ...]) -> str:
+    """key ของ representation ที่เลือก field (cache + ETag แยกจาก payload เต็ม)"""
+    return f"{route}?fields={','.join(fields)}"
+
+
+USERNAME_ROUTE = fields_route("/whoami", ("username",))
+
+
+def identity_or_304(route: str, build_payload, headers, fields: tuple[str, ...] | None = None) -> PreparedResponse:
+    """
+    response ของ route identity พร้อม 304 ตาม If-None-Match
+    fields (?fields=): body เฉพาะ field ที่ขอ มี cache และ ETag ของตัวเอง; field ที่ route ไม่มี -> 400
+    """
+    if fields:
+        error = unknown_fields_response(route, fields)
+        if error is not None:
+            return error
+        route, build_payload = fields_route(route, fields), select_fields(build_payload, fields)
+    resp = identity_response(route, build_payload)
+    if resp.not_modified and etag_matches(headers.get("If-None-Match"), resp.etag):
+        return resp.not_modified
+    return resp
+
+
+def compress(route, handler):
+    """middleware: gzip/deflate ตาม Accept-Encoding สำหรับ route ที่ body อาจใหญ่"""
+    def compressed(headers, query):
+        return negotiate_encoding(handler(headers, query), headers)
+    return compressed
+
+
+# ตาราง route ที่ใช้ร่วมกันทั้งโหมด threading และ asyncio
+# handler รับ (headers, query) แล้วคืน PreparedResponse; headers คือ http.client.HTTPMessage (get แบบไม่สนตัวพิมพ์)
+ROUTER = Router()
+
+
+@ROUTER.route("GET", "/", "/whoami", label="/whoami", query=True, middleware=[compress])
+def get_whoami(headers, query):
+    return identity_or_304("/whoami", whoami_payload, headers, parse_fields(query))
+
+
+@ROUTER.route("GET", "/active-user", query=True, middleware=[compress])
+def get_active_user(headers, query):
+    return identity_or_304("/active-user", active_user_payload, headers, parse_fields(query))
+
+
+# ข้อมูลทุก session บนเครื่อง: ไม่เปิดให้หน้าเว็บอ่านผ่าน CORS (เหมือน /metrics; curl / Prometheus ไม่ใช้ CORS อยู่แล้ว)
+@ROUTER.route("GET", "/sessions", query=True, cors=False, middleware=[compress])
+def get_sessions(headers, query):
+    return identity_or_304("/sessions", sessions_payload, headers, parse_fields(query))
+
+
+@ROUTER.route("GET", "/username")
+def get_username(headers, query):
+    return legacy_username_response()
+
+
+@ROUTER.route("GET", "/status", middleware=[compress])
+def get_status(headers, query):
+    return legacy_status_response()
+
+
+@ROUTER.route("GET", "/healthz", middleware=[compress])
+def get_healthz(headers, query):
+    return json_response({
+        "status": "ok",
+        "cache": identity_cache.stats(),
+        "refresher": identity_refresher.stats(),
+        "responses": response_cache.stats(),
+        "events": event_hub.stats(),
+        "session_events": session_events.stats(),
+        "server": http_server.stats() if http_server else None,
+        "ts": iso_now(),
+    }, 200)
+
+
+@ROUTER.route("GET", "/metrics", cors=False, middleware=[compress])
+def get_metrics(headers, query):
+    return text_response(metrics.REGISTRY.render(), metrics.CONTENT_TYPE)
+
+
+# stream: server แต่ละโหมดจัดการเอง (ยก connection ให้ event_hub) จึงไม่มี handler ปกติ
+# event identity มีรายชื่อทุก session (เหมือน /sessions) จึงไม่เปิด CORS; service worker ของ extension ใช้ host_permissions
+ROUTER.add("GET", "/events", None, stream=True, cors=False)
+
+
+def observe_request(path: str, status: int, elapsed: float, method: str = "GET"):
+    """นับ request และเวลาแยกตาม route (path แปลก ๆ รวมเป็น "other" เพื่อไม่ให้ label บาน; OPTIONS รวมเป็น "preflight")"""
+    route = "preflight" if method == "OPTIONS" else ROUTER.label(path)
+    HTTP_REQUESTS.inc(route=route, status=str(status))
+    HTTP_SECONDS.observe(elapsed, route=route)
+
+
+def log_access(client: str, method: str, path: str, version: str, resp: PreparedResponse, elapsed: float):
+    """
+    access log หนึ่งบรรทัดต่อ request (WHOAMI_ACCESS_LOG)
+    - text: บรรทัดแบบเดิมลง service.log
+    - json: JSON lines ลง access.log (route, status, ms, source, cache)
+    - สุ่มเก็บเฉพาะ 2xx/3xx ตาม WHOAMI_ACCESS_LOG_SAMPLE; 4xx/5xx ลงทุกครั้ง
+    """
+    if ACCESS_LOG == "off":
+        return
+    if resp.status < 400 and ACCESS_LOG_SAMPLE < 1 and random.random() >= ACCESS_LOG_SAMPLE:
+        return
+    if ACCESS_LOG != "json":
+        logger.info('HTTP %s - "%s %s %s" %d %s', client, method, path, version, resp.status, len(resp.body) or "-")
+        return
+    entry = {
+        "ts": round(time.time(), 3),
+        "client": client,
+        "method": method,
+        "route": ROUTER.label(path),
+        "status": resp.status,
+        "ms": round(elapsed * 1000, 3),
+        "bytes": len(resp.body),
+    }
+    if resp.meta:
+        entry.update(resp.meta)
+    if resp.status < 400 and ACCESS_LOG_SAMPLE < 1:
+        entry["sample"] = ACCESS_LOG_SAMPLE  # ใช้ถ่วงน้ำหนักกลับตอนวิเคราะห์
+    access_logger.info(json.dumps(entry, separators=(",", ":")))
+
+
+def register_service_metrics():
+    """ค่าที่มีตัวนับอยู่แล้ว (cache/refresher/server) อ่านตอน scrape ผ่าน callback"""
+    reg = metrics.REGISTRY
+    reg.callback("whoami_identity_cache_hits_total", "Snapshot reads served from memory",
+                 lambda: identity_cache.hits, kind="counter")
+    reg.callback("whoami_identity_cache_stale_hits_total", "Snapshot reads served while stale",
+                 lambda: identity_cache.stale_hits, kind="counter")
+    reg.callback("whoami_identity_cache_misses_total", "Reads with no snapshot (synchronous load)",
+                 lambda: identity_cache.misses, kind="counter")
+    reg.callback("whoami_identity_cache_hit_ratio", "hits / (hits + misses)",
+                 lambda: identity_cache.stats()["hit_ratio"])
+    reg.callback("whoami_identity_snapshot_age_seconds", "Age of the current identity snapshot",
+                 lambda: identity_cache.stats()["age"])
+    reg.callback("whoami_identity_refresh_failures_total", "Failed identity refreshes",
+                 lambda: identity_refresher.failures, kind="counter")
+    reg.callback("whoami_identity_coalesced_total", "Lookups that shared an in-flight refresh",
+                 lambda: identity_refresher.stats()["coalescing"]["shared"], kind="counter")
+    reg.callback("whoami_response_cache_hits_total", "Responses served pre-encoded",
+                 lambda: response_cache.hits, kind="counter")
+    reg.callback("whoami_server_queue_depth", "Connections/jobs waiting for a worker",
+                 lambda: http_server.stats()["queue_depth"] if http_server else None)
+    reg.callback("whoami_log_dropped_total", "Log records dropped because the log queue was full",
+                 lambda: (log_handler.dropped if log_handler else 0) + (access_handler.dropped if access_handler else 0),
+                 kind="counter")
+    reg.callback("whoami_log_queue_depth", "Log records waiting for the writer",
+                 lambda: log_handler.stats()["queued"] if log_handler else None)
+    reg.callback("whoami_sse_clients", "Open /events streams",
+                 lambda: event_hub.stats()["clients"])
+    reg.callback("whoami_sse_events_total", "Events pushed to /events streams",
+                 lambda: event_hub.events, kind="counter")
+    reg.callback("whoami_server_rejected_total", "Connections rejected with 503",
+                 lambda: http_server.stats()["rejected"] if http_server else None, kind="counter")
+
+
+CONNECTION_CLOSE = b"Connection: close\r\n"
+
+
+def keep_alive_header(remaining: int) -> bytes:
+    return f"Keep-Alive: timeout={int(KEEPALIVE_TIMEOUT)}, max={remaining}\r\n".encode("latin-1")
+
+
+SERVICE_UNAVAILABLE = json_response({"error": "server busy"}, 503)
+
+
+def overloaded_response_bytes() -> bytes:
+    """503 ทั้งก้อน (status line + header + body) สำหรับเขียนตรงลง socket ตอนคิวเต็ม"""
+    resp = SERVICE_UNAVAILABLE
+    return (
+        b"HTTP/1.1 503 Service Unavailable\r\n"
+        + resp.header_bytes
+        + f"Retry-After: {RETRY_AFTER}\r\n".encode("latin-1")
+        + CONNECTION_CLOSE
+        + b"\r\n"
+        + resp.body
+    )
+
+
+OVERLOADED = overloaded_response_bytes()
+
+# หัวของ /events: ไม่มี Content-Length, body คือ stream จนกว่าฝั่งใดฝั่งหนึ่งจะปิด (จึงต้อง Connection: close)
+EVENTS_RESPONSE = PreparedResponse(200, b"", [
+    ("Content-Type", "text/event-stream; charset=utf-8"),
+    ("Cache-Control", "no-cache"),
+])
+
+# server ที่กำลังรันอยู่ (ให้ /healthz รายงานคิวได้)
+http_server = None
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTP server ที่มี worker thread จำนวนคงที่ + คิวรับ connection ขนาดจำกัด
+    - ไม่สร้าง thread ต่อ connection -> memory/CPU คาดเดาได้แม้โดนยิงรัว ๆ
+    - คิวเต็มเมื่อไหร่ตอบ 503 + Retry-After จาก thread ที่ accept ทันทีแล้วปิด
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers: int = WORKERS, queue_size: int = QUEUE_SIZE,
+                 sock: socket.socket | None = None):
+        # สร้างคิวก่อน bind: ถ้า bind พลาด HTTPServer จะเรียก server_close() ซึ่งใช้คิวนี้
+        self.pending: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.request_queue_size = max(queue_size, LISTEN_BACKLOG)  # server_activate() ใช้เป็น backlog ของ listen()
+        if sock is None:
+            super().__init__(server_address, handler_class)
+        else:
+            # listening socket ที่ได้มาจาก process อื่น (bind/listen แล้ว) ใช้แทน socket ของตัวเอง
+            super().__init__(server_address, handler_class, bind_and_activate=False)
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()[:2]
+            self.server_name, self.server_port = self.server_address
+        self.workers = workers
+        self.draining = False
+        self._detached: set = set()
+        self.busy = 0
+        self.rejected = 0
+        self._busy_lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"whoami-http-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            self.rejected += 1
+            HTTP_REQUESTS.inc(route="rejected", status="503")
+            try:
+                request.sendall(OVERLOADED)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """
+        หยุด accept แล้วรอ connection ที่รับไว้แล้วให้เสร็จ (response ระหว่างนี้ได้ Connection: close)
+        ใช้ตอน graceful restart: listening socket ยังเปิดอยู่ใน worker ตัวใหม่ จึงไม่มี connection ถูกปฏิเสธ
+        """
+        self.draining = True
+        self.shutdown()
+        deadline = time.monotonic() + timeout
+        while (self.busy or not self.pending.empty()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.server_close()
+
+    def detach(self, request):
+        """ยก connection ให้คนอื่นดูแลต่อ (stream ของ /events) worker จะไม่ปิด socket นี้"""
+        self._detached.add(request)
+
+    def shutdown_request(self, request):
+        if request in self._detached:
+            self._detached.discard(request)
+            return
+        super().shutdown_request(request)
+
+    def under_pressure(self) -> bool:
+        """มี connection รอ worker อยู่ -> handler ควรเลิก keep-alive เพื่อคืน worker"""
+        return not self.pending.empty()
+
+    def _worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            with self._busy_lock:
+                self.busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._busy_lock:
+                    self.busy -= 1
+
+    def server_close(self):
+        super().server_close()
+        # ล้างคิวแล้วส่งสัญญาณหยุดให้ worker ทุกตัว
+        while True:
+            try:
+                request, _addr = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                self.shutdown_request(request)
+        for _ in self._threads:
+            self.pending.put(None)
+
+    def stats(self) -> dict:
+        return {
+            "mode": "threading",
+            "workers": self.workers,
+            "busy": self.busy,
+            "queue_depth": self.pending.qsize(),
+            "queue_size": self.pending.maxsize,
+            "rejected": self.rejected,
+        }
+
+
+class WhoamiHTTPRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 + keep-alive: background.js ใช้ TCP connection เดิมได้หลาย request
+    connection ที่ idle เกิน KEEPALIVE_TIMEOUT หรือครบ KEEPALIVE_MAX request จะถูกปิด (thread คืนตัว)
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    def setup(self):
+        super().setup()
+        self.requests_handled = 0
+
+    def log_message(self, fmt, *args):
+        logger.info("HTTP %s - " + fmt, self.address_string(), *args)
+
+    def log_request(self, code="-", size="-"):
+        # access log เขียนจาก do_GET ผ่าน log_access (มี duration / sampling)
+        pass
+
+    def log_error(self, fmt, *args):
+        # connection keep-alive ที่ idle จนหมดเวลาเป็นเรื่องปกติ ไม่ต้องลง log
+        if fmt.startswith("Request timed out"):
+            return
+        self.log_message(fmt, *args)
+
+    def _send_json(self, obj: dict, status: int = 200):
+        self._send_prepared(json_response(obj, status))
+
+    def _send_prepared(self, resp: PreparedResponse, cors: bytes = b""):
+        self.requests_handled += 1
+        if self.requests_handled >= KEEPALIVE_MAX or self.server.draining or self.server.under_pressure():
+            self.close_connection = True
+        self.send_response(resp.status)
+        # header block encode ไว้แล้ว ต่อท้าย buffer ของ BaseHTTPRequestHandler ได้เลย
+        self._headers_buffer.append(resp.header_bytes)
+        if cors:
+            self._headers_buffer.append(cors)
+        if self.close_connection:
+            self._headers_buffer.append(CONNECTION_CLOSE)
+        else:
+            self._headers_buffer.append(keep_alive_header(KEEPALIVE_MAX - self.requests_handled))
+        # header + body ออกไปใน write เดียว: ถ้าแยกสอง write บน keep-alive connection
+        # Nagle + delayed ACK ของ client จะหน่วง response ละ ~40ms
+        self._headers_buffer.append(b"\r\n")
+        # HEAD: header เหมือน GET ทุกตัว (รวม Content-Length) แต่ไม่มี body ไม่งั้น framing ของ keep-alive พัง
+        if resp.body and self.command != "HEAD":
+            self._headers_buffer.append(resp.body)
+        self.flush_headers()
+
+    def _stream_events(self, cors: bytes) -> PreparedResponse:
+        """ส่งหัว text/event-stream แล้วยก socket ให้ event_hub; worker thread กลับไปรับงานอื่นได้ทันที"""
+        if event_hub.full() or self.server.draining:
+            self._send_prepared(SERVICE_UNAVAILABLE, cors)
+            return SERVICE_UNAVAILABLE
+        self.close_connection = True
+        self.send_response(200)
+        self._headers_buffer += [EVENTS_RESPONSE.header_bytes, cors, CONNECTION_CLOSE, b"\r\n"]
+        self.flush_headers()
+        if event_hub.subscribe(sse.SocketSubscriber(self.connection), identity_event(current_identity())):
+            self.server.detach(self.request)
+        return EVENTS_RESPONSE
+
+    def do_GET(self):
+        """GET และ HEAD (HEAD ใช้ route เดียวกัน; _send_prepared ตัด body ทิ้ง)"""
+        started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+        try:
+            route, query = ROUTER.match("GET", self.path)
+            cors = cors_for(route, self.headers)
+            if route is None:
+                resp = NOT_FOUND
+                self._send_prepared(resp, cors)
+            elif route.options.get("stream") and self.command == "HEAD":
+                resp = EVENTS_RESPONSE
+                self._send_prepared(resp, cors)
+            elif route.options.get("stream"):
+                resp = self._stream_events(cors)
+            else:
+                resp = route.call(self.headers, query)
+                self._send_prepared(resp, cors)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+        elapsed = time.perf_counter() - started
+        observe_request(self.path, resp.status, elapsed, self.command)
+        log_access(self.address_string(), self.command, self.path, self.request_version, resp, elapsed)
+
+    do_HEAD = do_GET
+
+    def do_OPTIONS(self):
+        started = time.perf_counter()
+        resp, cors = preflight_response(self.path, self.headers)
+        self._send_prepared(resp, cors)
+        elapsed = time.perf_counter() - started
+        observe_request(self.path, resp.status, elapsed, "OPTIONS")
+        log_access(self.address_string(), self.command, self.path, self.request_version, resp, elapsed)
+
+    def _method_not_allowed(self):
+        started = time.perf_counter()
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)  # อ่าน body ทิ้งให้ keep-alive framing ถูก
+        resp = method_not_allowed(self.path)
+        self._send_prepared(resp, cors_for(ROUTER.match("GET", self.path)[0], self.headers))
+        elapsed = time.perf_counter() - started
+        observe_request(self.path, resp.status, elapsed, self.command)
+        log_access(self.address_string(), self.command, self.path, self.request_version, resp, elapsed)
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = _method_not_allowed
+
+
+class AsyncWhoamiServer:
+    """
+    HTTP front end แบบ asyncio (WHOAMI_SERVER_MODE=asyncio)
+    - event loop เดียวรับทุก connection แทนการสร้าง OS thread ต่อ connection
+    - งานที่อาจบล็อก (โหลด identity) ถูกส่งไป ThreadPoolExecutor ขนาดจำกัด
+    - interface เหมือน PooledHTTPServer: serve_forever / shutdown / server_close / stats
+    - connection เกิน max_connections ได้ 503 + Retry-After ทันที
+    """
+
+    server_version = "WhoamiAsync/1.0"
+    max_header_bytes = 64 * 1024
+    read_timeout = 10.0
+
+    def __init__(self, server_address: tuple[str, int], workers: int = ASYNC_WORKERS,
+                 max_connections: int = WORKERS + QUEUE_SIZE, sock: socket.socket | None = None):
+        self.server_address = server_address
+        self.workers = workers
+        self.max_connections = max_connections
+        self.connections = 0
+        self.pending = 0  # งานที่ส่งเข้า executor แล้วยังไม่เสร็จ
+        self.rejected = 0
+        self.draining = False
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="whoami-async")
+        self.loop = asyncio.new_event_loop()
+        self._server: asyncio.AbstractServer | None = None
+        self._stopped = threading.Event()
+        # bind ตั้งแต่ constructor เหมือน HTTPServer เพื่อให้ error เรื่อง port โผล่ทันที
+        if sock is None:
+            start = asyncio.start_server(self._handle_connection, *server_address, reuse_address=True,
+                                         backlog=LISTEN_BACKLOG)
+        else:
+            start = asyncio.start_server(self._handle_connection, sock=sock)
+        self._server = self.loop.run_until_complete(start)
+        # port 0 = ให้ OS เลือก; เก็บ address จริงไว้เหมือน HTTPServer.server_address
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self._stopped.set()
+
+    def shutdown(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._stopped.wait(5)
+
+    def drain(self, timeout: float = DRAIN_TIMEOUT):
+        """หยุด accept แล้วรอ connection ที่เปิดอยู่ตอบ request ปัจจุบันจนเสร็จ (ดู PooledHTTPServer.drain)"""
+        self.draining = True
+
+        async def wait_idle():
+            self._server.close()
+            deadline = time.monotonic() + timeout
+            while self.connections and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(wait_idle(), self.loop).result(timeout + 1)
+        self.shutdown()
+        self.server_close()
+
+    def server_close(self):
+        if self._server is not None:
+            self._server.close()
+            if not self.loop.is_closed():
+                self.loop.run_until_complete(self._server.wait_closed())
+                self.loop.close()
+            self._server = None
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            "mode": "asyncio",
+            "workers": self.workers,
+            "connections": self.connections,
+            "max_connections": self.max_connections,
+            "queue_depth": self.pending,
+            "rejected": self.rejected,
+        }
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.connections >= self.max_connections:
+            self.rejected += 1
+            HTTP_REQUESTS.inc(route="rejected", status="503")
+            writer.write(OVERLOADED)
+            try:
+                await writer.drain()
+            finally:
+                writer.close()
+            return
+        self.connections += 1
+        peer = writer.get_extra_info("peername")
+        client = peer[0] if peer else "-"
+        try:
+            for served in range(1, KEEPALIVE_MAX + 1):
+                # request แรกรอได้ read_timeout; ระหว่าง request บน keep-alive รอได้แค่ KEEPALIVE_TIMEOUT
+                wait = self.read_timeout if served == 1 else KEEPALIVE_TIMEOUT
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), wait)
+                if len(head) > self.max_header_bytes:
+                    raise ValueError("header too large")
+                request_line, _, raw_headers = head.partition(b"\r\n")
+                method, target, version = request_line.decode("latin-1").split()
+                headers = parse_headers(io.BytesIO(raw_headers))
+                length = int(headers.get("Content-Length") or 0)
+                if length:
+                    await reader.readexactly(length)  # GET ไม่ใช้ body แต่ต้องอ่านทิ้งให้ framing ถูก
+
+                started = time.perf_counter()
+                HTTP_IN_FLIGHT.inc()
+                try:
+                    head = method == "HEAD"  # ใช้ route ของ GET แต่ไม่ส่ง body
+                    route, query = ROUTER.match("GET" if head else method, target)
+                    cors = cors_for(route if method in ("GET", "HEAD") else ROUTER.match("GET", target)[0], headers)
+                    if method == "OPTIONS":
+                        resp, cors = preflight_response(target, headers)
+                    elif method not in ("GET", "HEAD"):
+                        resp = method_not_allowed(target)
+                    elif route is None:
+                        resp = NOT_FOUND
+                    elif route.options.get("stream"):
+                        resp = EVENTS_RESPONSE if head else None
+                    else:
+                        self.pending += 1
+                        try:
+                            resp = await self.loop.run_in_executor(self.executor, route.call, headers, query)
+                        finally:
+                            self.pending -= 1
+                finally:
+                    HTTP_IN_FLIGHT.dec()
+
+                if resp is None:
+                    await self._stream_events(reader, writer, client, version, started, cors)
+                    break
+
+                keep_alive = (
+                    self._wants_keep_alive(version, headers)
+                    and served < KEEPALIVE_MAX
+                    and self.connections < self.max_connections
+                    and not self.draining
+                )
+                writer.write(self._render(resp, keep_alive, KEEPALIVE_MAX - served, cors, head))
+                await writer.drain()
+                elapsed = time.perf_counter() - started
+                observe_request(target, resp.status, elapsed, method)
+                log_access(client, method, target, version, resp, elapsed)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except (ValueError, asyncio.LimitOverrunError):
+            writer.write(self._render(json_response({"error": "bad request"}, 400), False, 0))
+        except Exception:
+            logger.exception("Async HTTP handler error")
+        finally:
+            self.connections -= 1
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    async def _stream_events(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                             client: str, version: str, started: float, cors: bytes):
+        """/events: ลงทะเบียน writer กับ event_hub แล้วรอจน client ปิด (หรือ hub ตัดตอน stop)"""
+        subscriber = None
+        if event_hub.full() or self.draining:
+            resp = SERVICE_UNAVAILABLE
+            writer.write(self._render(resp, False, 0, cors))
+        else:
+            resp = EVENTS_RESPONSE
+            snap = await self.loop.run_in_executor(self.executor, current_identity)
+            writer.write(self._render(resp, False, 0, cors))
+            subscriber = sse.StreamSubscriber(self.loop, writer)
+            if not event_hub.subscribe(subscriber, identity_event(snap)):
+                subscriber = None
+        elapsed = time.perf_counter() - started
+        observe_request("/events", resp.status, elapsed)
+        log_access(client, "GET", "/events", version, resp, elapsed)
+        if subscriber is None:
+            await writer.drain()
+            return
+        # stream จำกัดจำนวนด้วย SSE_MAX_CLIENTS แยกต่างหาก ไม่กินโควตา max_connections ของ request ปกติ
+        self.connections -= 1
+        try:
+            # client ไม่ส่งอะไรมาอีก: read() คืน b"" เมื่อ client ปิดหรือ hub ปิด writer
+            while await reader.read(4096):
+                pass
+        finally:
+            self.connections += 1
+            event_hub.unsubscribe(subscriber)
+
+    @staticmethod
+    def _wants_keep_alive(version: str, headers) -> bool:
+        conn = (headers.get("Connection") or "").lower()
+        if version == "HTTP/1.1":
+            return "close" not in conn
+        return "keep-alive" in conn
+
+    def _render(self, resp: PreparedResponse, keep_alive: bool, remaining: int, cors: bytes = b"",
+                head: bool = False) -> bytes:
+        """status line + header + body ใน bytes เดียว; head=True (HEAD) ไม่มี body แต่ header เหมือนเดิม"""
+        reason = HTTPStatus(resp.status).phrase
+        status = (
+            f"HTTP/1.1 {resp.status} {reason}\r\n"
+            f"Server: {self.server_version}\r\n"
+            f"Date: {formatdate(usegmt=True)}\r\n"
+        ).encode("latin-1")
+        conn = keep_alive_header(remaining) if keep_alive else CONNECTION_CLOSE
+        return status + resp.header_bytes + cors + conn + b"\r\n" + (b"" if head else resp.body)
+
+
+def make_server(address: tuple[str, int] | None = None, mode: str | None = None,
+                sock: socket.socket | None = None):
+    """สร้าง HTTP server ตาม WHOAMI_SERVER_MODE (หรือ mode ที่ส่งมา); sock = listening socket ที่ bind ไว้แล้ว"""
+    global http_server
+    address = address or (HOST, PORT)
+    if (mode or SERVER_MODE) == "asyncio":
+        http_server = AsyncWhoamiServer(address, sock=sock)
+    else:
+        http_server = PooledHTTPServer(address, WhoamiHTTPRequestHandler, sock=sock)
+    return http_server
+
+
+def start_core(provider: IdentityProvider | None = None, address: tuple[str, int] | None = None,
+               mode: str | None = None, sock: socket.socket | None = None):
+    """
+    เริ่ม refresher + HTTP server (serve ใน thread แยก) คืน (server, thread)
+    ใช้ทั้งจาก Windows service adapter และ foreground runner
+    """
+    if provider is not None:
+        use_identity_provider(provider)
+    register_service_metrics()
+    # เริ่ม refresher ก่อนเปิด port เพื่อให้มี snapshot พร้อมตั้งแต่ request แรก
+    identity_refresher.start()
+    server = make_server(address, mode, sock)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.5}, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    logger.info("HTTP server running on http://%s:%d (mode=%s)", host, port, mode or SERVER_MODE)
+    if CORS.rejected:
+        logger.warning("WHOAMI_CORS_ORIGINS: ignoring wildcard origins %s (extension origins must be exact IDs)",
+                       ", ".join(CORS.rejected))
+    return server, thread
+
+
+def stop_core(server, drain: bool = False):
+    """
+    หยุด refresher และ server ตามลำดับ (error ระหว่างปิดแค่ลง log)
+    drain=True: ตอบ request ที่รับไว้แล้วให้จบก่อน (graceful restart)
+    """
+    identity_refresher.stop()
+    event_hub.close()
+    if drain and server:
+        try:
+            server.drain()
+            return
+        except Exception:
+            logger.exception("HTTP drain error")
+    try:
+        if server:
+            server.shutdown()
+    except Exception:
+        logger.exception("HTTP shutdown error")
+    try:
+        if server:
+            server.server_close()
+    except Exception:
+        logger.exception("HTTP server_close error")
+
+
+def run_foreground(argv=None):
+    """รัน service ใน console (OS ไหนก็ได้) จนกด Ctrl+C; log ออก stderr"""
+    parser = argparse.ArgumentParser(description="Run the whoami HTTP service in the foreground")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--mode", choices=["threading", "asyncio"], default=SERVER_MODE)
+    parser.add_argument("--fake-user", help="ใช้ FakeIdentityProvider ด้วย process user นี้ แทนการรัน whoami")
+    parser.add_argument("--fake-console-user", help="active console user ของ FakeIdentityProvider")
+    parser.add_argument("--fake-domain", default="LOCAL")
+    parser.add_argument("--fake-delay", type=float, default=0.0, help="วินาทีที่ provider ปลอมใช้ต่อการโหลด")
+    parser.add_argument("--fake-remote-user", action="append", help="ผู้ใช้ RDP ปลอม (ใส่ซ้ำได้) สำหรับ /sessions")
+    args = parser.parse_args(argv)
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.handlers.clear()
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    provider = None
+    if args.fake_user or args.fake_console_user or args.fake_remote_user:
+        provider = FakeIdentityProvider(args.fake_user or "svc-whoami", args.fake_console_user,
+                                        args.fake_domain, args.fake_delay, args.fake_remote_user)
+    server, thread = start_core(provider, (args.host, args.port), args.mode)
+    try:
+        while thread.is_alive():
+            thread.join(1.0)
+    except KeyboardInterrupt:
+        logger.info("Ctrl+C, stopping...")
+    finally:
+        stop_core(server)
+
+
+if __name__ == "__main__":
+    run_foreground()
@@ -0,0 +1,111 @@
+# cors.py
+"""
+CORS สำหรับ browser ที่เรียก service บน 127.0.0.1 (extension, หน้า Jira)
+- origin ต้องอยู่ใน allowlist: ตรงตัว ("chrome-extension://<id>"), wildcard sub-domain ("https://*.atlassian.net")
+  หรือ "*" = ทุก origin
+- ค่าเริ่มต้นมีแค่ Jira Cloud: extension ของเราไม่ต้องใช้ CORS (host_permissions ของ manifest ครอบ 127.0.0.1 แล้ว)
+  extension อื่นต้องระบุ ID ตรงตัวเท่านั้น; wildcard อย่าง "chrome-extension://*" ถูกตัดทิ้ง (ดู rejected)
+  ไม่งั้น extension ไหนก็ได้ที่ติดตั้งอยู่จะอ่าน identity ของผู้ใช้ได้
+- header block (bytes) ถูกสร้างครั้งเดียวต่อ origin แล้วเก็บไว้ ต่อท้าย response ที่ cache ไว้ได้เลยโดยไม่ต้อง format ใหม่
+- preflight ได้ Access-Control-Max-Age ให้ browser จำผลไว้ ไม่ต้องส่ง OPTIONS ก่อนทุก request
+- รองรับ Private Network Access ของ Chrome (หน้า https สาธารณะ -> 127.0.0.1)
+ใช้ร่วมกันทั้ง webservice-new และ webservice-old
+"""
+
+DEFAULT_ORIGINS = ("https://*.atlassian.net",)
+# ใช้ wildcard ได้เฉพาะ scheme ของเว็บ; origin ของ extension ต้องเป็น ID ตรงตัว
+WILDCARD_SCHEMES = ("https://", "http://")
+
+
+def parse_origins(value: str | None, default=DEFAULT_ORIGINS) -> tuple[str, ...]:
+    """ค่า env แบบคั่นด้วย comma -> tuple ของ pattern; ว่าง/None = default"""
+    if not value or not value.strip():
+        return tuple(default)
+    return tuple(o.strip().rstrip("/") for o in value.split(",") if o.strip())
+
+
+def _block(headers) -> bytes:
+    return "".join(f"{k}: {v}\r\n" for k, v in headers).encode("latin-1")
+
+
+class CorsPolicy:
+    max_cached = 256  # origin ที่เก็บ header block ไว้ (กัน Origin แปลก ๆ ทำให้ dict โตไม่จำกัด)
+
+    def __init__(self, origins=DEFAULT_ORIGINS, methods=("GET", "OPTIONS"),
+                 allow_headers=("Content-Type", "If-None-Match"), expose_headers=("ETag",),
+                 max_age: int = 86400):
+        self.any_origin = "*" in origins
+        self._exact = {o for o in origins if "*" not in o}
+        # "https://*.atlassian.net" -> ("https://", ".atlassian.net")
+        self._wildcards = []
+        self.rejected = []  # pattern ที่ไม่รับ เช่น "chrome-extension://*" (ให้ผู้เรียก log เตือน)
+        for o in origins:
+            if o == "*" or "*" not in o:
+                continue
+            prefix, _, suffix = o.partition("*")
+            if prefix in WILDCARD_SCHEMES and suffix.startswith(".") and "*" not in suffix:
+                self._wildcards.append((prefix, suffix))
+            else:
+                self.rejected.append(o)
+        self.origins = tuple(o for o in origins if o not in self.rejected)
+        self.max_age = max_age
+        self._preflight_common = [
+            ("Access-Control-Allow-Methods", ", ".join(methods)),
+            ("Access-Control-Allow-Headers", ", ".join(allow_headers)),
+            ("Access-Control-Max-Age", str(max_age)),
+        ]
+        self._expose = [("Access-Control-Expose-Headers", ", ".join(expose_headers))] if expose_headers else []
+        # ไม่มี Origin (curl, fetch จาก background ที่มี host_permissions) ได้แค่ Vary
+        # ให้ cache ของ browser ไม่เอา response ที่ไม่มี CORS ไปใช้ตอบ request ที่มี Origin
+        self._no_origin = b"" if self.any_origin else _block([("Vary", "Origin")])
+        self._actual: dict[str, bytes] = {}
+        self._preflight: dict[tuple[str, bool], bytes | None] = {}
+
+    def allowed(self, origin: str) -> bool:
+        if self.any_origin or origin in self._exact:
+            return True
+        for prefix, suffix in self._wildcards:
+            if origin.startswith(prefix) and origin.endswith(suffix) and len(origin) > len(prefix) + len(suffix):
+                host = origin[len(prefix):len(origin) - len(suffix)]
+                # "*" แทน label ของ host เท่านั้น: ห้ามมี "/" ":" หรือ "@" ที่เปลี่ยน host จริงได้
+                if not any(c in host for c in "/:@"):
+                    return True
+        return False
+
+    def _allow_origin(self, origin: str) -> list[tuple[str, str]]:
+        if self.any_origin:
+            return [("Access-Control-Allow-Origin", "*")]
+        return [("Access-Control-Allow-Origin", origin), ("Vary", "Origin")]
+
+    def actual(self, origin: str | None) -> bytes:
+        """header block สำหรับ response ปกติ (b"Vary: Origin" อย่างเดียวถ้า origin ไม่ผ่าน)"""
+        if not origin:
+            return self._no_origin
+        block = self._actual.get(origin)
+        if block is None:
+            if self.allowed(origin):
+                block = _block(self._allow_origin(origin) + self._expose)
+            else:
+                block = self._no_origin
+            if len(self._actual) >= self.max_cached:
+                self._actual.clear()
+            self._actual[origin] = block
+        return block
+
+    def preflight(self, origin: str | None, private_network: bool = False) -> bytes | None:
+        """header block สำหรับคำตอบ OPTIONS; None = origin ไม่อยู่ใน allowlist"""
+        if not origin:
+            return None
+        key = (origin, private_network)
+        if key in self._preflight:
+            return self._preflight[key]
+        block = None
+        if self.allowed(origin):
+            headers = self._allow_origin(origin) + self._preflight_common
+            if private_network:
+                headers.append(("Access-Control-Allow-Private-Network", "true"))
+            block = _block(headers)
+        if len(self._preflight) >= self.max_cached:
+            self._preflight.clear()
+        self._preflight[key] = block
+        return block
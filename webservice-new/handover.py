@@ -0,0 +1,364 @@
+# handover.py
+"""
+graceful restart: listening socket ไม่เคยปิดระหว่างเปลี่ยนตัว worker
+- WorkerSupervisor (อยู่ใน Windows service) bind port ครั้งเดียว แล้วส่ง socket ให้ worker process
+  Windows ใช้ socket.share()/fromshare() ผ่าน stdin, POSIX ใช้ fd inheritance (WHOAMI_LISTEN_FD)
+- restart(): start worker ใหม่ -> รอ READY -> สั่งตัวเก่า DRAIN (หยุด accept, ตอบ request ค้างให้จบ) แล้วออก
+  connection ใหม่ระหว่างนั้นรออยู่ใน backlog ของ socket เดียวกัน จึงไม่มี connection refused
+- worker อ่านคำสั่งจาก stdin: "SESSION <event> [session_id]" (session เปลี่ยน -> refresh identity),
+  "DRAIN" หรือ EOF (supervisor ตาย) -> drain แล้วออก
+- worker ไม่เปิดไฟล์ log เอง: ส่ง record เป็น "LOG <json>" ทาง stdout แล้ว supervisor เขียนลงไฟล์
+  (บน Windows ไฟล์ที่อีก process เปิดอยู่ rename ไม่ได้ ถ้าทุก process เปิด service.log เอง rotation จะพัง)
+- รองรับ socket activation แบบ systemd (LISTEN_FDS/LISTEN_PID) ด้วย
+
+รันบน Linux: python handover.py --fake-user alice  แล้ว kill -HUP <pid> เพื่อสลับ worker
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import core
+from core import logger
+
+LISTEN_FD_ENV = "WHOAMI_LISTEN_FD"  # POSIX: เลข fd ของ listening socket ที่ส่งต่อมา
+LISTEN_SHARE_ENV = "WHOAMI_LISTEN_SHARE"  # Windows: "stdin" = ข้อมูล socket.share() ตามมาทาง stdin
+SD_LISTEN_FDS_START = 3
+READY_TIMEOUT = 15.0  # วินาที; worker ใหม่ต้องพร้อมภายในนี้ ไม่งั้นตัวเก่าทำงานต่อ
+RESPAWN_BACKOFF = (1.0, 30.0)  # วินาที; รอก่อน start worker ใหม่อีกครั้งหลัง start ไม่ขึ้น (เริ่ม, สูงสุด)
+RESPAWN_LIMIT = 5  # start ไม่ขึ้นติดกันเกินนี้ -> ปิด socket แล้วให้ service หยุดแบบ error (SCM recovery start ใหม่)
+
+
+def create_listen_socket(address: tuple[str, int], backlog: int = 128) -> socket.socket:
+    """bind + listen ครั้งเดียวสำหรับทุก worker (backlog ใหญ่พอให้ connection รอช่วงสลับตัว)"""
+    return socket.create_server(address, backlog=backlog)
+
+
+def python_executable() -> str:
+    """ใน Windows service sys.executable คือ pythonservice.exe -> ใช้ python.exe ข้าง ๆ แทน"""
+    exe = sys.executable
+    if Path(exe).name.lower().startswith("pythonservice"):
+        candidate = Path(sys.exec_prefix) / "python.exe"
+        if candidate.exists():
+            return str(candidate)
+    return exe
+
+
+def inherited_listen_socket() -> socket.socket | None:
+    """listening socket ที่ parent / systemd ส่งมา หรือ None ถ้าไม่ได้รันแบบนั้น"""
+    if os.environ.get(LISTEN_SHARE_ENV) == "stdin":
+        header = sys.stdin.buffer.readline().split()
+        if len(header) != 2 or header[0] != b"SHARE":
+            raise RuntimeError(f"bad socket share header: {header!r}")
+        data = sys.stdin.buffer.read(int(header[1]))
+        return socket.fromshare(data)
+    fd = os.environ.get(LISTEN_FD_ENV)
+    if fd is None and os.environ.get("LISTEN_PID") == str(os.getpid()) and os.environ.get("LISTEN_FDS"):
+        fd = str(SD_LISTEN_FDS_START)  # systemd socket activation
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+
+class PipeLogTarget:
+    """target ของ asynclog ฝั่ง worker: เขียน record เป็นบรรทัด "LOG <json>" ลง stdout (pipe ไปหา supervisor)"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout.buffer
+        self._lock = threading.Lock()
+
+    def send(self, line: str):
+        with self._lock:
+            try:
+                self.stream.write(line.encode("utf-8") + b"\n")
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass  # supervisor ปิด pipe ไปแล้ว
+
+    def emit_batch(self, records: list):
+        lines = [
+            "LOG " + json.dumps({"name": r.name, "level": r.levelno, "created": r.created,
+                                 "msg": r.getMessage(), "exc": r.exc_text}, ensure_ascii=False)
+            for r in records
+        ]
+        self.send("\n".join(lines))
+
+    def close(self):
+        pass
+
+
+def relay_log(pid: int, payload: str):
+    """ฝั่ง supervisor: สร้าง record จากบรรทัด LOG แล้วส่งให้ handler ของ logger เดียวกันใน process นี้"""
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        data = {"name": logger.name, "level": logging.INFO, "msg": payload}
+    name = data.get("name") or logger.name
+    msg = data.get("msg", "")
+    if name != core.access_logger.name:  # access log แบบ json ต้องเป็น JSON ล้วน
+        msg = f"[worker {pid}] {msg}"
+    level = data.get("level", logging.INFO)
+    record = logging.makeLogRecord({
+        "name": name, "levelno": level, "levelname": logging.getLevelName(level),
+        "msg": msg, "exc_text": data.get("exc"), "created": data.get("created", time.time()),
+    })
+    logging.getLogger(name).handle(record)
+
+
+class WorkerProcess:
+    def __init__(self, proc: subprocess.Popen):
+        self.proc = proc
+        self.pid = proc.pid
+        self.started = time.monotonic()
+        self.ready = threading.Event()
+        # อ่าน stdout ตลอดอายุ worker: READY ครั้งเดียว ที่เหลือเป็น log ที่ต้องเขียนแทน worker
+        self._reader = threading.Thread(target=self._read_stdout, name=f"worker-{self.pid}-out", daemon=True)
+        self._reader.start()
+
+    def _read_stdout(self):
+        try:
+            for raw in self.proc.stdout:
+                line = raw.decode("utf-8", "replace").rstrip("\r\n")
+                if line.startswith("LOG "):
+                    relay_log(self.pid, line[4:])
+                elif line.startswith("READY"):
+                    self.ready.set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            try:
+                self.proc.stdout.close()
+            except OSError:
+                pass
+
+    def reading(self) -> bool:
+        return self._reader.is_alive()
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def send(self, line: str):
+        try:
+            self.proc.stdin.write(line.encode("ascii") + b"\n")
+            self.proc.stdin.flush()
+        except OSError:
+            pass
+
+    def retire(self, timeout: float):
+        """สั่ง drain แล้วรอออก; ถ้าเกินเวลาค่อย kill"""
+        self.send("DRAIN")
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("Worker %d did not exit after drain; killing", self.pid)
+            self.proc.kill()
+            self.proc.wait(5)
+        finally:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            self._reader.join(2.0)  # ให้ log สุดท้ายของ worker ลงไฟล์ก่อน
+
+
+class WorkerSupervisor:
+    """
+    ถือ listening socket และ worker process ที่กำลังเสิร์ฟ
+    command = คำสั่งรัน worker (เช่น [python, service.py, "worker"]) ต้องเรียก run_worker()
+    """
+
+    def __init__(self, command: list[str], address: tuple[str, int], drain_timeout: float = core.DRAIN_TIMEOUT):
+        self.command = command
+        self.address = address
+        self.drain_timeout = drain_timeout
+        self.sock: socket.socket | None = None
+        self.current: WorkerProcess | None = None
+        self._lock = threading.Lock()
+        self.restarts = 0
+        self.crashes = 0
+        self.respawn_failures = 0  # start worker แทนตัวที่ตายไม่ขึ้นติดกันกี่ครั้ง
+        self._respawn_at = 0.0
+
+    def start(self):
+        self.sock = create_listen_socket(self.address)
+        self.address = self.sock.getsockname()[:2]
+        self.current = self._spawn()
+        logger.info("Supervisor listening on %s:%d; worker pid=%d", *self.address, self.current.pid)
+
+    def _spawn(self) -> WorkerProcess:
+        env = dict(os.environ)
+        kwargs = {}
+        if os.name == "nt":
+            env[LISTEN_SHARE_ENV] = "stdin"
+            kwargs["creationflags"] = subprocess.CREATE_NO_WINDOW
+        else:
+            env[LISTEN_FD_ENV] = str(self.sock.fileno())
+            kwargs["pass_fds"] = (self.sock.fileno(),)
+        proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, **kwargs)
+        worker = WorkerProcess(proc)
+        if os.name == "nt":
+            # share() ต้องรู้ pid ปลายทาง จึงส่งหลังจาก process เกิดแล้ว
+            data = self.sock.share(proc.pid)
+            proc.stdin.write(b"SHARE %d\n" % len(data) + data)
+            proc.stdin.flush()
+        self._wait_ready(worker)
+        return worker
+
+    def _wait_ready(self, worker: WorkerProcess):
+        deadline = time.monotonic() + READY_TIMEOUT
+        while not worker.ready.wait(0.05):
+            # stdout ปิด (worker ตายก่อน READY) ไม่ต้องรอจนหมดเวลา
+            if not worker.reading() or time.monotonic() >= deadline:
+                break
+        if not worker.ready.is_set():
+            worker.proc.kill()
+            raise RuntimeError(f"worker {worker.pid} not ready (exit={worker.proc.poll()})")
+
+    def restart(self, reason: str = "manual") -> bool:
+        """เปลี่ยนเป็น worker ใหม่ (โหลดโค้ดใหม่) โดยไม่ปิด port; คืน False ถ้าตัวใหม่ start ไม่ขึ้น"""
+        with self._lock:
+            started = time.perf_counter()
+            try:
+                new = self._spawn()
+            except Exception:
+                logger.exception("Graceful restart (%s) failed; keeping worker %s", reason,
+                                 self.current.pid if self.current else None)
+                return False
+            old, self.current = self.current, new
+            self.restarts += 1
+        logger.info("Graceful restart (%s): worker %d ready in %.0fms; draining %s", reason, new.pid,
+                    (time.perf_counter() - started) * 1000, old.pid if old else None)
+        if old is not None:
+            old.retire(self.drain_timeout)
+        return True
+
+    def check(self):
+        """
+        เรียกเป็นระยะ: worker ตายเองเมื่อไหร่ start ใหม่บน socket เดิม
+        start ไม่ขึ้นก็ลองใหม่แบบ backoff ทุกครั้งที่เรียก (ระหว่างนี้ไม่มีใคร accept connection ค้างใน backlog)
+        ไม่ขึ้นติดกัน RESPAWN_LIMIT ครั้ง: ปิด socket (client ได้ connection refused แทนการค้าง) แล้ว raise
+        """
+        current = self.current
+        if current is not None:
+            if current.alive():
+                return
+            self.crashes += 1
+            logger.error("Worker %d exited with %s; starting a new one", current.pid, current.proc.returncode)
+            with self._lock:
+                if self.current is current:
+                    self.current = None
+            current.retire(0)  # ปิด pipe ของตัวที่ตายแล้ว
+        elif self.sock is None or time.monotonic() < self._respawn_at:
+            return  # ยังไม่ start / หยุดแล้ว หรือยังไม่ถึงรอบ retry
+        if self.restart("crash"):
+            self.respawn_failures = 0
+            return
+        self.respawn_failures += 1
+        if self.respawn_failures >= RESPAWN_LIMIT:
+            self.stop()
+            raise RuntimeError(f"worker failed to start {self.respawn_failures} times in a row")
+        delay = min(RESPAWN_BACKOFF[0] * 2 ** (self.respawn_failures - 1), RESPAWN_BACKOFF[1])
+        self._respawn_at = time.monotonic() + delay
+        logger.error("No worker is serving; retrying in %.0fs (%d/%d)", delay, self.respawn_failures, RESPAWN_LIMIT)
+
+    def notify_session(self, name: str, session_id: int | None = None):
+        """ส่ง session change event ต่อให้ worker (identity cache อยู่ใน worker)"""
+        worker = self.current
+        if worker is not None:
+            worker.send(f"SESSION {name}" if session_id is None else f"SESSION {name} {session_id}")
+
+    def stop(self):
+        with self._lock:
+            worker, self.current = self.current, None
+        if worker is not None:
+            worker.retire(self.drain_timeout)
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def stats(self) -> dict:
+        return {
+            "address": list(self.address),
+            "worker_pid": self.current.pid if self.current else None,
+            "restarts": self.restarts,
+            "crashes": self.crashes,
+            "respawn_failures": self.respawn_failures,
+        }
+
+
+def run_worker(provider: core.IdentityProvider | None = None):
+    """
+    ฝั่ง worker process: เสิร์ฟบน socket ที่ได้รับมา, แจ้ง READY ทาง stdout แล้วรอคำสั่งทาง stdin
+    log ทั้งหมดส่งให้ supervisor เขียน (ไม่เปิด service.log / access.log เอง)
+    """
+    sock = inherited_listen_socket()
+    if sock is None:
+        raise SystemExit("run_worker: no listening socket was handed over")
+    pipe = PipeLogTarget()
+    core.forward_logging(pipe)
+    server, _thread = core.start_core(provider, sock=sock)
+    pipe.send(f"READY {os.getpid()}")
+    while True:
+        line = sys.stdin.readline()
+        command, _, arg = line.strip().partition(" ")
+        if not line or command == "DRAIN":
+            break
+        if command == "SESSION":
+            name, _, session_id = arg.partition(" ")
+            core.session_changed(name, int(session_id) if session_id.isdigit() else None)
+    logger.info("Worker %d draining (%s)", os.getpid(), "drain" if line else "supervisor gone")
+    core.stop_core(server, drain=True)
+    logger.info("Worker %d exit", os.getpid())
+    core.flush_logging()
+
+
+def main(argv=None):
+    """
+    worker สำหรับ OS ที่ไม่ใช่ Windows: python handover.py worker [--fake-user ...]
+    ไม่มี subcommand = รัน supervisor ใน foreground (ส่ง SIGHUP เพื่อ graceful restart)
+    """
+    parser = argparse.ArgumentParser(description="Whoami graceful-restart supervisor / worker")
+    parser.add_argument("role", nargs="?", choices=["supervisor", "worker"], default="supervisor")
+    parser.add_argument("--fake-user")
+    parser.add_argument("--fake-console-user")
+    args = parser.parse_args(argv)
+
+    provider = None
+    if args.fake_user or args.fake_console_user:
+        provider = core.FakeIdentityProvider(args.fake_user or "svc-whoami", args.fake_console_user)
+    if args.role == "worker":
+        run_worker(provider)
+        return
+
+    import signal
+
+    logging.basicConfig(level=logging.INFO, format=core.LOG_FORMAT)
+    worker_cmd = [python_executable(), str(Path(__file__).resolve()), "worker"]
+    if args.fake_user:
+        worker_cmd += ["--fake-user", args.fake_user]
+    if args.fake_console_user:
+        worker_cmd += ["--fake-console-user", args.fake_console_user]
+    supervisor = WorkerSupervisor(worker_cmd, (core.HOST, core.PORT))
+    supervisor.start()
+    restart = threading.Event()
+    signal.signal(signal.SIGHUP, lambda *_: restart.set())
+    try:
+        while True:
+            if restart.wait(1.0):
+                restart.clear()
+                supervisor.restart("SIGHUP")
+            supervisor.check()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 pip install pywin32
 pywin32_postinstall -install
 sudo python service.py install
+# ถ้า service หยุดแบบ error (เช่น worker start ไม่ขึ้น) ให้ SCM start ใหม่
+sudo sc.exe failure PyWin32Whoami7777 reset= 86400 actions= restart/5000/restart/5000/restart/30000
 sudo python service.py --startup auto start
\ No newline at end of file
@@ -0,0 +1,523 @@
+# resolvers.py
+"""
+ตัวหาชื่อผู้ใช้ (username resolver) แบบต่อเป็นชั้น ใช้ร่วมกันทั้ง whoami service และ webservice-old
+- แต่ละ resolver คือหนึ่ง "tier" ที่ตอบว่าใครเป็นผู้ใช้หน้าเครื่อง
+- tier native (WTS console session, process token, environment) ตอบในระดับไมโครวินาทีโดยไม่ spawn อะไร
+- tier PowerShell/whoami spawn process ทุกครั้งและอาจค้างหลายวินาที จึงเปิดเฉพาะเมื่อ AD_RESOLVER_SLOW=1
+- runner ของ subprocess ฉีดเข้ามาได้ ทดสอบ chain นอก Windows ด้วย runner ปลอม และดู latency ต่อ tier ผ่าน stats()
+- ParallelResolverChain รัน tier ถูก ๆ ใน thread ที่เรียก ส่ง tier ช้าเข้า pool ตามลำดับความสำคัญพร้อมกัน
+  แล้วคืนคำตอบทันทีที่ไม่มี tier ที่สำคัญกว่าจะชนะได้อีก: กรณีแย่สุดรอ deadline เดียว ไม่ใช่ผลรวม timeout
+"""
+import itertools
+import os
+import queue
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+import metrics
+from singleflight import SingleFlight
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def resolver_metrics():
+    """
+    (histogram เวลาต่อ tier, counter จำนวน subprocess ที่ spawn) ลงทะเบียนตอนใช้ครั้งแรก
+    whoami service import โมดูลนี้แค่เพื่อ normalize_username/Resolution
+    ถ้าลงทะเบียนตอน import /metrics ของมันจะมี family resolver_* ว่าง ๆ ติดมา
+    """
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = (
+                    metrics.REGISTRY.histogram(
+                        "resolver_tier_duration_seconds", "Username resolver time per tier", ["tier", "outcome"]),
+                    metrics.REGISTRY.counter(
+                        "resolver_subprocess_spawns_total", "Child processes started by resolver tiers", ["tier"]),
+                )
+    return _metrics
+
+
+SYSTEM_ACCOUNTS = ("system", "local service", "network service")
+NO_CONSOLE_SESSION = 0xFFFFFFFF
+
+Resolution = namedtuple("Resolution", "username source")
+
+
+class ResolverCancelled(Exception):
+    """tier ถูกทิ้งเพราะ chain ได้คำตอบแล้ว"""
+
+
+def run_command(cmd: list[str], timeout: float, cancel: threading.Event | None = None) -> tuple[int, str]:
+    """
+    runner เริ่มต้นของ subprocess คืน (returncode, stdout)
+    ถ้าส่ง cancel มา จะ kill process ทันทีที่ cancel ถูก set
+    """
+    if cancel is None:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+        return result.returncode, result.stdout
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            stdout, _stderr = proc.communicate(timeout=0.05)
+            return proc.returncode, stdout
+        except subprocess.TimeoutExpired:
+            if cancel.is_set() or time.monotonic() >= deadline:
+                proc.kill()
+                proc.communicate()
+                if cancel.is_set():
+                    raise ResolverCancelled(cmd[0])
+                raise subprocess.TimeoutExpired(cmd, timeout)
+
+
+def normalize_username(raw) -> str | None:
+    """ตัด DOMAIN\\ ข้างหน้าออก; ค่าว่างและบัญชีระบบ (SYSTEM, HOST$ ...) คืน None"""
+    text = str(raw).strip() if raw else ""
+    if not text:
+        return None
+    username = text.splitlines()[0].strip()
+    if "\\" in username:
+        username = username.split("\\")[-1]
+    if not username or username.lower() in SYSTEM_ACCOUNTS or username.endswith("$"):
+        return None
+    return username
+
+
+class Resolver:
+    """tier พื้นฐาน: subclass เขียน lookup() ที่คืนชื่อดิบหรือ None"""
+
+    name = "base"
+    slow = False
+    timeout = 1.0  # วินาที; deadline ของ tier นี้ใน ParallelResolverChain
+
+    def lookup(self, cancel: threading.Event | None = None) -> str | None:
+        raise NotImplementedError
+
+    def resolve(self, cancel: threading.Event | None = None) -> str | None:
+        return normalize_username(self.lookup(cancel))
+
+
+class WTSConsoleResolver(Resolver):
+    """ผู้ใช้ที่ล็อกอินหน้าเครื่อง (WTS API ไม่ spawn process)"""
+
+    name = "wts-console"
+
+    def lookup(self, cancel=None):
+        try:
+            import win32ts
+        except ImportError:
+            return None
+        sid = win32ts.WTSGetActiveConsoleSessionId()
+        if sid == NO_CONSOLE_SESSION:
+            return None
+        return win32ts.WTSQuerySessionInformation(None, sid, win32ts.WTSUserName)
+
+
+class ProcessTokenResolver(Resolver):
+    """บัญชีของ process token ปัจจุบัน (สิ่งที่ `whoami` พิมพ์ โดยไม่ต้องรัน whoami)"""
+
+    name = "process-token"
+
+    def lookup(self, cancel=None):
+        try:
+            import win32api
+            import win32security
+        except ImportError:
+            return None
+        token = win32security.OpenProcessToken(win32api.GetCurrentProcess(), win32security.TOKEN_QUERY)
+        try:
+            sid, _attrs = win32security.GetTokenInformation(token, win32security.TokenUser)
+        finally:
+            token.Close()
+        name, _domain, _type = win32security.LookupAccountSid(None, sid)
+        return name
+
+
+class EnvironmentResolver(Resolver):
+    """ตัวแปร USERNAME (ทางสุดท้าย)"""
+
+    name = "environment"
+
+    def __init__(self, environ=None):
+        self.environ = os.environ if environ is None else environ
+
+    def lookup(self, cancel=None):
+        return self.environ.get("USERNAME")
+
+
+class CommandResolver(Resolver):
+    """tier ช้า: รันคำสั่งภายนอกผ่าน runner ที่ฉีดเข้ามาได้"""
+
+    slow = True
+
+    def __init__(self, name: str, cmd: list[str], timeout: float, runner=None):
+        self.name = name
+        self.cmd = cmd
+        self.timeout = timeout
+        self.runner = runner or run_command
+
+    def lookup(self, cancel=None):
+        resolver_metrics()[1].inc(tier=self.name)
+        if cancel is None:
+            returncode, stdout = self.runner(self.cmd, self.timeout)
+        else:
+            returncode, stdout = self.runner(self.cmd, self.timeout, cancel=cancel)
+        if returncode == 0 and stdout and stdout.strip():
+            return stdout.strip()
+        return None
+
+
+# คำสั่งชุดเดิมของ service รุ่นแรก คงไว้ตามตัวอักษรสำหรับ tier ช้าที่ต้องเปิดเอง
+EXPLORER_OWNER_CMD = [
+    "powershell", "-Command",
+    'Get-Process explorer -IncludeUserName -ErrorAction SilentlyContinue | '
+    'Where-Object {$_.UserName -and $_.UserName -notlike "*$"} | '
+    'Select-Object -First 1 -ExpandProperty UserName | '
+    'ForEach-Object { $_.Split("\\")[-1] }'
+]
+QUERY_USER_CMD = [
+    "powershell", "-Command",
+    'query user | Select-String "Active" | ForEach-Object { ($_ -split "\\s+")[1] }'
+]
+GET_ADUSER_CMD = [
+    "powershell", "-Command",
+    "try { Import-Module ActiveDirectory -ErrorAction Stop; "
+    "(Get-ADUser -Identity $env:USERNAME).sAMAccountName } "
+    "catch { $env:USERNAME }"
+]
+WHOAMI_CMD = ["whoami"]
+
+
+def slow_tiers_enabled(environ=None) -> bool:
+    environ = os.environ if environ is None else environ
+    return environ.get("AD_RESOLVER_SLOW", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+class ResolverChain:
+    """
+    ลองทีละ tier ตามลำดับ ชื่อแรกที่ใช้ได้ชนะ; เก็บ latency ต่อ tier
+    resolve() ที่เรียกพร้อมกันใช้ผลของรอบที่กำลังทำอยู่ร่วมกัน (single-flight)
+    request N ตัวที่มาพร้อมกันจึงรัน tier แค่รอบเดียว
+    """
+
+    def __init__(self, resolvers, default: str = "unknown"):
+        self.resolvers = list(resolvers)
+        self.default = default
+        self.flight = SingleFlight()
+        self._tier_seconds = resolver_metrics()[0]
+        self._lock = threading.Lock()
+        self._stats = {r.name: _new_tier_stats() for r in self.resolvers}
+
+    def resolve(self) -> Resolution:
+        return self.flight.do("resolve", self._resolve_once)
+
+    def _resolve_once(self) -> Resolution:
+        for resolver in self.resolvers:
+            started = time.perf_counter()
+            username = None
+            error = None
+            try:
+                username = resolver.resolve()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            self._record(resolver.name, time.perf_counter() - started, username is not None, error)
+            if username:
+                return Resolution(username, resolver.name)
+        return Resolution(self.default, "default")
+
+    def _record(self, name: str, elapsed: float, hit: bool, error: str | None = None):
+        outcome = "error" if error else ("hit" if hit else "miss")
+        self._tier_seconds.observe(elapsed, tier=name, outcome=outcome)
+        with self._lock:
+            s = self._stats.setdefault(name, _new_tier_stats())
+            ms = elapsed * 1000.0
+            s["calls"] += 1
+            s["hits"] += 1 if hit else 0
+            s["total_ms"] += ms
+            s["last_ms"] = ms
+            s["max_ms"] = max(s["max_ms"], ms)
+            if error:
+                s["errors"] += 1
+                s["last_error"] = error
+
+    def stats(self) -> dict:
+        """ตัวนับและ latency (ms) ต่อ tier เช่นสำหรับ /status"""
+        with self._lock:
+            out = {}
+            for name, s in self._stats.items():
+                out[name] = dict(s)
+                out[name]["avg_ms"] = round(s["total_ms"] / s["calls"], 3) if s["calls"] else 0.0
+                out[name]["total_ms"] = round(s["total_ms"], 3)
+                out[name]["last_ms"] = round(s["last_ms"], 3)
+                out[name]["max_ms"] = round(s["max_ms"], 3)
+            return out
+
+
+def _new_tier_stats() -> dict:
+    return {
+        "calls": 0, "hits": 0, "errors": 0, "timeouts": 0, "cancelled": 0,
+        "total_ms": 0.0, "last_ms": 0.0, "max_ms": 0.0, "last_error": None,
+    }
+
+
+class _PriorityPool:
+    """worker thread จำนวนคงที่ ดึงงานจาก priority queue (เลขน้อยได้รันก่อน)"""
+
+    def __init__(self, workers: int, name: str = "resolver"):
+        self.workers = workers
+        self.name = name
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def submit(self, priority: int, fn, *args) -> Future:
+        self._ensure_started()
+        future = Future()
+        self._queue.put((priority, next(self._seq), future, fn, args))
+        return future
+
+    def _ensure_started(self):
+        # start thread ตอนใช้ครั้งแรก ให้การ import โมดูลยังถูกอยู่
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True).start()
+            self._started = True
+
+    def _worker(self):
+        while True:
+            _priority, _seq, future, fn, args = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class ParallelResolverChain(ResolverChain):
+    """
+    รันทุก tier พร้อมกันแล้วคืนคำตอบที่ใช้ได้ของ tier ที่สำคัญที่สุด
+    - ลำดับ tier คือลำดับความสำคัญ: คำตอบของ tier ล่างใช้ได้ก็ต่อเมื่อทุก tier ข้างบนล้มเหลวหรือเลย deadline
+      ของตัวเองแล้ว (resolver.timeout นับจากตอน tier เริ่มรันจริง tier ที่ยังรอ worker จึงไม่หมดเวลาก่อนได้รัน)
+    - tier native/env รันใน thread ที่เรียก มีแค่ tier ช้าที่เข้า pool: PowerShell ที่ค้างเต็ม pool
+      จึงไม่มีทางกัน fallback USERNAME
+    - tier ที่แพ้ถูกยกเลิก (ที่ยังรอคิวไม่ได้เริ่ม, คำสั่งที่รันอยู่ถูก kill) และทั้งการเรียกไม่เกิน deadline วินาที
+    """
+
+    poll_interval = 0.05  # วินาที; เช็ก deadline ซ้ำระหว่างที่ tier ยังรอคิว
+
+    def __init__(self, resolvers, default: str = "unknown", max_workers: int = 4, deadline: float = 5.0):
+        super().__init__(resolvers, default)
+        self.deadline = deadline
+        self._pool = _PriorityPool(max_workers)
+
+    def _resolve_once(self) -> Resolution:
+        cancel = threading.Event()
+        overall = time.monotonic() + self.deadline
+        count = len(self.resolvers)
+        began = [None] * count  # เวลา (monotonic) ที่แต่ละ tier เริ่มรันจริง
+
+        # tier ถูก ๆ ก่อน tier ช้าตัวแรก: ถ้าเจอตรงนี้ไม่ต้อง spawn อะไรเลย
+        lead = 0
+        while lead < count and not self.resolvers[lead].slow:
+            username = self._run_tier(self.resolvers[lead], cancel)
+            if username:
+                return Resolution(username, self.resolvers[lead].name)
+            lead += 1
+
+        futures = {}
+        for i in range(lead, count):
+            if self.resolvers[i].slow:
+                futures[i] = self._pool.submit(i, self._run_tier, self.resolvers[i], cancel, began, i)
+        # tier ถูก ๆ ที่เหลือ (เช่น USERNAME) รันตรงนี้ระหว่างที่ tier ช้ากำลังทำงาน
+        for i in range(lead, count):
+            if i not in futures:
+                futures[i] = Future()
+                futures[i].set_result(self._run_tier(self.resolvers[i], cancel))
+
+        def deadline(i):
+            if began[i] is None:
+                return overall
+            return min(began[i] + self.resolvers[i].timeout, overall)
+
+        try:
+            while True:
+                now = time.monotonic()
+                blocking = None
+                for i in range(lead, count):
+                    future = futures[i]
+                    if future.done():
+                        username = future.result()
+                        if username:
+                            return Resolution(username, self.resolvers[i].name)
+                    elif now < deadline(i):
+                        blocking = i
+                        break
+                if blocking is None:
+                    return Resolution(self.default, "default")
+
+                pending = [f for i, f in futures.items() if not f.done() and now < deadline(i)]
+                timeout = max(0.0, deadline(blocking) - now)
+                if began[blocking] is None:
+                    timeout = min(timeout, self.poll_interval)
+                wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        finally:
+            cancel.set()
+            now = time.monotonic()
+            for i, future in futures.items():
+                if future.cancel():
+                    self._count(self.resolvers[i].name, "cancelled")
+                elif not future.done() and now >= deadline(i):
+                    self._count(self.resolvers[i].name, "timeouts")
+
+    def _run_tier(self, resolver: Resolver, cancel: threading.Event, began=None, index=None) -> str | None:
+        if began is not None:
+            began[index] = time.monotonic()
+        if cancel.is_set():
+            self._count(resolver.name, "cancelled")
+            return None
+        started = time.perf_counter()
+        username = None
+        error = None
+        try:
+            username = resolver.resolve(cancel)
+        except ResolverCancelled:
+            self._count(resolver.name, "cancelled")
+            return None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        self._record(resolver.name, time.perf_counter() - started, username is not None, error)
+        return username
+
+    def _count(self, name: str, key: str):
+        with self._lock:
+            self._stats.setdefault(name, _new_tier_stats())[key] += 1
+
+
+NETSETUP_DOMAIN_NAME = 3  # NETSETUP_JOIN_STATUS.NetSetupDomainName
+
+
+def detect_domain_joined(environ=None) -> tuple[bool, str]:
+    """
+    เช็กว่าเครื่อง join domain ไหมแบบเร็ว คืน (joined, source)
+    ใช้ NetGetJoinInformation (API ในเครื่อง ไม่ต้องรัน systeminfo) ถ้าไม่มี API ดูจาก USERDNSDOMAIN
+    """
+    try:
+        import ctypes
+        from ctypes import wintypes
+        netapi32 = ctypes.windll.netapi32
+        name = wintypes.LPWSTR()
+        status = ctypes.c_int()
+        if netapi32.NetGetJoinInformation(None, ctypes.byref(name), ctypes.byref(status)) == 0:
+            netapi32.NetApiBufferFree(name)
+            return status.value == NETSETUP_DOMAIN_NAME, "netapi"
+    except Exception:
+        pass
+    environ = os.environ if environ is None else environ
+    return bool(environ.get("USERDNSDOMAIN")), "environment"
+
+
+class DomainMembership:
+    """
+    สถานะ domain join ตรวจครั้งเดียวแล้ว cache ไว้ตลอดอายุ process
+    - warmup() ตรวจใน background thread
+    - joined() ไม่บล็อก และตอบ False จนกว่าการตรวจครั้งแรกจะเสร็จ
+    """
+
+    def __init__(self, detector=None):
+        self._detector = detector or detect_domain_joined
+        self._lock = threading.Lock()
+        self._joined = None
+        self._source = None
+        self._checked_at = None
+
+    def warmup(self) -> threading.Thread:
+        thread = threading.Thread(target=self._safe_refresh, name="domain-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def refresh(self) -> dict:
+        joined, source = self._detector()
+        with self._lock:
+            self._joined = bool(joined)
+            self._source = source
+            self._checked_at = time.time()
+        return self.state()
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            pass
+
+    def joined(self) -> bool:
+        return bool(self._joined)
+
+    def state(self) -> dict:
+        with self._lock:
+            return {
+                "joined": self._joined,
+                "known": self._joined is not None,
+                "source": self._source,
+                "checked_at": self._checked_at,
+            }
+
+
+def _env_float(environ, key: str, default: float) -> float:
+    try:
+        return float(environ.get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def build_default_chain(runner=None, include_slow: bool | None = None, environ=None,
+                        parallel: bool = True) -> ResolverChain:
+    """
+    tier native ก่อน; tier PowerShell/whoami เฉพาะเมื่อ include_slow (ค่าเริ่มต้นตาม AD_RESOLVER_SLOW)
+    environment เป็นทางสุดท้ายเสมอ
+    """
+    if include_slow is None:
+        include_slow = slow_tiers_enabled(environ)
+    tiers = [WTSConsoleResolver(), ProcessTokenResolver()]
+    if include_slow:
+        tiers += [
+            CommandResolver("explorer-owner", EXPLORER_OWNER_CMD, 10, runner),
+            CommandResolver("query-user", QUERY_USER_CMD, 5, runner),
+            CommandResolver("get-aduser", GET_ADUSER_CMD, 10, runner),
+            CommandResolver("whoami", WHOAMI_CMD, 5, runner),
+        ]
+    tiers.append(EnvironmentResolver(environ))
+    return _make_chain(tiers, environ, parallel)
+
+
+def build_console_chain(runner=None, environ=None, parallel: bool = True) -> ResolverChain:
+    """tier ของ ad_server.py ตัว standalone: Get-ADUser, whoami แล้วค่อย USERNAME"""
+    tiers = [
+        CommandResolver("get-aduser", GET_ADUSER_CMD, 10, runner),
+        CommandResolver("whoami", WHOAMI_CMD, 5, runner),
+        EnvironmentResolver(environ),
+    ]
+    return _make_chain(tiers, environ, parallel)
+
+
+def _make_chain(tiers, environ, parallel: bool) -> ResolverChain:
+    if not parallel:
+        return ResolverChain(tiers)
+    environ = os.environ if environ is None else environ
+    return ParallelResolverChain(
+        tiers,
+        max_workers=int(_env_float(environ, "AD_RESOLVER_WORKERS", 4)),
+        deadline=_env_float(environ, "AD_RESOLVER_DEADLINE", 5.0),
+    )
@@ -0,0 +1,77 @@
+# router.py
+"""
+ตาราง route แบบ (method, path) -> Route: หา route ด้วย dict lookup ครั้งเดียว แทน if/elif ไล่เทียบ path
+- query string ถูกตัดออกก่อนหา (/whoami?x=1 เจอ /whoami) และ parse เฉพาะ route ที่ขอ (query=True)
+- middleware = factory(route, handler) -> handler ใหม่ ประกอบครั้งเดียวตอน add() ไม่ใช่ทุก request
+  ใส่ได้ทั้งระดับ router (ทุก route) และราย route เช่น บีบอัด, CORS, header เฉพาะ
+- handler จะรับ argument อะไรก็ได้ router แค่ส่งต่อ (core ใช้ (headers, query), webservice-old ใช้ (handler, query))
+ใช้ร่วมกันทั้ง webservice-new และ webservice-old
+"""
+from urllib.parse import parse_qs
+
+
+class Route:
+    __slots__ = ("method", "paths", "label", "query", "handler", "call", "options")
+
+    def __init__(self, method: str, paths: tuple[str, ...], handler, label: str, query: bool, options: dict):
+        self.method = method
+        self.paths = paths
+        self.label = label  # ชื่อใน metrics/access log (path ที่เป็น alias ใช้ชื่อเดียวกัน)
+        self.query = query
+        self.handler = handler
+        self.call = handler  # handler ที่ห่อ middleware แล้ว
+        self.options = options
+
+    def __repr__(self):
+        return f"Route({self.method} {'|'.join(self.paths)})"
+
+
+class Router:
+    def __init__(self, middleware=()):
+        self.middleware = list(middleware)
+        self._table: dict[tuple[str, str], Route] = {}
+        self._methods: dict[str, list[str]] = {}  # path -> method ที่มี (สำหรับ 405 / Allow)
+
+    def add(self, method: str, paths, handler, label: str | None = None, query: bool = False,
+            middleware=(), **options) -> Route:
+        paths = (paths,) if isinstance(paths, str) else tuple(paths)
+        route = Route(method, paths, handler, label or paths[-1], query, options)
+        call = handler
+        # middleware ตัวแรกอยู่นอกสุด: router-wide ก่อน แล้วค่อยของ route
+        for factory in reversed(self.middleware + list(middleware)):
+            call = factory(route, call)
+        route.call = call
+        for path in paths:
+            self._table[(method, path)] = route
+            self._methods.setdefault(path, []).append(method)
+        return route
+
+    def route(self, method: str, *paths: str, **kwargs):
+        """decorator ของ add(): @ROUTER.route("GET", "/", "/whoami", label="/whoami")"""
+        def register(handler):
+            self.add(method, paths, handler, **kwargs)
+            return handler
+        return register
+
+    def match(self, method: str, target: str) -> tuple[Route | None, dict]:
+        """(route, query) ของ request target; query เป็น {} ถ้า route ไม่ได้ขอหรือไม่มี query string"""
+        path, sep, qs = target.partition("?")
+        route = self._table.get((method, path))
+        if route is None or not (sep and route.query):
+            return route, {}
+        return route, parse_qs(qs)
+
+    def allowed(self, target: str) -> list[str]:
+        """method ที่ path นี้รองรับ (ว่าง = ไม่มี path นี้เลย)"""
+        return self._methods.get(target.partition("?")[0], [])
+
+    def label(self, target: str, method: str = "GET") -> str:
+        route = self._table.get((method, target.partition("?")[0]))
+        return route.label if route is not None else "other"
+
+    def routes(self) -> list[Route]:
+        seen = []
+        for route in self._table.values():
+            if route not in seen:
+                seen.append(route)
+        return seen
@@ -1,13 +1,15 @@
 # service.py
-import json
-import logging
-import os
-import socket
+"""
+Windows service adapter ของ whoami service
+- แกน (HTTP server, identity cache/refresher, metrics) อยู่ใน core.py ซึ่งไม่ import pywin32
+- ไฟล์นี้มีแค่ส่วนที่ต้องใช้ Windows: WTS provider, session change event และวงจรชีวิตของ service
+- WHOAMI_GRACEFUL_RESTART=1: service ถือ port ไว้แล้วให้ worker process เสิร์ฟ (handover.py)
+  อัปเดตโค้ดแล้วสั่ง `python service.py reload` -> worker ใหม่รับงานต่อ ตัวเก่า drain โดย port ไม่เคยว่าง
+"""
+import ctypes
+import sys
 import threading
-import time
-import subprocess
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from pathlib import Path
+from ctypes import wintypes
 
 import win32event
 import win32service
@@ -15,168 +17,159 @@ import win32serviceutil
 import servicemanager
 import win32ts  # ใช้ดึง active console user
 
-# ---------------- ปรับค่าได้ ----------------
-HOST = os.environ.get("WHOAMI_HOST", "127.0.0.1")  # ใช้ "0.0.0.0" ถ้าต้องการรับจากภายนอก
-PORT = int(os.environ.get("WHOAMI_PORT", "7777"))
-LOG_PATH = os.path.join(
-    os.environ.get("PROGRAMDATA", r"C:\ProgramData"),
-    "whoami_service",
-    "service.log",
-)
-# -------------------------------------------
+import core
+import handover
+from core import logger
 
-logger = logging.getLogger("whoami_service")
-logger.setLevel(logging.INFO)  # handler จะถูกเติมภายหลัง
+# custom control code (128-255) สำหรับสั่ง graceful restart: python service.py reload
+SERVICE_CONTROL_GRACEFUL_RESTART = 128
 
 
-def setup_logging():
-    """สร้างโฟลเดอร์ log และผูก FileHandler อย่างปลอดภัย (เรียกเมื่อ service เริ่มจริง ๆ)"""
-    try:
-        log_dir = Path(LOG_PATH).parent
-        log_dir.mkdir(parents=True, exist_ok=True)
-
-        from logging.handlers import RotatingFileHandler
-        fh = RotatingFileHandler(LOG_PATH, maxBytes=5_000_000, backupCount=3, encoding="utf-8")
-        fmt = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-        fh.setFormatter(fmt)
-
-        logger.handlers.clear()
-        logger.addHandler(fh)
-        logger.propagate = False
-
-        logger.info("Logging initialized at %s", LOG_PATH)
-    except Exception:
-        # ถ้าเขียน ProgramData ไม่ได้ ให้ fallback ไป temp
-        import tempfile
-        fallback = os.path.join(tempfile.gettempdir(), "whoami_service.log")
-        try:
-            from logging.handlers import RotatingFileHandler
-            fh = RotatingFileHandler(fallback, maxBytes=5_000_000, backupCount=2, encoding="utf-8")
-            fmt = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-            fh.setFormatter(fmt)
-            logger.handlers.clear()
-            logger.addHandler(fh)
-            logger.propagate = False
-            logger.warning("Failed to init log at %s, fallback to %s", LOG_PATH, fallback)
-        except Exception:
-            pass  # อย่างน้อย Event Log ยังมี
+class WTSIdentityProvider(core.IdentityProvider):
+    """process user จาก whoami + ผู้ใช้หน้าเครื่องจาก WTS API"""
+
+    console_tier = "wts-console"
+    sessions_tier = "wts-sessions"
 
+    def active_console_user(self) -> dict | None:
+        """
+        คืนผู้ใช้ที่ล็อกอินหน้าเครื่อง (interactive console session)
+        ถ้าไม่มี session จะคืน None; ถ้า WTS error จะ raise (ให้ refresher รู้ว่า refresh ล้มเหลว)
+        """
+        sid = win32ts.WTSGetActiveConsoleSessionId()
+        if sid == 0xFFFFFFFF:
+            return None
+        username = win32ts.WTSQuerySessionInformation(None, sid, win32ts.WTSUserName)
+        domain = win32ts.WTSQuerySessionInformation(None, sid, win32ts.WTSDomainName)
+        if not username:
+            return None
+        return {"domain": domain, "username": username, "session_id": int(sid)}
 
-def iso_now():
-    return time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    def sessions(self) -> list[dict]:
+        try:
+            return enumerate_sessions_ex()
+        except AttributeError:
+            return enumerate_sessions_legacy()
 
 
-def get_process_whoami() -> dict:
-    """รัน whoami (ผู้ใช้ของโปรเซส service ปัจจุบัน)"""
-    raw = ""
-    try:
-        proc = subprocess.run(["whoami"], capture_output=True, text=True, shell=False, check=True)
-        raw = (proc.stdout or "").strip()
-    except subprocess.CalledProcessError as e:
-        logger.exception("whoami failed")
-        raw = (e.stdout or "").strip() or "unknown"
+class WTS_SESSION_INFO_1W(ctypes.Structure):
+    _fields_ = [
+        ("ExecEnvId", wintypes.DWORD),
+        ("State", ctypes.c_int),
+        ("SessionId", wintypes.DWORD),
+        ("pSessionName", wintypes.LPWSTR),
+        ("pHostName", wintypes.LPWSTR),
+        ("pUserName", wintypes.LPWSTR),
+        ("pDomainName", wintypes.LPWSTR),
+        ("pFarmName", wintypes.LPWSTR),
+    ]
 
-    domain, username = (None, raw)
-    if "\\" in raw:
-        domain, username = raw.split("\\", 1)
 
-    return {"raw": raw, "domain": domain, "username": username}
+WTS_TYPE_CLASS_SESSION_INFO_LEVEL1 = 2
 
 
-def get_active_console_user() -> dict | None:
+def enumerate_sessions_ex() -> list[dict]:
     """
-    คืนผู้ใช้ที่ล็อกอินหน้าเครื่อง (interactive console session)
-    ถ้าไม่มี session จะคืน None
+    ทุก session พร้อม user/domain/state ใน syscall เดียว (WTSEnumerateSessionsExW level 1)
+    แทนการเรียก WTSQuerySessionInformation 2 ครั้งต่อ session
     """
+    wtsapi = ctypes.WinDLL("wtsapi32", use_last_error=True)
+    level = wintypes.DWORD(1)
+    info = ctypes.POINTER(WTS_SESSION_INFO_1W)()
+    count = wintypes.DWORD(0)
+    if not wtsapi.WTSEnumerateSessionsExW(None, ctypes.byref(level), 0, ctypes.byref(info), ctypes.byref(count)):
+        raise ctypes.WinError(ctypes.get_last_error())
     try:
-        sid = win32ts.WTSGetActiveConsoleSessionId()
-        if sid == 0xFFFFFFFF:
-            return None
+        return [
+            core.session_entry(s.SessionId, s.State, s.pDomainName, s.pUserName, s.pSessionName)
+            for s in info[:count.value] if s.pUserName
+        ]
+    finally:
+        wtsapi.WTSFreeMemoryExW(WTS_TYPE_CLASS_SESSION_INFO_LEVEL1, info, count)
+
+
+def enumerate_sessions_legacy() -> list[dict]:
+    """fallback สำหรับ Windows ที่ไม่มี WTSEnumerateSessionsExW (ก่อน Windows 7 / Server 2008 R2)"""
+    entries = []
+    for s in win32ts.WTSEnumerateSessions(None):
+        sid = s["SessionId"]
         username = win32ts.WTSQuerySessionInformation(None, sid, win32ts.WTSUserName)
-        domain = win32ts.WTSQuerySessionInformation(None, sid, win32ts.WTSDomainName)
         if not username:
-            return None
-        return {"domain": domain, "username": username, "session_id": int(sid)}
-    except Exception:
-        logger.exception("Failed to query active console user")
-        return None
-
-
-class QuietHTTPServer(ThreadingHTTPServer):
-    """เปิดใช้ SO_REUSEADDR และ thread daemon"""
-    daemon_threads = True
-    allow_reuse_address = True
-
-
-class WhoamiHTTPRequestHandler(BaseHTTPRequestHandler):
-    def log_message(self, fmt, *args):
-        logger.info("HTTP %s - " + fmt, self.address_string(), *args)
-
-    def _send_json(self, obj: dict, status: int = 200):
-        data = json.dumps(obj).encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(data)))
-        self.end_headers()
-        self.wfile.write(data)
-
-    def do_GET(self):
-        if self.path in ("/", "/whoami"):
-            payload = {
-                "process_user": get_process_whoami(),
-                "active_console_user": get_active_console_user(),
-                "host": socket.gethostname(),
-                "listen": {"host": HOST, "port": PORT},
-                "ts": iso_now(),
-            }
-            return self._send_json(payload, 200)
-
-        if self.path == "/active-user":
-            payload = {
-                "active_console_user": get_active_console_user(),
-                "host": socket.gethostname(),
-                "ts": iso_now(),
-            }
-            return self._send_json(payload, 200)
-
-        if self.path == "/healthz":
-            return self._send_json({"status": "ok", "ts": iso_now()}, 200)
-
-        return self._send_json({"error": "not found"}, 404)
+            continue
+        domain = win32ts.WTSQuerySessionInformation(None, sid, win32ts.WTSDomainName)
+        entries.append(core.session_entry(sid, s["State"], domain, username, s["WinStationName"]))
+    return entries
+
+
+# session event ที่ทำให้ผู้ใช้หน้าเครื่องเปลี่ยน -> ต้อง refresh ทันที
+SESSION_EVENT_NAMES = {
+    win32ts.WTS_CONSOLE_CONNECT: "console-connect",
+    win32ts.WTS_CONSOLE_DISCONNECT: "console-disconnect",
+    win32ts.WTS_REMOTE_CONNECT: "remote-connect",
+    win32ts.WTS_REMOTE_DISCONNECT: "remote-disconnect",
+    win32ts.WTS_SESSION_LOGON: "logon",
+    win32ts.WTS_SESSION_LOGOFF: "logoff",
+    win32ts.WTS_SESSION_LOCK: "lock",
+    win32ts.WTS_SESSION_UNLOCK: "unlock",
+    # ค่าใหม่กว่าที่ win32ts บางเวอร์ชันไม่มีชื่อให้
+    9: "remote-control",
+    10: "create",
+    11: "terminate",
+}
+
+
+def session_id_from(data) -> int | None:
+    """pywin32 ส่ง WTSSESSION_NOTIFICATION มาเป็น (session_id,)"""
+    if isinstance(data, tuple):
+        data = data[0] if data else None
+    return int(data) if isinstance(data, int) else None
 
 
 class WhoamiService(win32serviceutil.ServiceFramework):
     _svc_name_ = "PyWin32Whoami7777"
     _svc_display_name_ = "Python Whoami JSON Service (port 7777)"
-    _svc_description_ = "HTTP service that returns whoami and active console user in JSON."
+    _svc_description_ = ("HTTP service that returns whoami and active console user in JSON "
+                         "(also serves the legacy /username and /status routes).")
 
     def __init__(self, args):
         super().__init__(args)
         self.hWaitStop = win32event.CreateEvent(None, 0, 0, None)
-        self.httpd: QuietHTTPServer | None = None
+        self.httpd: core.PooledHTTPServer | core.AsyncWhoamiServer | None = None
         self.server_thread: threading.Thread | None = None
+        self.supervisor: handover.WorkerSupervisor | None = None
         self.running = True
 
+    def GetAcceptedControls(self):
+        # รับ SESSIONCHANGE เพิ่ม เพื่อให้ SCM ส่ง logon/logoff/lock มาที่ SvcOtherEx
+        return super().GetAcceptedControls() | win32service.SERVICE_ACCEPT_SESSIONCHANGE
+
+    def SvcOtherEx(self, control, event_type, data):
+        if control == win32service.SERVICE_CONTROL_SESSIONCHANGE:
+            name = SESSION_EVENT_NAMES.get(event_type, f"event-{event_type}")
+            session_id = session_id_from(data)
+            if self.supervisor:
+                self.supervisor.notify_session(name, session_id)
+                return
+            core.session_changed(name, session_id)
+        elif control == SERVICE_CONTROL_GRACEFUL_RESTART and self.supervisor:
+            # อย่าบล็อก handler ของ SCM ระหว่างรอ worker ใหม่
+            threading.Thread(target=self.supervisor.restart, args=("service control",), daemon=True).start()
+
     def SvcStop(self):
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
         logger.info("Service stopping...")
         self.running = False
-        try:
-            if self.httpd:
-                self.httpd.shutdown()
-        except Exception:
-            logger.exception("HTTP shutdown error")
-        try:
-            if self.httpd:
-                self.httpd.server_close()
-        except Exception:
-            logger.exception("HTTP server_close error")
-        win32event.SetEvent(self.hWaitStop)
+        if self.supervisor:
+            self.supervisor.stop()
+        else:
+            core.stop_core(self.httpd)
         logger.info("Service stopped")
+        core.flush_logging()
+        win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
         servicemanager.LogInfoMsg(f"{self._svc_name_} starting")
-        setup_logging()
+        core.setup_logging()
         logger.info("Service starting...")
         try:
             self.main()
@@ -185,21 +178,36 @@ class WhoamiService(win32serviceutil.ServiceFramework):
             raise
 
     def main(self):
-        self.httpd = QuietHTTPServer((HOST, PORT), WhoamiHTTPRequestHandler)
-        self.server_thread = threading.Thread(
-            target=self.httpd.serve_forever, kwargs={"poll_interval": 0.5}, daemon=True
-        )
-        self.server_thread.start()
-        logger.info("HTTP server running on http://%s:%d", HOST, PORT)
+        if core.GRACEFUL_RESTART:
+            self.supervisor = handover.WorkerSupervisor(
+                [handover.python_executable(), __file__, "worker"], (core.HOST, core.PORT))
+            self.supervisor.start()
+        else:
+            try:
+                self.httpd, self.server_thread = core.start_core(WTSIdentityProvider())
+            except OSError:
+                # มักเป็น ADUsernameHTTPService ตัวเก่าที่ยังถือ port อยู่; service นี้เสิร์ฟ /username แทนได้แล้ว
+                logger.error("Cannot listen on %s:%d; if the legacy AD username service is installed, "
+                             "remove it (python ad_server_service.py uninstall)", core.HOST, core.PORT)
+                raise
 
         while self.running:
             rc = win32event.WaitForSingleObject(self.hWaitStop, 1000)
             if rc == win32event.WAIT_OBJECT_0:
                 break
+            if self.supervisor:
+                # start worker ไม่ขึ้นติดกันหลายครั้ง check() จะ raise -> service หยุดแบบ error ให้ SCM recovery start ใหม่
+                self.supervisor.check()
 
         logger.info("Main loop exit")
 
 
 if __name__ == "__main__":
-    # ตั้งค่าทุกอย่างตอนรันจริงใน SvcDoRun() เพื่อลด side-effects ตอน install/remove
-    win32serviceutil.HandleCommandLine(WhoamiService)
+    if sys.argv[1:2] == ["worker"]:
+        # worker process ของโหมด graceful restart (service เป็นคน start)
+        handover.run_worker(WTSIdentityProvider())
+    elif sys.argv[1:2] == ["reload"]:
+        win32serviceutil.ControlService(WhoamiService._svc_name_, SERVICE_CONTROL_GRACEFUL_RESTART)
+    else:
+        # ตั้งค่าทุกอย่างตอนรันจริงใน SvcDoRun() เพื่อลด side-effects ตอน install/remove
+        win32serviceutil.HandleCommandLine(WhoamiService)
@@ -0,0 +1,90 @@
+# sessionbus.py
+"""
+ส่งต่อ session change event (logon/logoff/lock/unlock/remote-connect ...) ไปยังผู้ที่สนใจภายใน process
+- ต้นทาง: Windows service (SvcOtherEx + SERVICE_CONTROL_SESSIONCHANGE), คำสั่ง SESSION ของ worker
+  หรือ event สังเคราะห์ใน CI/ทดสอบ: bus.publish(SessionEvent("logon", 2)); bus.join()
+- ปลายทาง: identity cache (invalidate), refresher (refresh ทันที), stream /events
+- publish() แค่เข้าคิวแล้วคืนทันที: handler ของ SCM ต้องไม่รอ socket ของ subscriber ช้า ๆ
+  dispatcher thread เดียวเรียก subscriber ตามลำดับที่ event เข้ามา
+"""
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("whoami_service")
+
+
+class SessionEvent:
+    """kind เป็นชื่อแบบ "logon", "remote-connect" (ดู SESSION_EVENT_NAMES ใน service.py)"""
+
+    __slots__ = ("kind", "session_id", "ts")
+
+    def __init__(self, kind: str, session_id: int | None = None, ts: float | None = None):
+        self.kind = kind
+        self.session_id = session_id
+        self.ts = time.time() if ts is None else ts
+
+    def as_dict(self) -> dict:
+        return {"event": self.kind, "session_id": self.session_id, "ts": round(self.ts, 3)}
+
+    def __repr__(self):
+        return f"SessionEvent({self.kind!r}, {self.session_id!r})"
+
+
+class SessionEventBus:
+    def __init__(self, history: int = 20):
+        self._subscribers: list = []
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self.recent: deque = deque(maxlen=history)
+        self.counts: dict[str, int] = {}
+
+    def subscribe(self, callback):
+        """callback(event: SessionEvent) ถูกเรียกจาก dispatcher thread"""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """เลิกรับ event (event ที่อยู่ระหว่างส่งอาจยังมาถึงอีกครั้งเดียว)"""
+        try:
+            self._subscribers.remove(callback)
+        except ValueError:
+            pass
+
+    def publish(self, event: SessionEvent):
+        self.counts[event.kind] = self.counts.get(event.kind, 0) + 1
+        self.recent.append(event)
+        self._ensure_dispatcher()
+        self._queue.put(event)
+
+    def join(self):
+        """รอจนทุก event ที่ publish ไปแล้วถูกส่งถึง subscriber ครบ (ใช้ในการทดสอบ)"""
+        self._queue.join()
+
+    def _ensure_dispatcher(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="session-events", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            try:
+                for callback in list(self._subscribers):
+                    try:
+                        callback(event)
+                    except Exception:
+                        logger.exception("Session event subscriber failed for %r", event)
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "counts": dict(self.counts),
+            "pending": self._queue.qsize(),
+            "recent": [e.as_dict() for e in self.recent],
+        }
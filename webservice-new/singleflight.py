@@ -0,0 +1,45 @@
+# singleflight.py
+"""
+รวม call ที่ซ้อนกัน (single-flight): ถ้ามีคนกำลังโหลด key เดียวกันอยู่
+คนที่มาทีหลังจะรอและได้ผลลัพธ์เดียวกัน แทนที่จะ spawn subprocess / query ซ้ำ
+ใช้ร่วมกันทั้ง webservice-new และ webservice-old
+"""
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future] = {}
+        self.leaders = 0  # ครั้งที่โหลดจริง
+        self.shared = 0  # ครั้งที่รอผลของคนอื่น
+
+    def do(self, key: str, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "shared": self.shared}
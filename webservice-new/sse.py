@@ -0,0 +1,158 @@
+# sse.py
+"""
+Server-Sent Events สำหรับ /events: extension ถือ connection เดียวค้างไว้แทนการ poll /whoami
+- EventHub เก็บ subscriber ทุกตัว publish() encode event ครั้งเดียวแล้วส่งให้ทุกคน
+- heartbeat (comment line) ทุก heartbeat วินาที กัน proxy/idle timeout ตัด และทำให้เจอ client ที่หลุดไปแล้ว
+- subscriber ไม่กิน worker thread: โหมด threading ยก socket มาให้ hub, โหมด asyncio เขียนผ่าน event loop
+- client ที่ช้า/หลุด (ส่งไม่ออก) ถูกตัดทิ้ง ให้ไป reconnect เอง (ใช้ retry: ที่ส่งไปตอนต้น)
+"""
+import asyncio
+import json
+import socket
+import threading
+
+
+def format_event(event: str | None, data: dict | str, event_id: int | str | None = None) -> bytes:
+    """หนึ่ง event ตาม text/event-stream (data เป็น JSON บรรทัดเดียว)"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    text = data if isinstance(data, str) else json.dumps(data, separators=(",", ":"))
+    lines.extend(f"data: {line}" for line in text.split("\n"))
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+HEARTBEAT = b": ping\n\n"
+
+
+class SocketSubscriber:
+    """subscriber ของโหมด threading: hub เขียนลง socket ตรง ๆ (timeout สั้น กัน client ช้าบล็อกทุกคน)"""
+
+    def __init__(self, sock: socket.socket, send_timeout: float = 2.0):
+        self.sock = sock
+        self.sock.settimeout(send_timeout)
+
+    def send(self, data: bytes) -> bool:
+        try:
+            self.sock.sendall(data)
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class StreamSubscriber:
+    """subscriber ของโหมด asyncio: เขียนผ่าน event loop; buffer ค้างเกิน max_buffer = client ไม่อ่านแล้ว"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter, max_buffer: int = 64 * 1024):
+        self.loop = loop
+        self.writer = writer
+        self.max_buffer = max_buffer
+
+    def send(self, data: bytes) -> bool:
+        if self.writer.is_closing() or self.loop.is_closed():
+            return False
+        if self.writer.transport.get_write_buffer_size() > self.max_buffer:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+        except RuntimeError:  # loop ปิดไปแล้ว
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        except RuntimeError:
+            pass
+
+
+class EventHub:
+    def __init__(self, heartbeat: float = 15.0, max_clients: int = 256, retry_ms: int = 2000):
+        self.heartbeat = heartbeat
+        self.max_clients = max_clients
+        self.retry_ms = retry_ms
+        self._lock = threading.Lock()
+        self._subscribers: list = []
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.connected = 0
+        self.events = 0
+        self.dropped = 0
+
+    def full(self) -> bool:
+        return len(self._subscribers) >= self.max_clients
+
+    def subscribe(self, subscriber, initial: bytes = b"") -> bool:
+        """เพิ่ม subscriber แล้วส่ง retry + event เริ่มต้น; คืน False ถ้าเต็มหรือส่งไม่ออก"""
+        if self.full() or not subscriber.send(f"retry: {self.retry_ms}\n\n".encode("ascii") + initial):
+            return False
+        with self._lock:
+            self._subscribers.append(subscriber)
+            self.connected += 1
+        self._ensure_heartbeat()
+        return True
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def publish(self, event: str, data: dict, event_id: int | None = None):
+        self.broadcast(format_event(event, data, event_id))
+
+    def broadcast(self, payload: bytes):
+        """ส่ง event ที่ encode แล้ว (format_event) ให้ทุก subscriber"""
+        self.events += 1
+        self._send_all(payload)
+
+    def _send_all(self, payload: bytes):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        dead = [s for s in subscribers if not s.send(payload)]
+        if dead:
+            with self._lock:
+                for s in dead:
+                    if s in self._subscribers:
+                        self._subscribers.remove(s)
+            self.dropped += len(dead)
+            for s in dead:
+                s.close()
+
+    def _ensure_heartbeat(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sse-heartbeat", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.heartbeat):
+            if self._subscribers:
+                self._send_all(HEARTBEAT)
+
+    def close(self):
+        """ตัดทุก stream (ตอน stop/drain) client จะ reconnect ไปที่ worker ตัวใหม่เอง"""
+        self._stop.set()
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for s in subscribers:
+            s.close()
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self._subscribers),
+            "max_clients": self.max_clients,
+            "connected": self.connected,
+            "events": self.events,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+
+from asynclog import AsyncLogHandler
+
+
+class ListTarget:
+    """target ในหน่วยความจำ; จำว่ามีการเขียนหลัง close หรือไม่"""
+
+    def __init__(self, delay: float = 0.0):
+        self.messages = []
+        self.closed = False
+        self.written_after_close = 0
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def emit_batch(self, records):
+        time.sleep(self.delay)
+        with self._lock:
+            if self.closed:
+                self.written_after_close += len(records)
+            self.messages.extend(r.getMessage() for r in records)
+
+    def close(self):
+        self.closed = True
+
+
+def make_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def test_stop_drains_while_other_threads_keep_logging():
+    target = ListTarget(delay=0.001)
+    handler = AsyncLogHandler(target, batch_size=16)
+    handler.start()
+    logger = make_logger("test_asynclog.busy", handler)
+    running = True
+    counts = [0] * 4
+
+    def spam(i):
+        while running:
+            logger.info("t%d-%d", i, counts[i])
+            counts[i] += 1
+
+    threads = [threading.Thread(target=spam, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    handler.stop(timeout=2)
+    elapsed = time.monotonic() - started
+    running = False
+    for t in threads:
+        t.join(5)
+
+    assert elapsed < 1.0
+    assert not any(t.name == "async-log-writer" and t.is_alive() for t in threading.enumerate())
+    # ทุก record ถูกเขียน (ก่อน close ผ่าน writer, หลัง stop เขียนตรง) ไม่มีตัวไหนหาย
+    assert len(target.messages) + handler.dropped == sum(counts)
+
+
+def test_target_is_closed_only_after_the_writer_finished():
+    target = ListTarget()
+    handler = AsyncLogHandler(target)
+    handler.start()
+    logger = make_logger("test_asynclog.order", handler)
+    for i in range(100):
+        logger.info("m%d", i)
+    handler.stop()
+    assert target.closed and target.written_after_close == 0
+    assert target.messages == [f"m{i}" for i in range(100)]
+    logger.info("after stop")  # เขียนตรง ไม่ค้างในคิว
+    assert target.messages[-1] == "after stop"
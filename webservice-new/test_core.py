@@ -0,0 +1,373 @@
+import http.client
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import core
+
+
+@pytest.fixture(params=["threading", "asyncio"])
+def server(request):
+    """HTTP server จริงบน port สุ่ม (ทั้งสองโหมด) ด้วย FakeIdentityProvider"""
+    core.use_identity_provider(core.FakeIdentityProvider("alice", console_user="bob", remote_users=["carol"]))
+    srv = core.make_server(("127.0.0.1", 0), request.param)
+    thread = threading.Thread(target=srv.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield srv.server_address[:2]
+    srv.shutdown()
+    srv.server_close()
+    thread.join(5)
+
+
+def get(address, path, headers=None, method="GET"):
+    conn = http.client.HTTPConnection(*address, timeout=5)
+    try:
+        conn.request(method, path, headers=headers or {})
+        resp = conn.getresponse()
+        return resp.status, resp.headers, resp.read()
+    finally:
+        conn.close()
+
+
+def raw(address, data: bytes) -> bytes:
+    """ส่ง request ดิบ (หลายตัวต่อกันบน keep-alive ได้) แล้วอ่านจน server ปิด"""
+    with socket.create_connection(address, timeout=5) as sock:
+        sock.sendall(data)
+        chunks = []
+        while chunk := sock.recv(65536):
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def test_head_has_get_headers_and_no_body(server):
+    status, headers, body = get(server, "/whoami")
+    data = raw(server, b"HEAD /whoami HTTP/1.1\r\nHost: x\r\n\r\n"
+                       b"HEAD /nope HTTP/1.1\r\nHost: x\r\n\r\n"
+                       b"GET /username HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+    head, not_found, last = data.split(b"HTTP/1.1 ")[1:]
+    assert head.startswith(b"200 ") and head.endswith(b"\r\n\r\n")
+    assert f"Content-Length: {len(body)}\r\n".encode() in head
+    assert f"ETag: {headers['ETag']}\r\n".encode() in head
+    assert not_found.startswith(b"404 ") and not_found.endswith(b"\r\n\r\n")
+    # request ถัดไปบน connection เดียวกันยังอ่านได้ถูก (ไม่มี body ของ HEAD ค้างอยู่หน้า response)
+    assert last.startswith(b"200 ") and last.endswith(b'"username": "bob", "method": "AD", "source": "fake-console"}')
+
+
+def test_other_methods_get_405_with_allow(server):
+    status, headers, body = get(server, "/whoami", method="DELETE")
+    assert status == 405
+    assert headers["Allow"] == "GET, HEAD, OPTIONS"
+
+
+def test_etag_is_per_representation_and_ignores_rdp_churn(server):
+    whoami = get(server, "/whoami")[1]["ETag"]
+    username = get(server, "/whoami?fields=username")[1]["ETag"]
+    sessions = get(server, "/sessions")[1]["ETag"]
+    assert len({whoami, username, sessions, get(server, "/active-user")[1]["ETag"]}) == 4
+
+    # RDP ผู้ใช้ใหม่เข้ามา: /sessions เปลี่ยน แต่ /whoami และ ?fields=username ยังได้ 304
+    core.identity_refresher.provider.remote_users.append("dave")
+    core.identity_refresher.refresh("test")
+    assert get(server, "/whoami", {"If-None-Match": whoami})[0] == 304
+    assert get(server, "/whoami?fields=username", {"If-None-Match": username})[0] == 304
+    status, headers, _ = get(server, "/sessions", {"If-None-Match": sessions})
+    assert status == 200 and headers["ETag"] != sessions
+
+
+def test_identity_event_carries_the_username_etag(server):
+    status, headers, body = get(server, "/whoami?fields=username")
+    event = core.identity_event(core.current_identity()).decode()
+    assert f'"etag":{json.dumps(headers["ETag"])}' in event
+
+
+def test_fields_projection(server):
+    status, headers, body = get(server, "/whoami?fields=username,host")
+    assert status == 200 and json.loads(body) == {"host": core.HOSTNAME, "username": "bob"}
+    # ?fields= ว่าง = payload เต็ม
+    assert "process_user" in json.loads(get(server, "/whoami?fields=")[2])
+
+
+def test_unknown_fields_are_rejected(server):
+    status, _, body = get(server, "/whoami?fields=username,sessions,nope")
+    assert status == 400
+    assert json.loads(body)["fields"] == ["nope", "sessions"]
+    assert get(server, "/sessions?fields=sessions")[0] == 200
+
+
+def test_route_fields_match_the_payloads():
+    snap = core.current_identity()
+    for route, build in (("/whoami", core.whoami_payload), ("/active-user", core.active_user_payload),
+                         ("/sessions", core.sessions_payload)):
+        assert core.ROUTE_FIELDS[route] == set(build(snap)) | {"username"}
+
+
+def test_legacy_username_and_status_routes(server):
+    # /username แบบ webservice-old: ผู้ใช้หน้าเครื่องก่อน (ตัด DOMAIN\ ทิ้ง) พร้อม tier ที่ตอบ
+    status, headers, body = get(server, "/username")
+    assert status == 200 and "ETag" not in headers
+    assert json.loads(body) == {"ok": True, "username": "bob", "method": "AD", "source": "fake-console"}
+
+    status, _, body = get(server, "/status")
+    data = json.loads(body)
+    assert status == 200 and data["status"] == "running"
+    assert data["endpoint"] == "http://%s:%d/username" % server
+    assert data["snapshot"]["source"] and "refresher" in data
+
+
+def test_legacy_username_skips_system_accounts(server):
+    core.use_identity_provider(core.FakeIdentityProvider("SYSTEM", domain="NT AUTHORITY"))
+    assert json.loads(get(server, "/username")[2])["username"] == "unknown"
+    core.use_identity_provider(core.FakeIdentityProvider("HOST$"))
+    assert json.loads(get(server, "/username")[2]) == {"ok": True, "username": "unknown", "method": "AD",
+                                                        "source": "default"}
+    core.use_identity_provider(core.FakeIdentityProvider("svc", domain="CORP"))
+    assert json.loads(get(server, "/username")[2])["username"] == "svc"
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_identity_cache_ttl_invalidate_and_change_callbacks():
+    cache = core.IdentityCache(ttl=0.05)
+    changes = []
+    cache.on_change(changes.append)
+    assert cache.current() is None and cache.stats()["misses"] == 1
+
+    snap = cache.publish({"username": "alice"}, None, "test")
+    assert cache.current() is snap and not cache.is_stale(snap)
+    time.sleep(0.06)
+    assert cache.current() is snap and cache.is_stale(snap)  # stale-while-revalidate: ยังเสิร์ฟได้
+
+    fresh = cache.publish({"username": "alice"}, None, "test")
+    assert not cache.is_stale(fresh) and cache.is_stale(snap)
+    cache.invalidate("test")
+    assert cache.is_stale(fresh)
+    # callback เฉพาะตอนเนื้อหาเปลี่ยนจริง (ครั้งแรก + ผู้ใช้ใหม่) ไม่ใช่ทุก publish
+    cache.publish({"username": "bob"}, None, "test")
+    assert [c["process_user"]["username"] for c in changes] == ["alice", "bob"]
+
+
+def test_session_change_invalidates_and_refreshes():
+    provider = core.FakeIdentityProvider("svc", console_user="alice")
+    core.use_identity_provider(provider)
+    core.identity_refresher.start()
+    try:
+        wait_until(lambda: core.identity_cache.peek() and core.identity_cache.peek()["source"] == "startup")
+        version = core.identity_cache.peek()["version"]
+
+        provider.console_user = "bob"
+        core.session_changed("logon", 2)
+        core.session_events.join()
+        wait_until(lambda: core.identity_cache.peek()["version"] > version)
+        snap = core.current_identity()
+        assert snap["active_console_user"]["username"] == "bob"
+        assert snap["source"] == "session logon #2"
+    finally:
+        core.identity_refresher.stop()
+
+
+class CountingProvider(core.FakeIdentityProvider):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = 0
+        self.fail = False
+
+    def process_user(self):
+        self.calls += 1
+        if self.fail:
+            raise OSError("whoami failed")
+        return super().process_user()
+
+
+def test_refresher_prewarms_and_requests_never_load():
+    cache = core.IdentityCache(ttl=60)
+    provider = CountingProvider("alice")
+    refresher = core.IdentityRefresher(cache, interval=60, provider=provider)
+    refresher.start()
+    try:
+        wait_until(lambda: cache.peek() is not None)
+        for _ in range(20):
+            cache.current()
+        assert provider.calls == 1
+
+        # refresh ล้มเหลว: snapshot เดิมยังอยู่ และ retry แบบ backoff
+        provider.fail = True
+        assert refresher.refresh("test") is False
+        assert cache.peek()["process_user"]["username"] == "alice"
+        assert refresher.stats()["consecutive_failures"] == 1
+        assert refresher._next_delay(False) == 1 and refresher._next_delay(True) == 60
+    finally:
+        refresher.stop()
+
+
+def test_if_none_match_returns_304_without_body(server):
+    status, headers, body = get(server, "/whoami")
+    etag = headers["ETag"]
+    assert status == 200 and etag.startswith('W/"')
+    status, headers, body = get(server, "/whoami", {"If-None-Match": f'"other", {etag[2:]}'})
+    assert status == 304 and body == b""
+    assert headers["ETag"] == etag and headers["Cache-Control"] == f"private, max-age={core.CLIENT_MAX_AGE}"
+    assert get(server, "/whoami", {"If-None-Match": '"other"'})[0] == 200
+
+
+def test_etag_matches():
+    assert core.etag_matches('W/"abc"', 'W/"abc"')
+    assert core.etag_matches('"abc"', 'W/"abc"')  # weak comparison
+    assert core.etag_matches('"x", W/"abc"', 'W/"abc"')
+    assert core.etag_matches("*", 'W/"abc"')
+    assert not core.etag_matches('"abcd"', 'W/"abc"')
+    assert not core.etag_matches(None, 'W/"abc"') and not core.etag_matches('"abc"', None)
+
+
+def test_preferred_encoding():
+    assert core.preferred_encoding(None) is None
+    assert core.preferred_encoding("gzip, deflate, br") == "gzip"
+    assert core.preferred_encoding("gzip;q=0, deflate") == "deflate"
+    assert core.preferred_encoding("gzip;q=0.2, deflate;q=0.8") == "deflate"
+    assert core.preferred_encoding("*") == "gzip"
+    assert core.preferred_encoding("identity, *;q=0") is None
+    assert core.preferred_encoding("br") is None
+
+
+def test_large_responses_are_compressed_with_vary(server, monkeypatch):
+    import gzip
+    import zlib
+
+    status, headers, plain = get(server, "/metrics")
+    assert len(plain) >= core.COMPRESS_MIN_BYTES and "Content-Encoding" not in headers
+    status, headers, body = get(server, "/metrics", {"Accept-Encoding": "gzip"})
+    assert status == 200 and headers["Content-Encoding"] == "gzip" and headers["Vary"] == "Accept-Encoding"
+    assert int(headers["Content-Length"]) == len(body) and gzip.decompress(body).startswith(b"# HELP")
+    status, headers, body = get(server, "/metrics", {"Accept-Encoding": "gzip;q=0, deflate"})
+    assert headers["Content-Encoding"] == "deflate" and zlib.decompress(body).startswith(b"# HELP")
+
+    # /whoami เล็กกว่า COMPRESS_MIN_BYTES: ส่งแบบไม่บีบ
+    status, headers, body = get(server, "/whoami", {"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in headers and json.loads(body)["host"] == core.HOSTNAME
+    monkeypatch.setattr(core, "COMPRESS_MIN_BYTES", 1)
+    status, headers, body = get(server, "/whoami", {"Accept-Encoding": "gzip"})
+    assert headers["Content-Encoding"] == "gzip" and json.loads(gzip.decompress(body))["host"] == core.HOSTNAME
+    # 304 ไม่มี body ให้บีบ
+    status, headers, body = get(server, "/whoami", {"Accept-Encoding": "gzip", "If-None-Match": headers["ETag"]})
+    assert status == 304 and "Content-Encoding" not in headers
+
+
+def test_keep_alive_counts_down_and_closes_at_max(server, monkeypatch):
+    monkeypatch.setattr(core, "KEEPALIVE_MAX", 3)
+    data = raw(server, b"GET /whoami HTTP/1.1\r\nHost: x\r\n\r\n" * 4)
+    responses = data.split(b"HTTP/1.1 ")[1:]
+    # ครบ KEEPALIVE_MAX แล้ว server ปิด; request ที่ 4 ไม่ได้คำตอบ
+    assert len(responses) == 3 and all(r.startswith(b"200 ") for r in responses)
+    assert core.keep_alive_header(2) in responses[0]
+    assert core.keep_alive_header(1) in responses[1]
+    assert b"Connection: close\r\n" in responses[2] and b"Keep-Alive" not in responses[2]
+
+
+def test_keep_alive_honours_connection_close_and_http10(server):
+    data = raw(server, b"GET /whoami HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n"
+                       b"GET /whoami HTTP/1.1\r\nHost: x\r\n\r\n")
+    assert data.count(b"HTTP/1.1 200 ") == 1 and b"Connection: close\r\n" in data
+    data = raw(server, b"GET /whoami HTTP/1.0\r\n\r\n")
+    assert data.count(b" 200 ") == 1 and b"Keep-Alive" not in data
+
+
+def test_concurrent_refreshes_spawn_one_lookup():
+    release = threading.Event()
+
+    class SlowProvider(CountingProvider):
+        def process_user(self):
+            user = super().process_user()
+            release.wait(5)
+            return user
+
+    cache = core.IdentityCache(ttl=60)
+    provider = SlowProvider("alice")
+    refresher = core.IdentityRefresher(cache, interval=60, provider=provider)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(refresher.refresh("test"))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    wait_until(lambda: refresher.stats()["coalescing"]["shared"] == 7)
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert results == [True] * 8 and provider.calls == 1
+    assert refresher.stats()["refreshes"] == 1 and cache.peek()["process_user"]["username"] == "alice"
+
+
+def test_json_access_log_and_sampling(monkeypatch, caplog):
+    monkeypatch.setattr(core, "ACCESS_LOG", "json")
+    monkeypatch.setattr(core, "ACCESS_LOG_SAMPLE", 0.25)
+    resp = core.json_response({"ok": True})
+    resp.meta = {"source": "cache"}
+
+    def access_lines():
+        return [json.loads(r.getMessage()) for r in caplog.records if r.name == "whoami_service.access"]
+
+    with caplog.at_level("INFO", logger="whoami_service"):
+        monkeypatch.setattr(core.random, "random", lambda: 0.5)  # ไม่ถูกสุ่ม
+        core.log_access("127.0.0.1", "GET", "/whoami?fields=username", "HTTP/1.1", resp, 0.0012)
+        core.log_access("127.0.0.1", "GET", "/nope", "HTTP/1.1", core.json_response({}, 404), 0.001)
+        monkeypatch.setattr(core.random, "random", lambda: 0.1)
+        core.log_access("127.0.0.1", "GET", "/whoami", "HTTP/1.1", resp, 0.0012)
+
+    not_found, sampled = access_lines()
+    # 4xx ลงทุกครั้งโดยไม่มี sample; 2xx ที่ถูกสุ่มติด sample ไว้ถ่วงน้ำหนัก
+    assert not_found["status"] == 404 and "sample" not in not_found
+    assert sampled["route"] == "/whoami" and sampled["ms"] == 1.2 and sampled["source"] == "cache"
+    assert sampled["sample"] == 0.25 and sampled["bytes"] == len(resp.body)
+
+    caplog.clear()
+    monkeypatch.setattr(core, "ACCESS_LOG", "off")
+    core.log_access("127.0.0.1", "GET", "/nope", "HTTP/1.1", core.json_response({}, 404), 0.001)
+    assert not caplog.records
+
+
+def test_session_entry_maps_wts_states():
+    assert core.session_entry("3", 4, "", "dave") == {
+        "session_id": 3, "station": None, "state": "disconnected", "domain": None, "username": "dave"}
+    assert core.session_entry(1, 0, "CORP", "bob", "Console")["state"] == "active"
+    assert core.session_entry(1, 42, "CORP", "bob")["state"] == "42"
+
+
+def test_sessions_route_lists_fake_provider_sessions(server):
+    status, _, body = get(server, "/sessions")
+    data = json.loads(body)
+    assert status == 200 and data["process_user"]["username"] == "alice"
+    assert [(s["session_id"], s["station"], s["username"]) for s in data["sessions"]] == [
+        (1, "Console", "bob"), (2, "RDP-Tcp#2", "carol")]
+
+
+def test_core_imports_without_pywin32():
+    import os
+    import subprocess
+    import sys
+
+    code = "import sys, core; assert not [m for m in sys.modules if m.startswith(('win32', 'pywintypes'))]"
+    subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(core.__file__)),
+                   check=True)
+
+
+def test_cache_control_is_private_max_age_until_the_snapshot_goes_stale(server):
+    assert core.cache_control(0) == "no-cache"
+    provider = CountingProvider("alice", console_user="bob")
+    core.use_identity_provider(provider)
+    status, headers, _ = get(server, "/whoami?fields=username")
+    assert headers["Cache-Control"] == f"private, max-age={core.CLIENT_MAX_AGE}"
+
+    # โหลดใหม่ไม่สำเร็จ: เสิร์ฟ snapshot เดิมแบบ stale และ client ต้องถามใหม่ทุกครั้ง (ทั้ง 200 และ 304)
+    provider.fail = True
+    core.identity_cache.invalidate("test")
+    status, headers, body = get(server, "/whoami?fields=username")
+    assert status == 200 and headers["Cache-Control"] == "no-cache" and json.loads(body) == {"username": "bob"}
+    status, headers, _ = get(server, "/whoami?fields=username", {"If-None-Match": headers["ETag"]})
+    assert status == 304 and headers["Cache-Control"] == "no-cache"
+    # route ที่ไม่อิง snapshot ไม่มี Cache-Control
+    assert "Cache-Control" not in get(server, "/username")[1]
@@ -0,0 +1,87 @@
+from cors import DEFAULT_ORIGINS, CorsPolicy, parse_origins
+from test_core import server  # noqa: F401  (fixture)
+
+EXTENSION = "chrome-extension://abcdefghijklmnopabcdefghijklmnop"
+
+
+def test_default_allows_atlassian_subdomains_only():
+    cors = CorsPolicy()
+    assert cors.allowed("https://acme.atlassian.net")
+    assert not cors.allowed("https://atlassian.net")
+    assert not cors.allowed("http://acme.atlassian.net")
+    assert not cors.allowed(EXTENSION)
+
+
+def test_wildcard_cannot_be_stretched_past_the_host():
+    cors = CorsPolicy(DEFAULT_ORIGINS)
+    # userinfo / port / path ที่ทำให้ host จริงเป็นเครื่องอื่น
+    assert not cors.allowed("https://evil.com@acme.atlassian.net")
+    assert not cors.allowed("https://evil.com:443.atlassian.net")
+    assert not cors.allowed("https://evil.com/.atlassian.net")
+    assert not cors.allowed("https://acme.atlassian.net.evil.com")
+
+
+def test_extension_origins_need_a_pinned_id():
+    cors = CorsPolicy(parse_origins(f"{EXTENSION}, chrome-extension://*, https://*.atlassian.net"))
+    assert cors.rejected == ["chrome-extension://*"]
+    assert cors.allowed(EXTENSION)
+    assert not cors.allowed("chrome-extension://otherextensionidotherextensionid")
+    assert cors.allowed("https://acme.atlassian.net")
+
+
+def test_unlisted_origin_gets_only_vary():
+    cors = CorsPolicy()
+    assert cors.actual(None) == b"Vary: Origin\r\n"
+    assert cors.actual("https://evil.example") == b"Vary: Origin\r\n"
+    assert cors.preflight("https://evil.example") is None
+
+
+def test_blocks_are_built_once_per_origin():
+    cors = CorsPolicy()
+    block = cors.actual("https://acme.atlassian.net")
+    assert block == (b"Access-Control-Allow-Origin: https://acme.atlassian.net\r\n"
+                     b"Vary: Origin\r\nAccess-Control-Expose-Headers: ETag\r\n")
+    assert cors.actual("https://acme.atlassian.net") is block
+
+
+def test_preflight_private_network_and_max_age():
+    cors = CorsPolicy(max_age=600)
+    block = cors.preflight("https://acme.atlassian.net", private_network=True)
+    assert b"Access-Control-Max-Age: 600\r\n" in block
+    assert b"Access-Control-Allow-Private-Network: true\r\n" in block
+    assert b"Private-Network" not in cors.preflight("https://acme.atlassian.net")
+
+
+def test_any_origin():
+    cors = CorsPolicy(parse_origins("*"))
+    assert cors.actual("https://anything.example").startswith(b"Access-Control-Allow-Origin: *\r\n")
+    assert cors.actual(None) == b""
+
+
+def test_core_keeps_sessions_metrics_and_events_out_of_cors():
+    import core
+
+    headers = {"Origin": "https://acme.atlassian.net"}
+    for path in ("/sessions", "/metrics", "/events"):
+        route, _ = core.ROUTER.match("GET", path)
+        assert core.cors_for(route, headers) == b""
+        resp, block = core.preflight_response(path, headers)
+        assert resp.status == 204 and block == b""
+    route, _ = core.ROUTER.match("GET", "/whoami")
+    assert b"Access-Control-Allow-Origin" in core.cors_for(route, headers)
+    assert b"Access-Control-Allow-Origin" in core.preflight_response("/whoami", headers)[1]
+
+
+def test_events_stream_has_no_cors_headers(server):
+    import http.client
+
+    conn = http.client.HTTPConnection(*server, timeout=5)
+    try:
+        conn.request("GET", "/events", headers={"Origin": "https://acme.atlassian.net"})
+        resp = conn.getresponse()
+        assert resp.status == 200 and resp.headers["Content-Type"].startswith("text/event-stream")
+        assert not [k for k in resp.headers if k.lower().startswith("access-control-")]
+        # stream เปิดจริง (retry + event identity ที่มี sessions) เพียงแต่หน้าเว็บอ่านไม่ได้
+        assert resp.fp.readline().startswith(b"retry: ")
+    finally:
+        conn.close()
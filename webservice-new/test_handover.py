@@ -0,0 +1,79 @@
+import sys
+
+import pytest
+
+import handover
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="ส่ง socket ด้วย fd inheritance (POSIX)")
+
+CRASH = [sys.executable, "-c", "import sys; sys.exit(3)"]
+
+
+@pytest.fixture
+def supervisor(monkeypatch):
+    monkeypatch.setattr(handover, "RESPAWN_BACKOFF", (0.0, 0.0))
+    sup = handover.WorkerSupervisor([sys.executable, handover.__file__, "worker", "--fake-user", "alice"],
+                                    ("127.0.0.1", 0), drain_timeout=2)
+    sup.start()
+    yield sup
+    sup.stop()
+
+
+def crash_current(sup):
+    sup.current.proc.kill()
+    sup.current.proc.wait(5)
+
+
+def test_crashed_worker_is_replaced(supervisor):
+    old = supervisor.current.pid
+    crash_current(supervisor)
+    supervisor.check()
+    assert supervisor.current is not None and supervisor.current.pid != old
+    assert supervisor.stats()["crashes"] == 1
+
+
+def test_failed_respawn_is_retried(supervisor):
+    command = supervisor.command
+    supervisor.command = CRASH
+    crash_current(supervisor)
+    supervisor.check()
+    supervisor.check()
+    assert supervisor.current is None and supervisor.respawn_failures == 2
+
+    supervisor.command = command
+    supervisor.check()
+    assert supervisor.current is not None and supervisor.current.alive()
+    assert supervisor.respawn_failures == 0
+
+
+def test_gives_up_and_releases_port(supervisor):
+    supervisor.command = CRASH
+    crash_current(supervisor)
+    for _ in range(handover.RESPAWN_LIMIT - 1):
+        supervisor.check()
+    with pytest.raises(RuntimeError):
+        supervisor.check()
+    assert supervisor.sock is None
+
+
+def test_worker_log_lines_are_written_by_the_supervisor_logger():
+    import io
+    import logging
+
+    out = io.BytesIO()
+    record = logging.makeLogRecord({"name": "whoami_service", "levelno": logging.WARNING,
+                                    "levelname": "WARNING", "msg": "ช้า %dms", "args": (120,)})
+    handover.PipeLogTarget(out).emit_batch([record])
+    line = out.getvalue().decode("utf-8")
+    assert line.startswith("LOG ") and line.endswith("\n")
+
+    seen = []
+    capture = logging.Handler()
+    capture.emit = seen.append
+    logger = logging.getLogger("whoami_service")
+    logger.addHandler(capture)
+    try:
+        handover.relay_log(42, line[4:].strip())
+    finally:
+        logger.removeHandler(capture)
+    assert [(r.levelname, r.getMessage()) for r in seen] == [("WARNING", "[worker 42] ช้า 120ms")]
@@ -0,0 +1,28 @@
+import os
+import sys
+
+from test_core import server  # noqa: F401  (fixture)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench"))
+import loadtest  # noqa: E402
+
+
+def test_percentile_is_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile(values, 100) == 100
+    assert loadtest.percentile([7.0], 95) == 7
+    assert loadtest.percentile([], 50) == 0.0
+
+
+def test_drive_counts_requests_and_connections(server):
+    port = server[1]
+    report = loadtest.drive(port, "/whoami", 4, True, 40, None)
+    assert report["requests"] == 40 and report["errors"] == 0
+    assert report["statuses"] == {"200": 40} and report["connections"] < 40
+    lat = report["latency_ms"]
+    assert 0 < lat["p50"] <= lat["p95"] <= lat["p99"] <= lat["max"]
+
+    # --no-keep-alive: connection ใหม่ทุก request
+    assert loadtest.drive(port, "/whoami", 4, False, 20, None)["connections"] == 20
@@ -0,0 +1,58 @@
+import metrics
+from test_core import get, server  # noqa: F401  (fixture)
+
+
+def test_counter_and_gauge_render():
+    reg = metrics.Registry()
+    hits = reg.counter("demo_hits_total", "Hits by route", ["route"])
+    hits.inc(route="/whoami")
+    hits.inc(2, route='/a"b')
+    reg.gauge("demo_in_flight", "In flight").set(1.5)
+    assert reg.counter("demo_hits_total", "ลงทะเบียนซ้ำได้ตัวเดิม") is hits
+    assert reg.render() == (
+        "# HELP demo_hits_total Hits by route\n"
+        "# TYPE demo_hits_total counter\n"
+        'demo_hits_total{route="/a\\"b"} 2\n'
+        'demo_hits_total{route="/whoami"} 1\n'
+        "# HELP demo_in_flight In flight\n"
+        "# TYPE demo_in_flight gauge\n"
+        "demo_in_flight 1.5\n"
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    reg = metrics.Registry()
+    h = reg.histogram("demo_seconds", "Latency", ["route"], buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        h.observe(value, route="/x")
+    assert reg.render().splitlines()[2:] == [
+        'demo_seconds_bucket{route="/x",le="0.1"} 2',
+        'demo_seconds_bucket{route="/x",le="1"} 3',
+        'demo_seconds_bucket{route="/x",le="+Inf"} 4',
+        'demo_seconds_sum{route="/x"} 3.65',
+        'demo_seconds_count{route="/x"} 4',
+    ]
+
+
+def test_callback_errors_render_only_the_header():
+    reg = metrics.Registry()
+    reg.callback("demo_depth", "Queue depth", lambda: {("a",): 3, ("b",): None}, labelnames=["queue"])
+    reg.callback("demo_broken", "Broken", lambda: 1 / 0, kind="counter")
+    assert reg.render().splitlines() == [
+        "# HELP demo_depth Queue depth", "# TYPE demo_depth gauge", 'demo_depth{queue="a"} 3',
+        "# HELP demo_broken Broken", "# TYPE demo_broken counter",
+    ]
+
+
+def test_metrics_endpoint(server):
+    get(server, "/whoami")
+    status, headers, body = get(server, "/metrics")
+    text = body.decode()
+    assert status == 200 and headers["Content-Type"] == metrics.CONTENT_TYPE
+    assert "# TYPE whoami_http_requests_total counter\n" in text
+    assert 'whoami_http_requests_total{route="/whoami",status="200"} ' in text
+    assert 'whoami_http_request_duration_seconds_bucket{route="/whoami",le="+Inf"} ' in text
+    # ทุกบรรทัดเป็น comment หรือ "ชื่อ{labels} ค่า"
+    for line in text.splitlines():
+        if not line.startswith("# "):
+            float(line.rsplit(" ", 1)[1].replace("+Inf", "inf"))
@@ -0,0 +1,203 @@
+import threading
+import time
+
+import resolvers
+from resolvers import Resolution, Resolver, ResolverChain
+
+
+class FakeResolver(Resolver):
+    """tier ที่ตอบค่าคงที่ และนับจำนวนครั้งที่ถูกเรียก"""
+
+    def __init__(self, name, answer=None, error=None):
+        self.name = name
+        self.answer = answer
+        self.error = error
+        self.calls = 0
+
+    def lookup(self, cancel=None):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return self.answer
+
+
+def test_normalize_username():
+    assert resolvers.normalize_username("CORP\\alice\r\n") == "alice"
+    assert resolvers.normalize_username("NT AUTHORITY\\SYSTEM") is None
+    assert resolvers.normalize_username("HOST$") is None
+    assert resolvers.normalize_username("  ") is None
+
+
+def test_chain_takes_first_usable_tier_in_priority_order():
+    first = FakeResolver("first", "NT AUTHORITY\\SYSTEM")
+    second = FakeResolver("second", error=OSError("no WTS"))
+    third = FakeResolver("third", "CORP\\alice")
+    fourth = FakeResolver("fourth", "bob")
+    chain = ResolverChain([first, second, third, fourth])
+
+    assert chain.resolve() == Resolution("alice", "third")
+    assert fourth.calls == 0
+    stats = chain.stats()
+    assert stats["second"]["errors"] == 1
+    assert stats["third"]["hits"] == 1
+
+
+def test_chain_falls_back_to_default():
+    chain = ResolverChain([FakeResolver("a"), FakeResolver("b", "")])
+    assert chain.resolve() == Resolution("unknown", "default")
+
+
+def test_concurrent_resolves_run_the_tiers_once():
+    release = threading.Event()
+
+    class Blocking(FakeResolver):
+        def lookup(self, cancel=None):
+            release.wait(5)
+            return super().lookup(cancel)
+
+    tier = Blocking("slow", "alice")
+    chain = ResolverChain([tier])
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(chain.resolve())) for _ in range(10)]
+    for t in threads:
+        t.start()
+    while chain.flight.leaders + chain.flight.shared < len(threads):
+        threading.Event().wait(0.001)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert results == [Resolution("alice", "slow")] * 10
+    assert tier.calls == 1
+
+
+def test_slow_tiers_are_opt_in():
+    chain = resolvers.build_default_chain(environ={}, parallel=False)
+    assert [r.name for r in chain.resolvers] == ["wts-console", "process-token", "environment"]
+    chain = resolvers.build_default_chain(environ={"AD_RESOLVER_SLOW": "1"}, parallel=False)
+    assert "whoami" in [r.name for r in chain.resolvers]
+
+
+def test_command_tier_uses_injected_runner():
+    calls = []
+
+    def runner(cmd, timeout):
+        calls.append(cmd)
+        return 0, "CORP\\carol\n"
+
+    chain = resolvers.build_console_chain(runner=runner, environ={}, parallel=False)
+    assert chain.resolve() == Resolution("carol", "get-aduser")
+    assert calls == [resolvers.GET_ADUSER_CMD]
+
+
+class SlowFake(FakeResolver):
+    """tier ช้าที่ถือ worker ไว้เหมือน PowerShell ที่ค้าง: จนถูก cancel หรือหมด timeout ของตัวเอง"""
+    slow = True
+
+    def __init__(self, name, answer=None, timeout=10.0, delay=None):
+        super().__init__(name, answer)
+        self.timeout = timeout
+        self.delay = delay
+        self.started = threading.Event()
+
+    def lookup(self, cancel=None):
+        self.calls += 1
+        self.started.set()
+        if self.delay is not None:
+            if cancel.wait(self.delay):
+                raise resolvers.ResolverCancelled(self.name)
+            return self.answer
+        if cancel.wait(self.timeout):
+            raise resolvers.ResolverCancelled(self.name)
+        raise TimeoutError(self.name)
+
+
+def parallel(tiers, workers=4, deadline=1.0):
+    return resolvers.ParallelResolverChain(tiers, max_workers=workers, deadline=deadline)
+
+
+def test_env_fallback_wins_when_slow_tiers_hold_every_worker():
+    # แบบ AD_RESOLVER_SLOW=1: native 2 + ช้า 4 + environment บน pool 4 worker
+    slow = [SlowFake(f"slow-{i}") for i in range(4)]
+    chain = parallel([FakeResolver("wts-console"), FakeResolver("process-token"), *slow,
+                      resolvers.EnvironmentResolver({"USERNAME": "dave"})])
+    assert chain.resolve() == Resolution("dave", "environment")
+    assert all(chain.stats()[t.name]["timeouts"] == 1 for t in slow)
+
+
+def test_queued_tier_deadline_starts_when_it_runs():
+    # worker เดียว: tier ช้าตัวที่สองรอคิว 0.3 s แต่ยังได้เวลา 0.5 s ของตัวเองเต็ม ๆ
+    first = SlowFake("first", timeout=0.3)
+    second = SlowFake("second", "erin", timeout=0.5, delay=0.4)
+    chain = parallel([first, second, FakeResolver("env", "fallback")], workers=1, deadline=3.0)
+    assert chain.resolve() == Resolution("erin", "second")
+
+
+def test_native_hit_returns_without_starting_slow_tiers():
+    slow = SlowFake("slow", "x")
+    chain = parallel([FakeResolver("wts-console", "alice"), slow])
+    assert chain.resolve() == Resolution("alice", "wts-console")
+    assert not slow.started.is_set()
+
+
+def test_higher_priority_slow_tier_beats_faster_fallback():
+    chain = parallel([SlowFake("get-aduser", "CORP\\frank", delay=0.1), FakeResolver("env", "svc")])
+    assert chain.resolve() == Resolution("frank", "get-aduser")
+
+
+def test_overall_deadline_bounds_the_call():
+    chain = parallel([SlowFake("hung", timeout=10.0)], deadline=0.2)
+    started = time.monotonic()
+    assert chain.resolve() == Resolution("unknown", "default")
+    assert time.monotonic() - started < 1.0
+
+
+def test_metric_families_are_registered_with_the_first_chain():
+    import metrics
+    ResolverChain([FakeResolver("a", "alice")]).resolve()
+    assert 'resolver_tier_duration_seconds_bucket{tier="a",outcome="hit"' in metrics.REGISTRY.render()
+
+
+def test_domain_membership_is_detected_once_in_the_background():
+    release = threading.Event()
+    calls = []
+
+    def detector():
+        calls.append(1)
+        release.wait(5)
+        return True, "fake"
+
+    domain = resolvers.DomainMembership(detector)
+    thread = domain.warmup()
+    # ระหว่างยังตรวจไม่เสร็จ joined() ไม่บล็อกและตอบ False
+    assert domain.joined() is False and domain.state()["known"] is False
+    release.set()
+    thread.join(5)
+    assert domain.joined() is True
+    assert domain.state()["source"] == "fake"
+    for _ in range(5):
+        domain.joined()
+    assert len(calls) == 1
+
+
+def test_domain_detection_falls_back_to_userdnsdomain():
+    # ไม่มี netapi32 (นอก Windows) -> ดูจาก USERDNSDOMAIN
+    assert resolvers.detect_domain_joined({"USERDNSDOMAIN": "CORP.EXAMPLE"}) == (True, "environment")
+    assert resolvers.detect_domain_joined({}) == (False, "environment")
+
+
+def test_old_service_defers_shared_imports_until_first_use():
+    import os
+    import subprocess
+    import sys
+
+    old_dir = os.path.join(os.path.dirname(os.path.abspath(resolvers.__file__)), "..", "webservice-old")
+    code = (
+        "import sys, ad_server_service as s\n"
+        "lazy = ('resolvers', 'router', 'cors', 'metrics', 'asynclog', 'subprocess', 'concurrent.futures')\n"
+        "assert not [m for m in lazy if m in sys.modules], [m for m in lazy if m in sys.modules]\n"
+        "s.http_state()\n"
+        "assert 'router' in sys.modules and 'resolvers' not in sys.modules\n"
+    )
+    proc = subprocess.run([sys.executable, "-c", code], cwd=old_dir, capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
@@ -0,0 +1,70 @@
+from router import Router
+
+
+def build():
+    calls = []
+
+    def tag(name):
+        def factory(route, call):
+            def wrapped(*args):
+                calls.append((name, route.label))
+                return call(*args)
+            return wrapped
+        return factory
+
+    router = Router(middleware=[tag("outer")])
+    router.add("GET", ("/", "/whoami"), lambda headers, query: ("whoami", query), label="/whoami",
+               query=True, middleware=[tag("inner")])
+    router.add("GET", "/healthz", lambda headers, query: ("healthz", query))
+    router.add("POST", "/admin/refresh", lambda headers, query: "refresh")
+    return router, calls
+
+
+def test_aliases_share_one_route_and_label():
+    router, _ = build()
+    route, _ = router.match("GET", "/")
+    assert route is router.match("GET", "/whoami")[0]
+    assert router.label("/") == router.label("/whoami?x=1") == "/whoami"
+
+
+def test_query_is_parsed_only_for_routes_that_ask():
+    router, _ = build()
+    assert router.match("GET", "/whoami?fields=username,host")[1] == {"fields": ["username,host"]}
+    route, query = router.match("GET", "/healthz?verbose=1")
+    assert route.label == "/healthz" and query == {}
+
+
+def test_unknown_path_and_wrong_method():
+    router, _ = build()
+    # 404: ไม่มี path นี้เลย
+    assert router.match("GET", "/nope") == (None, {})
+    assert router.allowed("/nope") == []
+    assert router.label("/nope") == "other"
+    # 405: มี path แต่ไม่มี method นี้ (allowed() ใช้ทำ Allow header)
+    assert router.match("POST", "/whoami")[0] is None
+    assert router.allowed("/whoami?x=1") == ["GET"]
+    assert router.allowed("/admin/refresh") == ["POST"]
+    assert router.match("GET", "/whoami/")[0] is None  # ไม่ตัด / ท้าย path
+
+
+def test_middleware_wraps_once_with_router_wide_outermost():
+    router, calls = build()
+    route, query = router.match("GET", "/whoami")
+    assert route.call(None, query) == ("whoami", {})
+    assert calls == [("outer", "/whoami"), ("inner", "/whoami")]
+    assert route.handler(None, {}) == ("whoami", {})  # handler เดิมไม่ถูกห่อ
+
+
+def test_routes_lists_each_route_once():
+    router, _ = build()
+    assert [r.label for r in router.routes()] == ["/whoami", "/healthz", "/admin/refresh"]
+
+
+def test_core_route_table_404_and_405():
+    import core
+
+    assert core.ROUTER.match("GET", "/whoami?fields=username")[0].label == "/whoami"
+    assert core.method_not_allowed("/nope").status == 404
+    resp = core.method_not_allowed("/sessions?fields=sessions")
+    assert resp.status == 405
+    assert ("Allow", "GET, HEAD, OPTIONS") in resp.headers
@@ -0,0 +1,52 @@
+from sessionbus import SessionEvent, SessionEventBus
+
+
+def test_every_subscriber_gets_events_in_order():
+    bus = SessionEventBus()
+    first, second = [], []
+    bus.subscribe(first.append)
+    bus.subscribe(second.append)
+    events = [SessionEvent("logon", 2), SessionEvent("lock", 2), SessionEvent("remote-connect", 3)]
+    for event in events:
+        bus.publish(event)
+    bus.join()
+
+    assert first == events and second == events
+    assert bus.stats()["counts"] == {"logon": 1, "lock": 1, "remote-connect": 1}
+    assert bus.stats()["recent"][-1] == {"event": "remote-connect", "session_id": 3, "ts": round(events[-1].ts, 3)}
+
+
+def test_failing_subscriber_does_not_block_the_others():
+    bus = SessionEventBus()
+    seen = []
+
+    def broken(event):
+        raise RuntimeError("boom")
+
+    bus.subscribe(broken)
+    bus.subscribe(seen.append)
+    bus.publish(SessionEvent("logoff"))
+    bus.join()
+    assert [e.kind for e in seen] == ["logoff"]
+
+
+def test_unsubscribe_stops_delivery():
+    bus = SessionEventBus()
+    seen = []
+    bus.subscribe(seen.append)
+    bus.publish(SessionEvent("logon", 1))
+    bus.join()
+    bus.unsubscribe(seen.append)
+    bus.unsubscribe(seen.append)  # ซ้ำได้ไม่ error
+    bus.publish(SessionEvent("logoff", 1))
+    bus.join()
+    assert [e.kind for e in seen] == ["logon"]
+    assert bus.stats()["pending"] == 0
+
+
+def test_history_is_bounded():
+    bus = SessionEventBus(history=2)
+    for kind in ("logon", "lock", "unlock"):
+        bus.publish(SessionEvent(kind))
+    bus.join()
+    assert [e["event"] for e in bus.stats()["recent"]] == ["lock", "unlock"]
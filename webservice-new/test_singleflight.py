@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_load():
+    flight = SingleFlight()
+    entered = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        entered.set()
+        release.wait(5)
+        return "alice"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", load)))
+    leader.start()
+    assert entered.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("k", load))) for _ in range(8)]
+    for t in followers:
+        t.start()
+    # รอให้ทุก follower เข้าไปรอผลของ leader ก่อนปล่อย
+    while flight.shared < len(followers):
+        threading.Event().wait(0.001)
+    release.set()
+    for t in [leader, *followers]:
+        t.join(5)
+
+    assert results == ["alice"] * 9
+    assert len(calls) == 1
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "shared": 8}
+
+
+def test_error_propagates_and_next_call_reloads():
+    flight = SingleFlight()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        flight.do("k", fail)
+    assert flight.do("k", lambda: "bob") == "bob"
+    assert flight.leaders == 2
+
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("b", lambda: 2) == 2
+    assert flight.shared == 0
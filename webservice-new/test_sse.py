@@ -0,0 +1,73 @@
+import time
+
+import sse
+
+
+class FakeSubscriber:
+    """จำทุก payload; ok=False จำลอง client ที่หลุด/ช้า"""
+
+    def __init__(self, ok: bool = True):
+        self.sent = []
+        self.ok = ok
+        self.closed = False
+
+    def send(self, data: bytes) -> bool:
+        if self.ok:
+            self.sent.append(data)
+        return self.ok
+
+    def close(self):
+        self.closed = True
+
+
+def test_format_event():
+    assert sse.format_event("identity", {"a": 1}, 7) == b'id: 7\nevent: identity\ndata: {"a":1}\n\n'
+    assert sse.format_event(None, "x\ny") == b"data: x\ndata: y\n\n"
+
+
+def test_subscribe_publish_and_drop_dead_clients():
+    hub = sse.EventHub(heartbeat=60, retry_ms=1500)
+    alive, dying = FakeSubscriber(), FakeSubscriber()
+    try:
+        assert hub.subscribe(alive, b"first")
+        assert hub.subscribe(dying)
+        assert alive.sent == [b"retry: 1500\n\nfirst"]
+
+        hub.publish("identity", {"v": 1}, 1)
+        assert alive.sent[-1] == dying.sent[-1] == sse.format_event("identity", {"v": 1}, 1)
+
+        dying.ok = False
+        hub.publish("identity", {"v": 2}, 2)
+        assert dying.closed and not alive.closed
+        assert hub.stats() == {"clients": 1, "max_clients": 256, "connected": 2, "events": 2, "dropped": 1}
+
+        hub.unsubscribe(alive)
+        hub.publish("identity", {"v": 3}, 3)
+        assert len(alive.sent) == 3 and hub.stats()["clients"] == 0
+    finally:
+        hub.close()
+
+
+def test_max_clients_and_failed_initial_send():
+    hub = sse.EventHub(heartbeat=60, max_clients=1)
+    try:
+        assert not hub.subscribe(FakeSubscriber(ok=False))
+        assert hub.subscribe(FakeSubscriber())
+        assert hub.full() and not hub.subscribe(FakeSubscriber())
+        assert hub.stats()["connected"] == 1
+    finally:
+        hub.close()
+
+
+def test_heartbeat_and_close():
+    hub = sse.EventHub(heartbeat=0.02)
+    sub = FakeSubscriber()
+    hub.subscribe(sub)
+    deadline = time.monotonic() + 5
+    while sse.HEARTBEAT not in sub.sent:
+        assert time.monotonic() < deadline, "no heartbeat"
+        time.sleep(0.01)
+    hub.close()
+    assert sub.closed and hub.stats()["clients"] == 0
+    hub._thread.join(1)
+    assert not hub._thread.is_alive()
@@ -3,41 +3,97 @@
 Simple HTTP server to get AD username (sAMAccountName)
 Run: python ad_server.py
 Test: curl http://127.0.0.1:7777/username
+Re-check domain membership: curl -X POST http://127.0.0.1:7777/admin/refresh-domain
 """
 
 import json
 import os
-import subprocess
 import sys
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse
+
+# resolvers, router and cors come from the whoami service in ../webservice-new
+# (resolvers in turn loads singleflight and metrics from there)
+_SHARED_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'webservice-new')
+if _SHARED_DIR not in sys.path:
+    sys.path.append(_SHARED_DIR)
+
+from resolvers import DomainMembership, build_console_chain  # noqa: E402
+from cors import CorsPolicy, parse_origins  # noqa: E402
+from router import Router  # noqa: E402
+
+# Get-ADUser / whoami / USERNAME, launched concurrently with one overall deadline
+RESOLVER = build_console_chain()
+# Detected once in the background at startup; POST /admin/refresh-domain re-checks
+DOMAIN = DomainMembership()
+# Browser origins allowed to read /username, comma-separated ("*" = any); default: *.atlassian.net only.
+# Extension origins must be exact IDs (chrome-extension://<id>); wildcards like chrome-extension://* are ignored.
+CORS = CorsPolicy(parse_origins(os.environ.get('AD_CORS_ORIGINS')), max_age=7200)
+
+# Route table: (method, path) -> handler(request_handler, query); query strings are ignored
+ROUTER = Router()
+
+
+@ROUTER.route('GET', '/username', '/', label='/username')
+def get_username(handler, query):
+    handler.get_username()
+
+
+@ROUTER.route('POST', '/admin/refresh-domain')
+def refresh_domain(handler, query):
+    try:
+        response = {"ok": True, "domain": DOMAIN.refresh()}
+    except Exception as e:
+        response = {"ok": False, "error": str(e)}
+    body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'application/json; charset=utf-8')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
 
 class ADUsernameHandler(BaseHTTPRequestHandler):
+    _cors = b''  # precomputed CORS header block for the current request's Origin
+
     def do_GET(self):
         """Handle GET requests"""
-        parsed_path = urlparse(self.path)
+        route, query = ROUTER.match('GET', self.path)
+        self._cors = CORS.actual(self.headers.get('Origin'))
         
-        # Add CORS headers
-        self.send_cors_headers()
+        if route is not None:
+            route.call(self, query)
+        else:
+            self.send_error(404, "Not Found")
+    
+    def do_POST(self):
+        """Handle admin requests (no CORS: not meant for browser pages)"""
+        route, query = ROUTER.match('POST', self.path)
+        self._cors = b''
         
-        if parsed_path.path == '/username' or parsed_path.path == '/':
-            self.get_username()
+        if route is not None:
+            route.call(self, query)
         else:
             self.send_error(404, "Not Found")
     
     def do_OPTIONS(self):
-        """Handle preflight OPTIONS requests"""
-        self.send_cors_headers()
-        self.send_response(204)
+        """Handle preflight OPTIONS requests; the browser caches the answer for Access-Control-Max-Age"""
+        origin = self.headers.get('Origin')
+        if 'GET' in ROUTER.allowed(self.path):
+            private_network = (self.headers.get('Access-Control-Request-Private-Network') or '').lower() == 'true'
+            self._cors = CORS.preflight(origin, private_network) or b''
+            self.send_response(204)
+            self.send_header('Allow', 'GET, OPTIONS')
+        else:
+            self._cors = CORS.actual(origin)
+            self.send_response(404)
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
-    def send_cors_headers(self):
-        """Send CORS headers for browser compatibility"""
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.send_header('Content-Type', 'application/json; charset=utf-8')
+    def end_headers(self):
+        """Append the precomputed CORS block (one status line; headers built once per origin)"""
+        if self._cors and self.request_version != 'HTTP/0.9':
+            self._headers_buffer.append(self._cors)
+        super().end_headers()
     
     def get_username(self):
         """Get AD username and return as JSON"""
@@ -55,64 +111,20 @@ class ADUsernameHandler(BaseHTTPRequestHandler):
                 "error": str(e)
             }
         
-        # Send response
+        body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        response_json = json.dumps(response, ensure_ascii=False)
-        self.wfile.write(response_json.encode('utf-8'))
+        self.wfile.write(body)
     
     def get_ad_username(self):
-        """Get AD username (sAMAccountName) from domain"""
-        try:
-            # Method 1: Try PowerShell Get-ADUser (requires RSAT)
-            cmd = [
-                'powershell', '-Command',
-                'try { Import-Module ActiveDirectory -ErrorAction Stop; '
-                '(Get-ADUser -Identity $env:USERNAME).sAMAccountName } '
-                'catch { $env:USERNAME }'
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            if result.returncode == 0 and result.stdout.strip():
-                return result.stdout.strip()
-        except Exception:
-            pass
-        
-        try:
-            # Method 2: Try whoami command
-            cmd = ['whoami']
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=5)
-            if result.returncode == 0 and result.stdout.strip():
-                # Extract username from DOMAIN\username format
-                username = result.stdout.strip()
-                if '\\' in username:
-                    return username.split('\\')[-1]
-                return username
-        except Exception:
-            pass
-        
-        try:
-            # Method 3: Try net user command
-            username = os.environ.get('USERNAME', '')
-            if username:
-                cmd = ['net', 'user', username, '/domain']
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    return username
-        except Exception:
-            pass
-        
-        # Fallback: Environment variable
-        return os.environ.get('USERNAME', 'unknown')
+        """Get AD username (sAMAccountName); tiers run in parallel, best answer wins"""
+        return RESOLVER.resolve().username
     
     def is_domain_joined(self):
-        """Check if computer is joined to domain"""
-        try:
-            cmd = ['systeminfo']
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            if result.returncode == 0:
-                return 'Domain:' in result.stdout and 'WORKGROUP' not in result.stdout
-        except Exception:
-            pass
-        return False
+        """Check if computer is joined to domain (cached; never blocks the request)"""
+        return DOMAIN.joined()
     
     def log_message(self, format, *args):
         """Custom log format"""
@@ -126,9 +138,14 @@ def main():
     print(f"Starting AD Username HTTP Server...")
     print(f"Server: http://{host}:{port}/")
     print(f"Endpoint: http://{host}:{port}/username")
+    if CORS.rejected:
+        print(f"AD_CORS_ORIGINS: ignoring wildcard origins {', '.join(CORS.rejected)} (use exact extension IDs)")
     print(f"Press Ctrl+C to stop")
     print("-" * 50)
     
+    # Domain detection runs in the background so the first request never waits for it
+    DOMAIN.warmup()
+    
     try:
         server = HTTPServer((host, port), ADUsernameHandler)
         server.serve_forever()
@@ -1,13 +1,22 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import sys
 import os
-import time
 import threading
-import signal
+import socketserver
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import json
-import subprocess
+import logging
 from datetime import datetime
 
+# resolvers, router, cors, metrics and asynclog are shared with the whoami service in ../webservice-new.
+# They are imported on first use (resolver, first request, first log line), not here: resolvers
+# pulls in subprocess and concurrent.futures, which service start does not need.
+_SHARED_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'webservice-new')
+if _SHARED_DIR not in sys.path:
+    sys.path.append(_SHARED_DIR)
+
 # Windows Service imports
 try:
     import win32serviceutil
@@ -23,34 +32,93 @@ except ImportError:
 HOST = '127.0.0.1'
 PORT = 7777
 
+# Native tiers only by default; set AD_RESOLVER_SLOW=1 to add the PowerShell/whoami tiers.
+# Built on first use so that importing this module (service start) stays cheap.
+_resolver = None
+_resolver_lock = threading.Lock()
+
+def get_resolver():
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                from resolvers import build_default_chain
+                _resolver = build_default_chain()
+    return _resolver
+
+# service.log is written by a background thread; _log only enqueues
+_logger = logging.getLogger('ad_server_service')
+_logger.setLevel(logging.INFO)
+_log_handler = None
+_log_init_lock = threading.Lock()
+
 def _log(msg: str):
+    global _log_handler
     try:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        with open(os.path.join(script_dir, 'service.log'), 'a', encoding='utf-8') as f:
-            f.write(f"{datetime.now().isoformat()} | {msg}\n")
+        if _log_handler is None:
+            with _log_init_lock:
+                if _log_handler is None:
+                    import asynclog
+                    _log_handler = asynclog.attach(
+                        _logger, os.path.join(_script_dir(), 'service.log'), '%(message)s')
+        _logger.info('%s | %s', datetime.now().isoformat(), msg)
     except Exception:
         # Best-effort; ignore logging errors
         pass
 
+def _flush_log():
+    if _log_handler is not None:
+        _log_handler.stop()
+
 def _script_dir():
     return os.path.dirname(os.path.abspath(__file__))
 
 def _svc_name_path():
     return os.path.join(_script_dir(), 'service_name.txt')
 
-# Early import marker for diagnostics (helps detect import failures under PythonService)
-try:
-    _log("module import: ad_server_service loaded")
-    # Log key environment info to aid service startup debugging
+def _log_environment():
+    """Key environment info for service debugging (logged after SERVICE_RUNNING, not at import)"""
     for k in ["PYTHONHOME", "PYTHONPATH", "Path", "PATH", "AppDirectory"]:
-        try:
-            v = os.environ.get(k)
-            if v:
-                _log(f"env {k}={v}")
-        except Exception:
-            pass
-except Exception:
-    pass
+        v = os.environ.get(k)
+        if v:
+            _log(f"env {k}={v}")
+
+class StartupPhases:
+    """Milliseconds spent in each start-up phase, logged once and shown on /status"""
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.last = origin
+        self.phases = []
+        self.warm_ms = None
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, round((now - self.last) * 1000, 1)))
+        self.last = now
+
+    def total_ms(self):
+        return round(sum(ms for _name, ms in self.phases), 1)
+
+    def summary(self):
+        parts = [f"{name}={ms}ms" for name, ms in self.phases]
+        return ' '.join(parts + [f"total={self.total_ms()}ms"])
+
+    def as_dict(self):
+        return {"phases_ms": dict(self.phases), "total_ms": self.total_ms(), "resolver_warm_ms": self.warm_ms}
+
+STARTUP = StartupPhases(_IMPORT_STARTED)
+
+def _warm_resolver():
+    """Build the chain and resolve once in the background so the first request is served hot"""
+    started = time.perf_counter()
+    try:
+        http_state()
+        get_resolver().resolve()
+    except Exception as e:
+        _log(f"resolver warm-up failed: {e}")
+    STARTUP.warm_ms = round((time.perf_counter() - started) * 1000, 1)
+    _log(f"startup: resolver warm-up {STARTUP.warm_ms}ms")
 
 def _read_saved_service_name():
     try:
@@ -67,131 +135,170 @@ def _write_saved_service_name(name: str):
     except Exception as e:
         _log(f"Failed to write service_name.txt: {e}")
 
+def _send_json(handler, response):
+    handler.send_response(200)
+    handler.send_header('Content-type', 'application/json')
+    handler.end_headers()
+    handler.wfile.write(json.dumps(response).encode())
+
+
+def get_username(handler, query):
+    try:
+        resolution = get_resolver().resolve()
+        response = {
+            "ok": True,
+            "username": resolution.username,
+            "method": "AD",
+            "source": resolution.source
+        }
+    except Exception as e:
+        response = {
+            "ok": False,
+            "error": str(e)
+        }
+    _send_json(handler, response)
+
+
+def get_status(handler, query):
+    _send_json(handler, {
+        "service": "AD Username HTTP Server",
+        "status": "running",
+        "endpoint": f"http://{HOST}:{PORT}/username",
+        "resolvers": get_resolver().stats(),
+        "coalescing": get_resolver().flight.stats(),
+        "startup": STARTUP.as_dict()
+    })
+
+
+def get_metrics(handler, query):
+    metrics = http_state().metrics
+    body = metrics.REGISTRY.render().encode('utf-8')
+    handler.send_response(200)
+    handler.send_header('Content-type', metrics.CONTENT_TYPE)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class _HttpState:
+    """Route table, CORS policy and request metrics; built once by http_state()"""
+
+    def __init__(self):
+        import metrics
+        from cors import CorsPolicy, parse_origins
+        from router import Router
+
+        # Browser origins allowed to read responses, comma-separated; default: cors.DEFAULT_ORIGINS (*.atlassian.net).
+        # Extension origins must be exact IDs (chrome-extension://<id>); wildcards like chrome-extension://* are ignored.
+        self.cors = CorsPolicy(parse_origins(os.environ.get('AD_CORS_ORIGINS')), max_age=7200)
+        # One dict lookup per request; handlers take (handler, query)
+        self.router = Router()
+        self.router.add('GET', '/username', get_username)
+        self.router.add('GET', ('/', '/status'), get_status, label='/status')
+        # Scraped by Prometheus, never by a page: no CORS headers at all
+        self.router.add('GET', '/metrics', get_metrics, cors=False)
+
+        self.metrics = metrics
+        self.requests = metrics.REGISTRY.counter(
+            'ad_username_http_requests_total', 'HTTP requests by route and status', ['route', 'status'])
+        self.seconds = metrics.REGISTRY.histogram(
+            'ad_username_http_request_duration_seconds', 'Time to handle and write one request', ['route'])
+        self.in_flight = metrics.REGISTRY.gauge(
+            'ad_username_http_in_flight_requests', 'Requests currently being handled')
+        metrics.REGISTRY.callback(
+            'ad_username_resolve_coalesced_total', 'Resolutions that shared an in-flight lookup',
+            lambda: get_resolver().flight.shared, kind='counter')
+        metrics.REGISTRY.callback(
+            'ad_username_resolve_coalesce_ratio', 'shared / (shared + leaders)',
+            lambda: round(get_resolver().flight.shared / max(1, get_resolver().flight.shared + get_resolver().flight.leaders), 4))
+        metrics.REGISTRY.callback(
+            'ad_username_log_dropped_total', 'Log records dropped because the log queue was full',
+            lambda: _log_handler.dropped if _log_handler else None, kind='counter')
+
+    def cors_for(self, route, origin):
+        """CORS block for a GET response; routes added with cors=False get none"""
+        if route is not None and not route.options.get('cors', True):
+            return b''
+        return self.cors.actual(origin)
+
+_http = None
+_http_lock = threading.Lock()
+
+def http_state():
+    """Built on the first request (or resolver warm-up), so service start only pays for the stdlib"""
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                _http = _HttpState()
+    return _http
+
 class ADUsernameHandler(BaseHTTPRequestHandler):
+    _cors = b''  # precomputed CORS header block for the current request's Origin
+
     def do_GET(self):
-        if self.path == '/username':
-            try:
-                username = self.get_ad_username()
-                response = {
-                    "ok": True,
-                    "username": username,
-                    "method": "AD"
-                }
-            except Exception as e:
-                response = {
-                    "ok": False,
-                    "error": str(e)
-                }
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode())
-        
-        elif self.path == '/' or self.path == '/status':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            response = {
-                "service": "AD Username HTTP Server",
-                "status": "running",
-                "endpoint": f"http://{HOST}:{PORT}/username"
-            }
-            self.wfile.write(json.dumps(response).encode())
-        
+        started = time.perf_counter()
+        http = http_state()
+        http.in_flight.inc()
+        self._status = 200
+        route, query = http.router.match('GET', self.path)
+        self._cors = http.cors_for(route, self.headers.get('Origin'))
+        try:
+            if route is None:
+                self.send_response(404)
+                self.end_headers()
+            else:
+                route.call(self, query)
+        finally:
+            http.in_flight.dec()
+            label = route.label if route is not None else 'other'
+            http.requests.inc(route=label, status=str(self._status))
+            http.seconds.observe(time.perf_counter() - started, route=label)
+
+    def do_OPTIONS(self):
+        """CORS preflight; the browser caches the answer for Access-Control-Max-Age"""
+        http = http_state()
+        origin = self.headers.get('Origin')
+        route, _ = http.router.match('GET', self.path)
+        if route is not None:
+            private_network = (self.headers.get('Access-Control-Request-Private-Network') or '').lower() == 'true'
+            if route.options.get('cors', True):
+                self._cors = http.cors.preflight(origin, private_network) or b''
+            self.send_response(204)
+            self.send_header('Allow', 'GET, OPTIONS')
         else:
+            self._cors = http.cors.actual(origin)
             self.send_response(404)
-            self.end_headers()
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        http.requests.inc(route='preflight', status=str(self._status))
 
-    def get_ad_username(self):
-        """Get AD username (sAMAccountName) from domain"""
-        
-        # Method 1: Get logged-in user via explorer.exe process (works even in service mode)
-        try:
-            cmd = [
-                'powershell', '-Command',
-                'Get-Process explorer -IncludeUserName -ErrorAction SilentlyContinue | '
-                'Where-Object {$_.UserName -and $_.UserName -notlike "*$"} | '
-                'Select-Object -First 1 -ExpandProperty UserName | '
-                'ForEach-Object { $_.Split("\\")[-1] }'
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            if result.returncode == 0 and result.stdout.strip():
-                username = result.stdout.strip()
-                if username and username.lower() not in ['system', 'local service', 'network service']:
-                    return username
-        except Exception:
-            pass
-        
-        # Method 2: Get active console session user
-        try:
-            cmd = [
-                'powershell', '-Command',
-                'query user | Select-String "Active" | ForEach-Object { ($_ -split "\\s+")[1] }'
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=5)
-            if result.returncode == 0 and result.stdout.strip():
-                username = result.stdout.strip()
-                if username and username.lower() not in ['system', 'local service', 'network service']:
-                    return username
-        except Exception:
-            pass
-        
-        # Method 3: Try PowerShell Get-ADUser (requires RSAT) - only if not system account
-        try:
-            cmd = [
-                'powershell', '-Command',
-                'try { Import-Module ActiveDirectory -ErrorAction Stop; '
-                '(Get-ADUser -Identity $env:USERNAME).sAMAccountName } '
-                'catch { $env:USERNAME }'
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            if result.returncode == 0 and result.stdout.strip():
-                username = result.stdout.strip()
-                if username and username.lower() not in ['system', 'local service', 'network service']:
-                    return username
-        except Exception:
-            pass
-        
-        # Method 4: Try whoami command (fallback)
-        try:
-            cmd = ['whoami']
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=5)
-            if result.returncode == 0 and result.stdout.strip():
-                # Extract username from DOMAIN\username format
-                username = result.stdout.strip()
-                if '\\' in username:
-                    username = username.split('\\')[-1]
-                if username and username.lower() not in ['system', 'local service', 'network service']:
-                    return username
-        except Exception:
-            pass
-        
-        # Method 5: Environment variable (last resort)
-        username = os.environ.get('USERNAME', 'unknown')
-        if username.lower() not in ['system', 'local service', 'network service']:
-            return username
-        
-        # If all methods return system accounts, return a default
-        return 'unknown'
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
 
-    def is_domain_joined(self):
-        """Check if computer is joined to domain"""
-        try:
-            cmd = ['systeminfo']
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            if result.returncode == 0:
-                return 'Domain:' in result.stdout and 'WORKGROUP' not in result.stdout
-        except Exception:
-            pass
-        return False
+    def end_headers(self):
+        if self._cors and self.request_version != 'HTTP/0.9':
+            self._headers_buffer.append(self._cors)
+        super().end_headers()
+
+    def get_ad_username(self):
+        """Get AD username (sAMAccountName) via the resolver chain"""
+        return get_resolver().resolve().username
 
     def log_message(self, format, *args):
         """Custom log format"""
         print(f"[{self.date_time_string()}] {format % args}")
 
+class ADUsernameHTTPServer(HTTPServer):
+    def server_bind(self):
+        # HTTPServer.server_bind resolves getfqdn(host), a reverse DNS lookup that can take
+        # seconds on machines with slow/missing DNS; the name is only used for SERVER_NAME
+        socketserver.TCPServer.server_bind(self)
+        host, port = self.server_address[:2]
+        self.server_name = host
+        self.server_port = port
+
 class ADUsernameServer:
     def __init__(self):
         self.httpd = None
@@ -205,35 +312,16 @@ class ADUsernameServer:
             if self.httpd:
                 self.stop()
             
-            # Create new server
-            self.httpd = HTTPServer((HOST, PORT), ADUsernameHandler)
+            # bind() + listen() happen in the constructor: once it returns, connections
+            # queue in the backlog, so no sleep or connect probe is needed
+            self.httpd = ADUsernameHTTPServer((HOST, PORT), ADUsernameHandler)
+            self.stop_event.clear()
             self.server_thread = threading.Thread(target=self._run_server)
             self.server_thread.daemon = True
             self.server_thread.start()
-            _log("ADUsernameServer.start: thread started; sleeping 1s")
-            
-            # Give the server more time to start in service context
-            time.sleep(1)
-            
-            # Check if the server actually started
-            import socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                sock.settimeout(5)
-                result = sock.connect_ex((HOST, PORT))
-                sock.close()
-                if result == 0:
-                    _log(f"ADUsernameServer.start: server reachable on {HOST}:{PORT}")
-                    print(f"Server started successfully on {HOST}:{PORT}")
-                    return True
-                else:
-                    _log(f"ADUsernameServer.start: connect_ex returned {result}")
-                    print(f"Failed to connect to server on {HOST}:{PORT}")
-                    return False
-            except Exception as e:
-                _log(f"ADUsernameServer.start: error checking server status: {e}")
-                print(f"Error checking server status: {e}")
-                return False
+            _log(f"ADUsernameServer.start: listening on {HOST}:{PORT}")
+            print(f"Server started successfully on {HOST}:{PORT}")
+            return True
             
         except Exception as e:
             _log(f"ADUsernameServer.start: exception {e}")
@@ -280,33 +368,32 @@ if WINDOWS_SERVICE:
             self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
             win32event.SetEvent(self.hWaitStop)
             self.server.stop()
+            _flush_log()
 
         def SvcDoRun(self):
             # Report that we're starting
             self.ReportServiceStatus(win32service.SERVICE_START_PENDING)
-            _log("SvcDoRun: START_PENDING reported")
-            
-            servicemanager.LogMsg(
-                servicemanager.EVENTLOG_INFORMATION_TYPE,
-                servicemanager.PYS_SERVICE_STARTED,
-                (self._svc_name_, '')
-            )
+            STARTUP.mark('service_init')
             
             try:
                 # Set working directory to script location
                 script_dir = os.path.dirname(os.path.abspath(__file__))
                 os.chdir(script_dir)
-                _log(f"SvcDoRun: chdir to {script_dir}")
-                
-                # Log startup attempt
-                servicemanager.LogInfoMsg(f"Starting AD Username HTTP Service from {script_dir}")
-                _log("SvcDoRun: calling server.start()")
                 
                 if self.server.start():
-                    # Report that we're running successfully
+                    STARTUP.mark('bind')
+                    # Report RUNNING as soon as the socket is bound; everything else is deferred
                     self.ReportServiceStatus(win32service.SERVICE_RUNNING)
-                    _log("SvcDoRun: SERVICE_RUNNING reported")
-                    servicemanager.LogInfoMsg(f"AD Username HTTP Service started on http://{HOST}:{PORT}")
+                    STARTUP.mark('running')
+                    _log(f"SvcDoRun: SERVICE_RUNNING reported; startup {STARTUP.summary()}")
+                    threading.Thread(target=_warm_resolver, daemon=True).start()
+                    servicemanager.LogMsg(
+                        servicemanager.EVENTLOG_INFORMATION_TYPE,
+                        servicemanager.PYS_SERVICE_STARTED,
+                        (self._svc_name_, '')
+                    )
+                    servicemanager.LogInfoMsg(f"AD Username HTTP Service started on http://{HOST}:{PORT} from {script_dir}")
+                    _log_environment()
                     # Wait for stop signal
                     win32event.WaitForSingleObject(self.hWaitStop, win32event.INFINITE)
                     _log("SvcDoRun: stop signal received; exiting")
@@ -658,6 +745,7 @@ def run_console():
     print("Press Ctrl+C to stop")
     print("-" * 50)
     
+    import signal
     server = ADUsernameServer()
     
     def signal_handler(sig, frame):
@@ -667,7 +755,11 @@ def run_console():
     
     signal.signal(signal.SIGINT, signal_handler)
     
+    STARTUP.mark('console_init')
     if server.start():
+        STARTUP.mark('bind')
+        print(f"Startup: {STARTUP.summary()}")
+        threading.Thread(target=_warm_resolver, daemon=True).start()
         try:
             while not server.stop_event.is_set():
                 time.sleep(1)
@@ -717,6 +809,8 @@ def debug_service():
     
     print("=== Debug Complete ===")
 
+STARTUP.mark('imports')
+
 def main():
     if len(sys.argv) > 1:
         command = sys.argv[1].lower()